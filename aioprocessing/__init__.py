@@ -9,6 +9,8 @@ __all__ = [
     "AioQueue",
     "AioSimpleQueue",
     "AioJoinableQueue",
+    "AioPriorityQueue",
+    "AioShmQueue",
     "AioLock",
     "AioRLock",
     "AioCondition",
@@ -92,6 +94,9 @@ def AioPool(
     coro_map()
     coro_starmap()
 
+    coro_imap() and coro_imap_unordered() return asynchronous
+    iterators. Cancelling a coroutine cancels its work in the pool.
+
     """
     context = context if context else _get_context()
     from .pool import AioPool
@@ -111,6 +116,7 @@ def AioManager(*, context=None):
     Provides the follow asyncio-friendly objects:
 
     AioQueue
+    AioPriorityQueue
     AioBarrier
     AioBoundedSemaphore
     AioCondition
@@ -130,58 +136,145 @@ def AioManager(*, context=None):
     return m
 
 
-def AioPipe(duplex=True):
-    """ Returns a pair of AioConnection objects. """
+def AioPipe(duplex=True, *, serializer=None, compression=None, **kwargs):
+    """ Returns a pair of AioConnection objects.
+
+    serializer, compression and any other keyword arguments (e.g.
+    compression_threshold or native) are passed on to both AioConnection
+    objects.
+
+    """
     from .connection import AioConnection
 
     conn1, conn2 = multiprocessing.Pipe(duplex=duplex)
     # Transform the returned connection instances into
     # instance of AioConnection.
-    conn1 = AioConnection(conn1)
-    conn2 = AioConnection(conn2)
+    conn1 = AioConnection(
+        conn1, serializer=serializer, compression=compression, **kwargs
+    )
+    conn2 = AioConnection(
+        conn2, serializer=serializer, compression=compression, **kwargs
+    )
     return conn1, conn2
 
 
 # queues
 
 
-def AioQueue(maxsize=0, *, context=None):
+def AioQueue(
+    maxsize=0,
+    *,
+    high_watermark=None,
+    low_watermark=None,
+    serializer=None,
+    stats=False,
+    context=None
+):
     """ Returns an asyncio-friendly version of a multiprocessing.Queue
 
     Returns an AioQueue objects with the given context. If a context
     is not provided, the default for the platform will be used.
+    high_watermark and low_watermark control when coro_put holds off;
+    see AioQueue for details. serializer picks how items are serialized;
+    see serialization.get_serializer for the options. If stats is True,
+    the queue keeps throughput and latency figures; see stats().
 
     """
     context = context = context if context else _get_context()
     from .queues import AioQueue
 
-    return AioQueue(maxsize, ctx=context)
+    return AioQueue(
+        maxsize,
+        high_watermark=high_watermark,
+        low_watermark=low_watermark,
+        serializer=serializer,
+        stats=stats,
+        ctx=context,
+    )
 
 
-def AioJoinableQueue(maxsize=0, *, context=None):
+def AioJoinableQueue(
+    maxsize=0,
+    *,
+    high_watermark=None,
+    low_watermark=None,
+    serializer=None,
+    stats=False,
+    context=None
+):
     """ Returns an asyncio-friendly version of a multiprocessing.JoinableQueue
 
     Returns an AioJoinableQueue object with the given context. If a context
     is not provided, the default for the platform will be used.
+    high_watermark and low_watermark control when coro_put holds off;
+    see AioQueue for details. serializer picks how items are serialized;
+    see serialization.get_serializer for the options. If stats is True,
+    the queue keeps throughput and latency figures; see stats().
 
     """
     context = context = context if context else _get_context()
     from .queues import AioJoinableQueue
 
-    return AioJoinableQueue(maxsize, ctx=context)
+    return AioJoinableQueue(
+        maxsize,
+        high_watermark=high_watermark,
+        low_watermark=low_watermark,
+        serializer=serializer,
+        stats=stats,
+        ctx=context,
+    )
+
+
+def AioPriorityQueue(
+    levels=3, maxsize=0, *, serializer=None, stats=False, context=None
+):
+    """ Returns an asyncio-friendly priority queue.
+
+    Returns an AioPriorityQueue object with the given context, which
+    orders (priority, data) items by priority across processes. priority
+    must be an int from 0 to levels - 1. If a context is not provided,
+    the default for the platform will be used.
+    serializer picks how the data of each item is serialized, and
+    stats=True keeps throughput and latency figures.
+
+    """
+    context = context if context else _get_context()
+    from .queues import AioPriorityQueue
+
+    return AioPriorityQueue(
+        levels, maxsize, serializer=serializer, stats=stats, ctx=context
+    )
 
 
-def AioSimpleQueue(*, context=None):
+def AioSimpleQueue(*, serializer=None, stats=False, context=None):
     """ Returns an asyncio-friendly version of a multiprocessing.SimpleQueue
 
     Returns an AioSimpleQueue object with the given context. If a context
     is not provided, the default for the platform will be used.
+    serializer picks how items are serialized; see
+    serialization.get_serializer for the options. If stats is True,
+    the queue keeps throughput and latency figures; see stats().
 
     """
     context = context = context if context else _get_context()
     from .queues import AioSimpleQueue
 
-    return AioSimpleQueue(ctx=context)
+    return AioSimpleQueue(serializer=serializer, stats=stats, ctx=context)
+
+
+def AioShmQueue(capacity=1 << 20, *, context=None):
+    """ Returns an asyncio-friendly queue backed by shared memory.
+
+    Items are copied into a ring buffer of capacity bytes in shared
+    memory, instead of going through a pipe and a feeder thread.
+    Synchronization primitives are created with the given context. If a
+    context is not provided, the default for the platform will be used.
+
+    """
+    context = context if context else _get_context()
+    from .queues import AioShmQueue
+
+    return AioShmQueue(capacity, ctx=context)
 
 
 # locks
@@ -0,0 +1,93 @@
+import threading
+from collections import deque
+
+__all__ = ["BufferPool", "release"]
+
+
+class _PooledBuffer(bytearray):
+    """ A bytearray that remembers the BufferPool it belongs to. """
+
+    __slots__ = ("pool",)
+
+
+class BufferPool:
+    """ A pool of reusable receive buffers, in power-of-two size classes.
+
+    acquire(nbytes) returns a writable memoryview of exactly nbytes,
+    backed by a buffer from the smallest size class that fits it, from
+    min_size bytes up to max_size bytes. Once the memoryview is no longer
+    needed, release(view) puts its buffer back in the pool, to be handed
+    out again, instead of allocating a fresh one for every message.
+    Views can't be used after they're released, and any other views of
+    the same buffer must not be used either.
+
+    Up to max_buffers free buffers are kept in each size class. Requests
+    for more than max_size bytes get a buffer of their own, which is
+    dropped when it's released. A BufferPool can be shared between
+    threads.
+
+    """
+
+    def __init__(self, *, min_size=1 << 12, max_size=1 << 26, max_buffers=8):
+        if min_size < 1 or max_size < min_size:
+            raise ValueError("Need 1 <= min_size <= max_size")
+        self._min_bits = (min_size - 1).bit_length()
+        self._max_bits = (max_size - 1).bit_length()
+        self._max_buffers = max_buffers
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, nbytes):
+        """ Returns a memoryview of nbytes from a pooled buffer. """
+        if nbytes < 0:
+            raise ValueError("nbytes must not be negative")
+        bits = max((nbytes - 1).bit_length(), self._min_bits)
+        buf = None
+        if bits <= self._max_bits:
+            with self._lock:
+                free = self._free.get(bits)
+                if free:
+                    buf = free.pop()
+            if buf is None:
+                buf = _PooledBuffer(1 << bits)
+        else:
+            buf = _PooledBuffer(nbytes)
+        buf.pool = self
+        return memoryview(buf)[:nbytes]
+
+    def copy(self, data):
+        """ Returns a pooled memoryview holding a copy of data. """
+        data = memoryview(data).cast("B")
+        view = self.acquire(data.nbytes)
+        view[:] = data
+        return view
+
+    def release(self, view):
+        """ Puts the buffer behind view, from acquire, back in the pool. """
+        buf = view.obj
+        if not isinstance(buf, _PooledBuffer) or buf.pool is not self:
+            raise ValueError("view wasn't acquired from this pool")
+        view.release()
+        # Released buffers are marked, so releasing one twice can't put
+        # it in the pool twice.
+        buf.pool = None
+        bits = (len(buf) - 1).bit_length()
+        if len(buf) != 1 << bits or bits > self._max_bits:
+            return
+        with self._lock:
+            free = self._free.setdefault(bits, deque())
+            if len(free) < self._max_buffers:
+                free.append(buf)
+
+    def free_buffers(self):
+        """ Returns how many free buffers the pool is holding. """
+        with self._lock:
+            return sum(len(free) for free in self._free.values())
+
+
+def release(view):
+    """ Puts the buffer behind view back in the pool it came from. """
+    buf = view.obj
+    if not isinstance(buf, _PooledBuffer) or buf.pool is None:
+        raise ValueError("view isn't from a BufferPool, or was released")
+    buf.pool.release(view)
@@ -1,10 +1,33 @@
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import hmac
+import os
+import select
+import time
+from collections import deque
 
-from .mp import connection as _connection
-from .executor import CoroBuilder
-from .util import run_in_executor
+from . import buffers, serialization, transport
+from .mp import connection as _connection, reduction
+from .executor import CoroBuilder, shared_executor
+from .util import (
+    _NO_SENTINEL,
+    _WAIT_SLICE,
+    PrefetchIterator,
+    run_in_executor,
+    supports_readers,
+    wait_readable,
+    wait_slices,
+)
 
-__all__ = ["AioConnection"]
+__all__ = ["AioConnection", "coro_select"]
+
+# The largest message send_stream and coro_send_stream send at once.
+STREAM_CHUNK_SIZE = 1 << 20
+
+# A stream ends with an empty message, then one of these. An aborted
+# stream's status is followed by a description of the error.
+_STREAM_OK = b"\x00"
+_STREAM_ABORTED = b"\x01"
 
 
 class AioConnection(metaclass=CoroBuilder):
@@ -14,17 +37,537 @@ class AioConnection(metaclass=CoroBuilder):
         "send_bytes",
         "recv_bytes",
         "recv_bytes_into",
+        "recv_bytes_pooled",
+        "send_buffers",
+        "recv_into_buffers",
         "send",
+        "send_oob",
+        "recv_oob",
+    ]
+    interruptible = [
+        "recv",
+        "recv_bytes",
+        "recv_bytes_pooled",
+        "recv_into_buffers",
+        "poll",
     ]
 
-    def __init__(self, obj):
+    def __init__(
+        self,
+        obj,
+        *,
+        serializer=None,
+        compression=None,
+        compression_threshold=serialization.COMPRESSION_THRESHOLD,
+        native=False
+    ):
         """ Initialize the AioConnection.
 
         obj - a multiprocessing.Connection object.
+        serializer - how send and recv turn objects into bytes and back.
+                     See serialization.get_serializer for the options.
+                     Both ends of the connection must use the same one.
+        compression - "zlib" or "lzma" to compress messages sent with
+                      send and send_bytes that are at least
+                      compression_threshold bytes long. Every message
+                      is flagged with how it was encoded, so both ends
+                      must enable compression, but the codecs and
+                      thresholds can differ. send_oob never compresses.
+        native - if True, obj is wrapped in a transport.NativeConnection,
+                 so coro_send, coro_recv, coro_send_bytes,
+                 coro_recv_bytes and coro_poll wait on the event loop
+                 instead of running in the ThreadPoolExecutor. The other
+                 end can be a plain Connection. Ignored on Windows.
 
         """
         super().__init__()
+        serialization.check_compression(compression)
+        if native and transport.supported:
+            if not isinstance(obj, transport.NativeConnection):
+                obj = transport.NativeConnection(obj)
         self._obj = obj
+        self._native = isinstance(obj, transport.NativeConnection)
+        self._serializer = serialization.get_serializer(serializer)
+        self._compression = compression
+        self._compression_threshold = compression_threshold
+        # Messages received by cancelled coro_recv and coro_recv_bytes
+        # calls, which are handed to the next recv or recv_bytes.
+        self._orphans = {"recv": deque(), "recv_bytes": deque()}
+
+    def send(self, obj):
+        if self._compression is not None:
+            return self.send_bytes(self._dumps(obj))
+        if self._serializer is None:
+            return self._obj.send(obj)
+        return self._obj.send_bytes(self._serializer.dumps(obj))
+
+    def recv(self):
+        if self._orphans["recv"]:
+            return self._orphans["recv"].popleft()
+        if self._compression is not None:
+            return self._loads(self.recv_bytes())
+        if self._serializer is None:
+            return self._obj.recv()
+        return self._serializer.loads(self._obj.recv_bytes())
+
+    def send_bytes(self, buf, offset=0, size=None):
+        if self._compression is None:
+            return self._obj.send_bytes(buf, offset, size)
+        self._obj.send_bytes(
+            serialization.compress_frame(
+                transport.byte_view(buf, offset, size),
+                self._compression,
+                self._compression_threshold,
+            )
+        )
+
+    def recv_bytes(self, maxlength=None):
+        if self._orphans["recv_bytes"]:
+            return self._orphans["recv_bytes"].popleft()
+        if self._compression is None:
+            return self._obj.recv_bytes(maxlength)
+        return serialization.decompress_frame(
+            self._obj.recv_bytes(), maxlength
+        )
+
+    def recv_bytes_into(self, buf, offset=0):
+        if self._compression is None:
+            return self._obj.recv_bytes_into(buf, offset)
+        data = self.recv_bytes()
+        m = memoryview(buf)
+        itemsize = m.itemsize
+        m = m.cast("B")
+        start = offset * itemsize
+        if start < 0 or start > m.nbytes:
+            raise ValueError("offset out of bounds")
+        if len(data) > m.nbytes - start:
+            raise _connection.BufferTooShort(data)
+        m[start:start + len(data)] = data
+        return len(data) // itemsize
+
+    def recv_bytes_pooled(self, pool, maxlength=None):
+        """ Receive a message into a buffer from pool, a BufferPool.
+
+        Returns a memoryview of the message. Call pool.release(view)
+        once done with it, so its buffer can be reused for a later
+        message, instead of a new one being allocated for every
+        message. On POSIX platforms, uncompressed messages are read
+        straight into the pooled buffer.
+
+        """
+        if self._orphans["recv_bytes"]:
+            return pool.copy(self._orphans["recv_bytes"].popleft())
+        if self._compression is None:
+            return transport.recv_bytes_pooled(self._obj, pool, maxlength)
+        return self._decompress_pooled(
+            transport.recv_bytes_pooled(self._obj, pool), pool, maxlength
+        )
+
+    def send_buffers(self, buffers):
+        """ Send the contents of several buffers as one message.
+
+        buffers is a list of bytes-like objects. The other end receives
+        them as a single message, as if they had been joined together
+        and sent with send_bytes, e.g. with recv_bytes or
+        recv_into_buffers. On POSIX platforms, they're written with
+        writev after the message header, rather than being copied into
+        one bytes object first.
+
+        """
+        if self._compression is not None:
+            buffers = serialization.compress_frames(
+                buffers, self._compression, self._compression_threshold
+            )
+        transport.send_buffers(self._obj, buffers)
+
+    def recv_into_buffers(self, buffers):
+        """ Receive a message into several writable buffers, in turn.
+
+        Returns a list of memoryviews of the bytes filled in each buffer.
+        If the message doesn't fit, BufferTooShort is raised, holding
+        the whole message. On POSIX platforms, uncompressed messages
+        are read straight into the buffers.
+
+        """
+        if self._orphans["recv_bytes"]:
+            return transport.scatter(
+                self._orphans["recv_bytes"].popleft(), buffers
+            )
+        if self._compression is None:
+            return transport.recv_into_buffers(self._obj, buffers)
+        return transport.scatter(self.recv_bytes(), buffers)
+
+    def _decompress_pooled(self, view, pool, maxlength):
+        try:
+            data = serialization.decompress_frame(view, maxlength)
+        except BaseException:
+            pool.release(view)
+            raise
+        if not isinstance(data, memoryview) or data.obj is not view.obj:
+            data = pool.copy(data)
+            pool.release(view)
+        return data
+
+    def poll(self, timeout=0.0):
+        if self._orphans["recv"] or self._orphans["recv_bytes"]:
+            return True
+        return self._obj.poll(timeout)
+
+    def _interruptible_poll(self, cancelled, timeout=0.0):
+        if timeout is not None and timeout <= 0:
+            return self.poll(timeout)
+        for wait in wait_slices(timeout, cancelled):
+            if self.poll(wait):
+                return True
+        return False
+
+    def _interruptible_recv(self, cancelled):
+        self._interruptible_poll(cancelled, None)
+        return self.recv()
+
+    def _interruptible_recv_bytes(self, cancelled, maxlength=None):
+        self._interruptible_poll(cancelled, None)
+        return self.recv_bytes(maxlength)
+
+    def _interruptible_recv_bytes_pooled(
+        self, cancelled, pool, maxlength=None
+    ):
+        self._interruptible_poll(cancelled, None)
+        return self.recv_bytes_pooled(pool, maxlength)
+
+    def _interruptible_recv_into_buffers(self, cancelled, buffers):
+        self._interruptible_poll(cancelled, None)
+        return self.recv_into_buffers(buffers)
+
+    def _select_readers(self):
+        """ Returns the connections coro_select watches for this one. """
+        return [self._obj]
+
+    def _select_pending(self):
+        """ Returns True if recv has a message to return without reading. """
+        if self._native and self._obj.has_message():
+            return True
+        return bool(self._orphans["recv"] or self._orphans["recv_bytes"])
+
+    def coro_send(self, obj, *, loop=None):
+        """ Asynchronous version of send.
+
+        With native=True, obj is serialized (and compressed) on the
+        event loop, and sent without using the ThreadPoolExecutor.
+
+        """
+        if not self._natively(loop):
+            return self.run_in_executor(self.send, obj, loop=loop)
+        return asyncio.ensure_future(
+            self._obj.coro_send_bytes(self._encode(obj), loop=loop),
+            loop=loop,
+        )
+
+    def coro_recv(self, *, loop=None):
+        """ Asynchronous version of recv. """
+        if not self._natively(loop):
+            return self.run_interruptibly("recv", loop=loop)
+        return asyncio.ensure_future(self._recv_natively(loop), loop=loop)
+
+    async def _recv_natively(self, loop):
+        if self._orphans["recv"]:
+            return self._orphans["recv"].popleft()
+        data = await self._obj.coro_recv_bytes(loop=loop)
+        if self._compression is not None:
+            data = serialization.decompress_frame(data)
+        return self._loads(data)
+
+    def coro_send_bytes(self, buf, offset=0, size=None, *, loop=None):
+        """ Asynchronous version of send_bytes. """
+        if not self._natively(loop):
+            return self.run_in_executor(
+                self.send_bytes, buf, offset, size, loop=loop
+            )
+        data = transport.byte_view(buf, offset, size)
+        if self._compression is not None:
+            data = memoryview(
+                serialization.compress_frame(
+                    data, self._compression, self._compression_threshold
+                )
+            )
+        return asyncio.ensure_future(
+            self._obj.coro_send_bytes(data, loop=loop), loop=loop
+        )
+
+    def coro_recv_bytes(self, maxlength=None, *, loop=None):
+        """ Asynchronous version of recv_bytes. """
+        if not self._natively(loop):
+            return self.run_interruptibly("recv_bytes", maxlength, loop=loop)
+        return asyncio.ensure_future(
+            self._recv_bytes_natively(maxlength, loop), loop=loop
+        )
+
+    async def _recv_bytes_natively(self, maxlength, loop):
+        if self._orphans["recv_bytes"]:
+            return self._orphans["recv_bytes"].popleft()
+        if self._compression is None:
+            return await self._obj.coro_recv_bytes(maxlength, loop=loop)
+        return serialization.decompress_frame(
+            await self._obj.coro_recv_bytes(loop=loop), maxlength
+        )
+
+    def coro_send_buffers(self, buffers, *, loop=None):
+        """ Asynchronous version of send_buffers. """
+        if not self._natively(loop):
+            return self.run_in_executor(self.send_buffers, buffers, loop=loop)
+        if self._compression is not None:
+            buffers = serialization.compress_frames(
+                buffers, self._compression, self._compression_threshold
+            )
+        return asyncio.ensure_future(
+            self._obj.coro_send_buffers(buffers, loop=loop), loop=loop
+        )
+
+    def coro_recv_into_buffers(self, buffers, *, loop=None):
+        """ Asynchronous version of recv_into_buffers. """
+        if not self._natively(loop):
+            return self.run_interruptibly(
+                "recv_into_buffers", buffers, loop=loop
+            )
+        return asyncio.ensure_future(
+            self._recv_into_buffers_natively(buffers, loop), loop=loop
+        )
+
+    async def _recv_into_buffers_natively(self, buffers, loop):
+        data = await self._recv_bytes_natively(None, loop)
+        return transport.scatter(data, buffers)
+
+    def coro_recv_bytes_pooled(self, pool, maxlength=None, *, loop=None):
+        """ Asynchronous version of recv_bytes_pooled. """
+        if not self._natively(loop):
+            return self.run_interruptibly(
+                "recv_bytes_pooled", pool, maxlength, loop=loop
+            )
+        return asyncio.ensure_future(
+            self._recv_bytes_pooled_natively(pool, maxlength, loop), loop=loop
+        )
+
+    async def _recv_bytes_pooled_natively(self, pool, maxlength, loop):
+        if self._orphans["recv_bytes"]:
+            return pool.copy(self._orphans["recv_bytes"].popleft())
+        if self._compression is None:
+            return await self._obj.coro_recv_bytes_pooled(
+                pool, maxlength, loop=loop
+            )
+        view = await self._obj.coro_recv_bytes_pooled(pool, loop=loop)
+        return self._decompress_pooled(view, pool, maxlength)
+
+    def coro_poll(self, timeout=0.0, *, loop=None):
+        """ Asynchronous version of poll. """
+        if not self._natively(loop):
+            return self.run_interruptibly("poll", timeout, loop=loop)
+        return asyncio.ensure_future(
+            self._poll_natively(timeout, loop), loop=loop
+        )
+
+    async def _poll_natively(self, timeout, loop):
+        if self._orphans["recv"] or self._orphans["recv_bytes"]:
+            return True
+        return await self._obj.coro_poll(timeout, loop=loop)
+
+    def _natively(self, loop):
+        """ Returns True if coroutines can skip the executor on loop. """
+        if not self._native:
+            return False
+        return supports_readers(loop if loop else asyncio.get_event_loop())
+
+    def _encode(self, obj):
+        """ Returns the frame that send sends for obj. """
+        data = self._dumps(obj)
+        if self._compression is not None:
+            data = serialization.compress_frame(
+                data, self._compression, self._compression_threshold
+            )
+        return data
+
+    def _hand_back(self, func, result):
+        if func == "recv_bytes_pooled":
+            # Keep a copy, so the pooled buffer isn't held indefinitely.
+            data = bytes(result)
+            buffers.release(result)
+            self._orphans["recv_bytes"].append(data)
+        elif func == "recv_into_buffers":
+            data = b"".join(view.tobytes() for view in result)
+            self._orphans["recv_bytes"].append(data)
+        elif func in self._orphans:
+            self._orphans[func].append(result)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_orphans"] = {"recv": deque(), "recv_bytes": deque()}
+        return state
+
+    def _dumps(self, obj):
+        if self._serializer is None:
+            return reduction.ForkingPickler.dumps(obj)
+        return self._serializer.dumps(obj)
+
+    def _loads(self, data):
+        if self._serializer is None:
+            return reduction.ForkingPickler.loads(data)
+        return self._serializer.loads(data)
+
+    def send_oob(self, obj, *, threshold=serialization.OOB_THRESHOLD):
+        """ Send obj, shipping its large buffers out-of-band.
+
+        obj is pickled with protocol 5, and every buffer of at least
+        threshold bytes (e.g. the data of a NumPy array, a memoryview or
+        a pickle.PickleBuffer) is sent as its own frame, straight from
+        the original object's memory, rather than being copied into the
+        pickle. The other end must receive the message with recv_oob.
+
+        """
+        payload, buffers = serialization.dumps_oob(obj, threshold)
+        self._obj.send_bytes(
+            serialization.pack_oob_header(payload, buffers)
+        )
+        for buf in buffers:
+            self._obj.send_bytes(buf)
+
+    def recv_oob(self):
+        """ Receive an object sent with send_oob.
+
+        The rebuilt object uses the received frames as its buffers
+        without copying them, so e.g. NumPy arrays will be read-only.
+
+        """
+        payload, sizes = serialization.unpack_oob_header(
+            self._obj.recv_bytes()
+        )
+        buffers = [self._obj.recv_bytes() for _ in sizes]
+        return serialization.loads_oob(payload, buffers)
+
+    def send_stream(self, iterable, *, chunk_size=STREAM_CHUNK_SIZE):
+        """ Send the bytes-like objects from iterable as a stream.
+
+        Each object is sent in messages of at most chunk_size bytes, and
+        the next object isn't taken from iterable until the previous one
+        has been sent, so only one needs to be held in memory at a time,
+        however much data is sent. The other end must receive the data
+        with recv_stream or coro_recv_stream. If iterable raises an
+        error, or gives an object that isn't bytes-like, the stream is
+        ended as aborted and the error is raised.
+
+        """
+        it = iter(iterable)
+        while True:
+            try:
+                chunks = _chunks(next(it), chunk_size)
+            except StopIteration:
+                break
+            except Exception as e:
+                for frame in _stream_end(e):
+                    self.send_bytes(frame)
+                raise
+            for chunk in chunks:
+                self.send_bytes(chunk)
+        for frame in _stream_end():
+            self.send_bytes(frame)
+
+    def recv_stream(self, maxlength=None):
+        """ Returns an iterator over the chunks of a stream, as bytes.
+
+        The stream must have been sent with send_stream or
+        coro_send_stream. OSError is raised if a chunk is longer than
+        maxlength, or if the sender aborted the stream. The iterator
+        must be exhausted before anything else is received.
+
+        """
+        while True:
+            chunk = self.recv_bytes(maxlength)
+            if not chunk:
+                _check_stream_end(self.recv_bytes())
+                return
+            yield chunk
+
+    def coro_send_stream(
+        self, iterable, *, chunk_size=STREAM_CHUNK_SIZE, loop=None
+    ):
+        """ Asynchronous version of send_stream.
+
+        iterable can be an asynchronous or a regular iterable. Each
+        chunk is sent with coro_send_bytes, and the next one isn't sent
+        until the previous one has been written, so a slow receiver
+        holds up the sender, rather than data piling up in memory. If
+        this is cancelled, the stream is left unfinished, and the
+        connection can't be used for streams any more.
+
+        """
+        return asyncio.ensure_future(
+            self._send_stream(iterable, chunk_size, loop), loop=loop
+        )
+
+    async def _send_stream(self, iterable, chunk_size, loop):
+        if hasattr(iterable, "__aiter__"):
+            it = iterable.__aiter__()
+            next_item = it.__anext__
+        else:
+            next_item = functools.partial(_next_item, iter(iterable))
+        while True:
+            try:
+                chunks = _chunks(await next_item(), chunk_size)
+            except StopAsyncIteration:
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                for frame in _stream_end(e):
+                    await self.coro_send_bytes(frame, loop=loop)
+                raise
+            for chunk in chunks:
+                await self.coro_send_bytes(chunk, loop=loop)
+        for frame in _stream_end():
+            await self.coro_send_bytes(frame, loop=loop)
+
+    def coro_recv_stream(self, maxlength=None, *, prefetch=0, loop=None):
+        """ Asynchronous version of recv_stream.
+
+        Returns an asynchronous iterator over the chunks. If prefetch
+        is more than 0, up to that many chunks are received ahead of the
+        consumer. The iterator must be exhausted before anything else
+        is received.
+
+        """
+        return PrefetchIterator(
+            functools.partial(self._recv_chunk, maxlength, loop),
+            prefetch,
+            sentinel=b"",
+            loop=loop,
+        )
+
+    async def _recv_chunk(self, maxlength, loop):
+        chunk = await self.coro_recv_bytes(maxlength, loop=loop)
+        if not chunk:
+            _check_stream_end(await self.coro_recv_bytes(loop=loop))
+            return b""
+        return chunk
+
+    def iterate(self, prefetch=0, *, sentinel=_NO_SENTINEL, loop=None):
+        """ Returns an asynchronous iterator over received objects.
+
+        Each object is received with coro_recv, and iteration ends when
+        the other end of the connection is closed, or sentinel is
+        received, if given. If prefetch is more than 0, up to that many
+        objects are received ahead of the consumer. Objects that were
+        prefetched when the iteration is abandoned are returned by the
+        iterator's aclose() coroutine.
+
+        """
+        return PrefetchIterator(
+            functools.partial(self.coro_recv, loop=loop),
+            prefetch,
+            sentinel=sentinel,
+            stop_on=(EOFError,),
+            loop=loop,
+        )
+
+    def __aiter__(self):
+        return self.iterate()
 
     def __enter__(self):
         self._obj.__enter__()
@@ -34,19 +577,409 @@ class AioConnection(metaclass=CoroBuilder):
         self._obj.__exit__(*args, **kwargs)
 
 
-def AioClient(*args, **kwargs):
-    """ Returns an AioConnection instance. """
+def _chunks(data, chunk_size):
+    """ Returns the bytes of data as slices of at most chunk_size. """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    view = transport.byte_view(data)
+    return [
+        view[start:start + chunk_size]
+        for start in range(0, view.nbytes, chunk_size)
+    ]
+
+
+async def _next_item(it):
+    try:
+        return next(it)
+    except StopIteration:
+        raise StopAsyncIteration
+
+
+def _stream_end(error=None):
+    """ Returns the messages that end a stream. """
+    if error is None:
+        return [b"", _STREAM_OK]
+    description = "{}: {}".format(type(error).__name__, error)
+    return [b"", _STREAM_ABORTED + description.encode("utf-8", "replace")]
+
+
+def _check_stream_end(status):
+    """ Raises OSError if status says the stream was aborted. """
+    if status[:1] == _STREAM_ABORTED:
+        raise OSError(
+            "stream aborted by sender: {}".format(
+                bytes(status[1:]).decode("utf-8", "replace")
+            )
+        )
+    if status != _STREAM_OK:
+        raise OSError("bad stream status")
+
+
+def AioClient(
+    *args,
+    serializer=None,
+    compression=None,
+    compression_threshold=serialization.COMPRESSION_THRESHOLD,
+    native=False,
+    **kwargs
+):
+    """ Returns an AioConnection instance.
+
+    serializer, compression, compression_threshold and native are
+    passed on to the AioConnection.
+
+    """
     conn = _connection.Client(*args, **kwargs)
-    return AioConnection(conn)
+    return AioConnection(
+        conn,
+        serializer=serializer,
+        compression=compression,
+        compression_threshold=compression_threshold,
+        native=native,
+    )
+
+
+class AioClientPool:
+    """ A pool of authenticated connections to one listener.
+
+    Connections are made with AioClient(address, family, authkey), with
+    the given serializer, compression and native settings, in the
+    shared ThreadPoolExecutor, and kept open between uses, so a client
+    that makes many short requests doesn't pay for a connection and an
+    authentication challenge every time:
+
+        async with pool.connection() as conn:
+            await conn.coro_send(request)
+            reply = await conn.coro_recv()
+
+    At most max_size connections are open at once (any number, if it's
+    None); once that many are in use, acquiring another one waits until
+    one is released. Idle
+    connections are checked before they're handed out again, and ones
+    the listener has closed, or that have unread data waiting, are
+    closed and replaced. Connections idle for more than idle_timeout
+    seconds (if given) are closed too.
+
+    """
+
+    def __init__(
+        self,
+        address,
+        family=None,
+        authkey=None,
+        *,
+        max_size=10,
+        idle_timeout=None,
+        serializer=None,
+        compression=None,
+        compression_threshold=serialization.COMPRESSION_THRESHOLD,
+        native=False
+    ):
+        if max_size is not None and max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self._connect = functools.partial(
+            AioClient,
+            address,
+            family,
+            authkey,
+            serializer=serializer,
+            compression=compression,
+            compression_threshold=compression_threshold,
+            native=native,
+        )
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        # (connection, time released) pairs, most recently released last.
+        self._idle = deque()
+        self._sem = None
+        self._closed = False
+
+    def connection(self, *, loop=None):
+        """ Returns an async context manager for a pooled connection.
+
+        The connection is released back to the pool when the block
+        exits, or closed, if the block raised an error, since whatever
+        exchange it was in the middle of can't be picked up again.
+
+        """
+        return _PoolConnection(self, loop)
+
+    async def acquire(self, *, loop=None):
+        """ Returns an open connection, from the pool if there is one.
+
+        The connection must be handed back with release.
+
+        """
+        if self._closed:
+            raise OSError("pool is closed")
+        if not loop:
+            loop = asyncio.get_event_loop()
+        if self._sem is None and self._max_size is not None:
+            self._sem = asyncio.Semaphore(self._max_size)
+        if self._sem is not None:
+            await self._sem.acquire()
+        try:
+            conn = self._take_idle()
+            if conn is None:
+                conn = await self._new_connection(loop)
+        except BaseException:
+            if self._sem is not None:
+                self._sem.release()
+            raise
+        return conn
+
+    def release(self, conn, *, discard=False):
+        """ Hands conn back to the pool, or closes it, if discard is True.
+        """
+        try:
+            if discard or self._closed or conn.closed:
+                conn.close()
+            else:
+                self._idle.append((conn, time.monotonic()))
+                self._expire()
+        finally:
+            if self._sem is not None:
+                self._sem.release()
+
+    def idle_connections(self):
+        """ Returns how many open connections are waiting to be reused. """
+        self._expire()
+        return len(self._idle)
+
+    def close(self):
+        """ Closes the idle connections, and the others once released. """
+        self._closed = True
+        while self._idle:
+            self._idle.popleft()[0].close()
+
+    async def _new_connection(self, loop):
+        fut = run_in_executor(shared_executor(), self._connect, loop=loop)
+        try:
+            # The connection can't be abandoned half made, so it's
+            # shielded, and closed once it's made if this was cancelled.
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            fut.add_done_callback(_close_result)
+            raise
+
+    def _take_idle(self):
+        """ Returns the most recently used healthy idle connection, if any.
+        """
+        self._expire()
+        while self._idle:
+            conn = self._idle.pop()[0]
+            try:
+                # An idle connection should have nothing to read; if it
+                # has, it's either closed at the other end, or out of
+                # step with it.
+                if not conn.closed and not conn.poll(0):
+                    return conn
+            except (EOFError, OSError):
+                pass
+            conn.close()
+        return None
+
+    def _expire(self):
+        """ Closes the connections that have been idle too long. """
+        if self._idle_timeout is None:
+            return
+        oldest = time.monotonic() - self._idle_timeout
+        while self._idle and self._idle[0][1] < oldest:
+            self._idle.popleft()[0].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+
+class _PoolConnection:
+    """ The async context manager returned by AioClientPool.connection. """
+
+    def __init__(self, pool, loop):
+        self._pool = pool
+        self._loop = loop
+        self._conn = None
+
+    async def __aenter__(self):
+        self._conn = await self._pool.acquire(loop=self._loop)
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._pool.release(self._conn, discard=exc_type is not None)
+
+
+def _close_result(fut):
+    if not fut.cancelled() and fut.exception() is None:
+        fut.result().close()
 
 
 class AioListener(metaclass=CoroBuilder):
     delegate = _connection.Listener
     coroutines = ["accept"]
+    interruptible = ["accept"]
+    wrapper_kwargs = [
+        "serializer",
+        "compression",
+        "compression_threshold",
+        "native",
+    ]
+
+    def __init__(
+        self,
+        *args,
+        serializer=None,
+        compression=None,
+        compression_threshold=serialization.COMPRESSION_THRESHOLD,
+        native=False,
+        **kwargs
+    ):
+        serialization.check_compression(compression)
+        self._serializer = serialization.get_serializer(serializer)
+        self._compression = compression
+        self._compression_threshold = compression_threshold
+        self._native = native
+        # Connections accepted by cancelled coro_accept calls, which
+        # are handed to the next accept.
+        self._orphans = deque()
 
     def accept(self):
-        conn = self._obj.accept()
-        return AioConnection(conn)
+        """ Accept a connection.
+
+        The AioConnection returned uses the listener's serializer,
+        compression and native settings.
+
+        """
+        if self._orphans:
+            return self._orphans.popleft()
+        return self._wrap(self._obj.accept())
+
+    def _interruptible_accept(self, cancelled):
+        sock = getattr(self._obj._listener, "_socket", None)
+        if sock is not None and not self._orphans:
+            for wait in wait_slices(None, cancelled):
+                if _connection.wait([sock], wait):
+                    break
+        return self.accept()
+
+    def _hand_back(self, func, result):
+        self._orphans.append(result)
+
+    def coro_serve(self, handler, max_concurrency=None, *, loop=None):
+        """ Accept connections and hand each one to handler, concurrently.
+
+        handler is a coroutine function that's called with an
+        AioConnection for each client, once it has been authenticated,
+        and run as its own task. The connection is closed when handler
+        returns. Up to max_concurrency clients (any number, if None) are
+        authenticated and handled at once; once that many are, no more
+        are accepted until one of them is done.
+
+        On POSIX platforms, listeners on sockets accept clients and run
+        the authentication challenge on the event loop, so clients
+        don't queue up behind each other, and no threads are used.
+        Elsewhere, each accept is run in the ThreadPoolExecutor, one at
+        a time.
+
+        Pass a backlog bigger than the default of 1 to the listener if
+        many clients connect at once, or some of them may be left
+        waiting for the operating system to retry their connection.
+
+        Returns a Future that runs until it's cancelled. Cancelling it
+        also cancels any handlers still running. Errors raised by
+        handler, or while authenticating a client, are passed to the
+        event loop's exception handler, and the other clients are
+        served as usual.
+
+        """
+        if not loop:
+            loop = asyncio.get_event_loop()
+        listener = self._obj._listener
+        if listener is None:
+            raise OSError("listener is closed")
+        sock = getattr(listener, "_socket", None)
+        if sock is None or not transport.supported:
+            serve = self._serve_from_executor(handler, max_concurrency, loop)
+        elif not supports_readers(loop):
+            serve = self._serve_from_executor(handler, max_concurrency, loop)
+        else:
+            serve = self._serve(sock, handler, max_concurrency, loop)
+        return asyncio.ensure_future(serve, loop=loop)
+
+    async def _serve(self, sock, handler, max_concurrency, loop):
+        limit = _ServeLimit(max_concurrency, loop)
+        sock.setblocking(False)
+        try:
+            while True:
+                await limit.acquire()
+                while True:
+                    try:
+                        s, addr = sock.accept()
+                        break
+                    except BlockingIOError:
+                        await wait_readable([sock.fileno()], loop=loop)
+                    except BaseException:
+                        limit.release()
+                        raise
+                self._obj._listener._last_accepted = addr
+                s.setblocking(True)
+                conn = _connection.Connection(s.detach())
+                limit.start(self._serve_one(conn, handler, loop))
+        finally:
+            sock.setblocking(True)
+            await limit.cancel_all()
+
+    async def _serve_one(self, conn, handler, loop):
+        authkey = self._obj._authkey
+        try:
+            if authkey:
+                native = transport.NativeConnection(conn)
+                await _deliver_challenge(native, authkey, loop)
+                await _answer_challenge(native, authkey, loop)
+                if not self._native:
+                    os.set_blocking(native.fileno(), True)
+                else:
+                    conn = native
+        except BaseException:
+            conn.close()
+            raise
+        await self._handle(self._wrap(conn), handler)
+
+    async def _serve_from_executor(self, handler, max_concurrency, loop):
+        limit = _ServeLimit(max_concurrency, loop)
+        try:
+            while True:
+                await limit.acquire()
+                try:
+                    conn = await self.coro_accept(loop=loop)
+                except _connection.AuthenticationError as e:
+                    limit.release()
+                    _report(loop, "Authenticating a client failed", e)
+                    continue
+                except BaseException:
+                    limit.release()
+                    raise
+                limit.start(self._handle(conn, handler))
+        finally:
+            await limit.cancel_all()
+
+    async def _handle(self, conn, handler):
+        try:
+            await handler(conn)
+        finally:
+            conn.close()
+
+    def _wrap(self, conn):
+        """ Returns an AioConnection for conn, with the listener's settings.
+        """
+        return AioConnection(
+            conn,
+            serializer=self._serializer,
+            compression=self._compression,
+            compression_threshold=self._compression_threshold,
+            native=self._native,
+        )
 
     def __enter__(self):
         self._obj.__enter__()
@@ -56,22 +989,304 @@ class AioListener(metaclass=CoroBuilder):
         self._obj.__exit__(*args, **kwargs)
 
 
-def coro_deliver_challenge(*args, **kwargs):
-    executor = ThreadPoolExecutor(max_workers=1)
+class _ServeLimit:
+    """ Keeps track of the client tasks run by AioListener.coro_serve. """
+
+    def __init__(self, max_concurrency, loop):
+        if max_concurrency is not None and max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self._loop = loop
+        self._tasks = set()
+        self._sem = None
+        if max_concurrency is not None:
+            self._sem = asyncio.Semaphore(max_concurrency)
+
+    async def acquire(self):
+        if self._sem is not None:
+            await self._sem.acquire()
+
+    def release(self):
+        if self._sem is not None:
+            self._sem.release()
+
+    def start(self, coro):
+        """ Runs coro as a task, which releases its slot when done. """
+        task = asyncio.ensure_future(coro, loop=self._loop)
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        self.release()
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            _report(self._loop, "Serving a client failed", error)
+
+    async def cancel_all(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+
+def _report(loop, message, error):
+    loop.call_exception_handler({"message": message, "exception": error})
+
+
+# The handshake constants were renamed in Python 3.12, when the challenge
+# started naming the digest to answer it with.
+_CHALLENGE = getattr(_connection, "_CHALLENGE", None) or getattr(
+    _connection, "CHALLENGE", None
+)
+_WELCOME = getattr(_connection, "_WELCOME", None) or getattr(
+    _connection, "WELCOME", None
+)
+_FAILURE = getattr(_connection, "_FAILURE", None) or getattr(
+    _connection, "FAILURE", None
+)
+_DIGEST_PREFIXED = hasattr(_connection, "_verify_challenge")
+
+
+async def _deliver_challenge(conn, authkey, loop):
+    """ Does what deliver_challenge does, on conn, a NativeConnection. """
+    if not isinstance(authkey, bytes):
+        raise ValueError(
+            "Authkey must be bytes, not {0!s}".format(type(authkey))
+        )
+    message = os.urandom(_connection.MESSAGE_LENGTH)
+    if _DIGEST_PREFIXED:
+        message = b"{sha256}" + message
+    await conn.coro_send_bytes(_CHALLENGE + message, loop=loop)
+    response = await conn.coro_recv_bytes(256, loop=loop)
+    try:
+        if _DIGEST_PREFIXED:
+            _connection._verify_challenge(authkey, message, response)
+        elif not hmac.compare_digest(
+            response, hmac.new(authkey, message, "md5").digest()
+        ):
+            raise _connection.AuthenticationError(
+                "digest received was wrong"
+            )
+    except _connection.AuthenticationError:
+        await conn.coro_send_bytes(_FAILURE, loop=loop)
+        raise
+    await conn.coro_send_bytes(_WELCOME, loop=loop)
+
+
+async def _answer_challenge(conn, authkey, loop):
+    """ Does what answer_challenge does, on conn, a NativeConnection. """
+    message = await conn.coro_recv_bytes(256, loop=loop)
+    if not message.startswith(_CHALLENGE):
+        raise _connection.AuthenticationError(
+            "Protocol error, expected challenge"
+        )
+    message = message[len(_CHALLENGE):]
+    if _DIGEST_PREFIXED:
+        digest = _connection._create_response(authkey, message)
+    else:
+        digest = hmac.new(authkey, message, "md5").digest()
+    await conn.coro_send_bytes(digest, loop=loop)
+    response = await conn.coro_recv_bytes(256, loop=loop)
+    if response != _WELCOME:
+        raise _connection.AuthenticationError("digest sent was rejected")
+
+
+def coro_deliver_challenge(connection, authkey, *args, loop=None, **kwargs):
+    """ Asynchronous version of connection.deliver_challenge.
+
+    If connection is a native AioConnection (or a NativeConnection),
+    the challenge is run on the event loop. Otherwise it's run in the
+    shared ThreadPoolExecutor.
+
+    """
+    if not loop:
+        loop = asyncio.get_event_loop()
+    native = _native_connection(connection, loop)
+    if native is not None and not args and not kwargs:
+        return asyncio.ensure_future(
+            _deliver_challenge(native, authkey, loop), loop=loop
+        )
     return run_in_executor(
-        executor, _connection.deliver_challenge, *args, **kwargs
+        shared_executor(),
+        _connection.deliver_challenge,
+        connection,
+        authkey,
+        *args,
+        loop=loop,
+        **kwargs
     )
 
 
-def coro_answer_challenge(*args, **kwargs):
-    executor = ThreadPoolExecutor(max_workers=1)
+def coro_answer_challenge(connection, authkey, *args, loop=None, **kwargs):
+    """ Asynchronous version of connection.answer_challenge.
+
+    If connection is a native AioConnection (or a NativeConnection),
+    the challenge is answered on the event loop. Otherwise it's run in
+    the shared ThreadPoolExecutor.
+
+    """
+    if not loop:
+        loop = asyncio.get_event_loop()
+    native = _native_connection(connection, loop)
+    if native is not None and not args and not kwargs:
+        return asyncio.ensure_future(
+            _answer_challenge(native, authkey, loop), loop=loop
+        )
     return run_in_executor(
-        executor, _connection.answer_challenge, *args, **kwargs
+        shared_executor(),
+        _connection.answer_challenge,
+        connection,
+        authkey,
+        *args,
+        loop=loop,
+        **kwargs
     )
 
 
-def coro_wait(*args, **kwargs):
-    executor = ThreadPoolExecutor(max_workers=1)
-    return run_in_executor(
-        executor, _connection.wait, *args, **kwargs
+def _native_connection(connection, loop):
+    """ Returns the NativeConnection to use for connection on loop, if any.
+    """
+    if isinstance(connection, AioConnection):
+        if not connection._natively(loop):
+            return None
+        connection = connection._obj
+    if isinstance(connection, transport.NativeConnection):
+        if supports_readers(loop):
+            return connection
+    return None
+
+
+def coro_wait(object_list, timeout=None, *, loop=None):
+    """ Asynchronous version of connection.wait.
+
+    Waits on the event loop for the objects to become readable, where
+    it can watch them, and in the shared ThreadPoolExecutor elsewhere.
+
+    """
+    if not loop:
+        loop = asyncio.get_event_loop()
+    if not supports_readers(loop):
+        return run_in_executor(
+            shared_executor(),
+            _connection.wait,
+            object_list,
+            timeout,
+            loop=loop,
+        )
+    return asyncio.ensure_future(
+        _wait(list(object_list), timeout, loop), loop=loop
+    )
+
+
+async def _wait(object_list, timeout, loop):
+    deadline = None if timeout is None else loop.time() + timeout
+    fds = [o if isinstance(o, int) else o.fileno() for o in object_list]
+    while True:
+        ready = _connection.wait(object_list, 0)
+        if ready:
+            return ready
+        remaining = None if deadline is None else deadline - loop.time()
+        if remaining is not None and remaining <= 0:
+            return []
+        fut = wait_readable(fds, loop=loop)
+        try:
+            await asyncio.wait_for(fut, remaining)
+        except asyncio.TimeoutError:
+            return []
+
+
+def coro_select(*sources, timeout=None, loop=None):
+    """ Wait until at least one of sources has something to receive.
+
+    sources can be AioConnection objects, the queues (except
+    AioShmQueue), or plain multiprocessing Connection objects. Returns
+    a Future whose result is the list of sources that are ready, in
+    the order they were passed: a get or recv on any of them won't
+    block. A connection whose other end was closed counts as ready,
+    since recv raises EOFError straight away. If timeout seconds pass
+    first, the result is an empty list.
+
+    Nothing is taken off any of the sources. The event loop watches
+    their file descriptors, so no thread is tied up, no matter how
+    many sources there are. On platforms where the event loop can't
+    watch pipes, the wait is run in the shared ThreadPoolExecutor, in
+    short slices, so cancelling it frees the thread.
+
+    """
+    if not loop:
+        loop = asyncio.get_event_loop()
+    hooks = [_select_hooks(source) for source in sources]
+    return asyncio.ensure_future(
+        _select(sources, hooks, timeout, loop), loop=loop
     )
+
+
+def _select_hooks(source):
+    """ Returns (readers, pending) for a coro_select source.
+
+    readers is a list of the connections to watch for the source, and
+    pending is a function that returns True if the source has items
+    buffered in the wrapper itself, so it's ready whatever its readers
+    say.
+
+    """
+    readers = getattr(source, "_select_readers", None)
+    if readers is not None:
+        return readers(), source._select_pending
+    if hasattr(source, "poll") and hasattr(source, "fileno"):
+        return [source], _nothing_pending
+    raise TypeError("Can't select on {!r}".format(source))
+
+
+def _nothing_pending():
+    return False
+
+
+async def _select(sources, hooks, timeout, loop):
+    deadline = None if timeout is None else loop.time() + timeout
+    readers = [reader for r, _ in hooks for reader in r]
+    watch = supports_readers(loop)
+    while True:
+        # Check every reader with a single system call, rather than
+        # polling each source in turn.
+        readable = _readable(readers)
+        ready = [
+            source
+            for source, (r, pending) in zip(sources, hooks)
+            if pending() or any(id(reader) in readable for reader in r)
+        ]
+        if ready:
+            return ready
+        remaining = None if deadline is None else deadline - loop.time()
+        if remaining is not None and remaining <= 0:
+            return []
+        if not watch:
+            wait = _WAIT_SLICE if remaining is None else remaining
+            await loop.run_in_executor(
+                shared_executor(),
+                _connection.wait,
+                readers,
+                min(wait, _WAIT_SLICE),
+            )
+            continue
+        fut = wait_readable([reader.fileno() for reader in readers], loop=loop)
+        try:
+            await asyncio.wait_for(fut, remaining)
+        except asyncio.TimeoutError:
+            return []
+
+
+def _readable(readers):
+    """ Returns the ids of the readers that have data waiting. """
+    if not hasattr(select, "poll"):
+        return set(map(id, _connection.wait(readers, 0)))
+    poller = select.poll()
+    by_fd = {}
+    for reader in readers:
+        fd = reader.fileno()
+        by_fd.setdefault(fd, []).append(reader)
+        poller.register(fd, select.POLLIN)
+    return {id(reader) for fd, _ in poller.poll(0) for reader in by_fd[fd]}
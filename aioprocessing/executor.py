@@ -1,3 +1,6 @@
+import asyncio
+import os
+import threading
 from functools import wraps
 from concurrent.futures import ThreadPoolExecutor
 
@@ -15,6 +18,33 @@ def init_executor(func):
     return wrapper
 
 
+# The executor returned by shared_executor, and the pid of the process
+# it belongs to.
+_shared_executor = None
+_shared_pid = None
+_shared_lock = threading.Lock()
+
+
+def shared_executor():
+    """ Returns a ThreadPoolExecutor for code that has no object to own one.
+
+    The module-level coroutine helpers run their blocking calls here,
+    rather than starting a new thread for every call. The executor is
+    created on first use, with a bounded number of workers, and created
+    again in a forked child, since the parent's worker threads don't
+    exist there.
+
+    """
+    global _shared_executor, _shared_pid
+    with _shared_lock:
+        if _shared_executor is None or _shared_pid != os.getpid():
+            _shared_executor = ThreadPoolExecutor(
+                max_workers=min(32, cpu_count() + 4)
+            )
+            _shared_pid = os.getpid()
+        return _shared_executor
+
+
 class _ExecutorMixin:
     """ A Mixin that provides asynchronous functionality.
 
@@ -40,6 +70,57 @@ class _ExecutorMixin:
             self._executor, callback, *args, loop=loop, **kwargs
         )
 
+    def run_interruptibly(self, func, *args, loop=None, **kwargs):
+        """ Runs the interruptible version of method func in the executor.
+
+        The class must define _interruptible_<func>, which takes a
+        threading.Event followed by func's arguments, and does what func
+        does, but blocks in short slices (see util.wait_slices), giving
+        up once the Event is set.
+
+        The Event is set when the returned Future is cancelled, so the
+        executor thread is freed shortly after. If the call produced a
+        result anyway (e.g. took an item off a queue), it's passed to
+        _hand_back, rather than being dropped.
+
+        """
+        callback = getattr(self, "_interruptible_{}".format(func))
+        cancelled = threading.Event()
+        lock = threading.Lock()
+        delivered = []
+
+        def call():
+            result = callback(cancelled, *args, **kwargs)
+            with lock:
+                if cancelled.is_set():
+                    self._hand_back(func, result)
+                    raise asyncio.CancelledError
+                delivered.append(result)
+            return result
+
+        def on_done(fut):
+            if not fut.cancelled():
+                return
+            with lock:
+                cancelled.set()
+                # The call finished, but its result never made it to
+                # the Future.
+                if delivered:
+                    self._hand_back(func, delivered.pop())
+
+        fut = self.run_in_executor(call, loop=loop)
+        fut.add_done_callback(on_done)
+        return fut
+
+    def _hand_back(self, func, result):
+        """ Called with the result of a cancelled interruptible call.
+
+        Classes whose interruptible calls consume something, like an
+        item taken off a queue, override this to keep the result for
+        the next caller.
+
+        """
+
     @init_executor
     def run_in_thread(self, callback, *args, **kwargs):
         """ Runs a method in an executor thread.
@@ -86,7 +167,7 @@ class CoroBuilder(type):
        add a new instance method to the class called "coro_<func_name>",
        which is a coroutine that calls func_name in a ThreadPoolExecutor.
 
-    Each wrapper class that uses this metaclass can define three class
+    Each wrapper class that uses this metaclass can define these class
     attributes that will influence the behavior of the metaclass:
     coroutines - A list of methods that should get coroutine versions
                  in the wrapper. For example:
@@ -99,26 +180,44 @@ class CoroBuilder(type):
                    used by the wrapper class. This defaults to cpu_count(),
                    but for classes that need to acquire locks, it should
                    always be set to 1.
+    wrapper_kwargs - Keyword arguments that are only meant for the
+                     wrapper's own __init__, and shouldn't be passed
+                     on to the delegate.
+    interruptible - Methods in coroutines whose coro_<func_name> should
+                    be run with run_interruptibly, so cancelling them
+                    frees the executor thread. The class must define
+                    _interruptible_<func_name> for each of them.
 
     """
 
     def __new__(cls, clsname, bases, dct, **kwargs):
         coro_list = dct.get("coroutines", [])
+        interruptible = set(dct.get("interruptible", []))
         existing_coros = set()
 
-        def find_existing_coros(d):
-            for attr in d:
-                if attr.startswith("coro_") or attr.startswith("thread_"):
-                    existing_coros.add(attr)
+        def find_existing_coros(d, inherited=False):
+            for attr, value in d.items():
+                if not attr.startswith(("coro_", "thread_")):
+                    continue
+                # A plain coroutine generated for a base class gets
+                # replaced if this class makes the method interruptible.
+                generated_for = getattr(value, "_generated_for", None)
+                if inherited and generated_for in interruptible:
+                    continue
+                existing_coros.add(attr)
 
         # Determine if any bases include the coroutines attribute, or
         # if either this class or a base class provides an actual
         # implementation for a coroutine method.
-        find_existing_coros(dct)
         for b in bases:
             b_dct = b.__dict__
             coro_list.extend(b_dct.get("coroutines", []))
-            find_existing_coros(b_dct)
+            interruptible.update(b_dct.get("interruptible", []))
+        find_existing_coros(dct)
+        for b in bases:
+            find_existing_coros(b.__dict__, inherited=True)
+
+        dct["interruptible"] = sorted(interruptible)
 
         # Add _ExecutorMixin to bases.
         if _ExecutorMixin not in bases:
@@ -128,7 +227,11 @@ class CoroBuilder(type):
         # is not already provided by dct or one of our bases.
         for func in coro_list:
             coro_name = "coro_{}".format(func)
-            if coro_name not in existing_coros:
+            if coro_name in existing_coros:
+                continue
+            if func in interruptible:
+                dct[coro_name] = cls.interruptible_coro_maker(func)
+            else:
                 dct[coro_name] = cls.coro_maker(func)
 
         return super().__new__(cls, clsname, bases, dct)
@@ -145,6 +248,7 @@ class CoroBuilder(type):
         pool_workers = dct.get("pool_workers")
         delegate = dct.get("delegate")
         old_init = dct.get("__init__")
+        wrapper_kwargs = dct.get("wrapper_kwargs")
         # Search bases for values we care about, if we didn't
         # find them on the current class.
         for b in bases:
@@ -155,6 +259,8 @@ class CoroBuilder(type):
                 delegate = b_dct.get("delegate")
             if not old_init:
                 old_init = b_dct.get("__init__")
+            if not wrapper_kwargs:
+                wrapper_kwargs = b_dct.get("wrapper_kwargs")
 
         cls.delegate = delegate
 
@@ -175,13 +281,18 @@ class CoroBuilder(type):
             # If we're wrapping a mp object, instantiate it here.
             # If a context was specified, we instaniate the mp class
             # using that context. Otherwise, we'll just use the default
-            # context.
+            # context. Delegates that aren't part of multiprocessing
+            # take the context as a keyword argument instead.
             if cls.delegate:
+                for name in wrapper_kwargs or ():
+                    kwargs.pop(name, None)
                 ctx = kwargs.pop("ctx", None)
+                clz = cls.delegate
                 if ctx:
-                    clz = getattr(ctx, cls.delegate.__name__)
-                else:
-                    clz = cls.delegate
+                    if hasattr(ctx, clz.__name__):
+                        clz = getattr(ctx, clz.__name__)
+                    else:
+                        kwargs["ctx"] = ctx
                 self._obj = clz(*args, **kwargs)
 
         cls.__init__ = init_func
@@ -193,4 +304,12 @@ class CoroBuilder(type):
                 getattr(self, func), *args, loop=loop, **kwargs
             )
 
+        coro_func._generated_for = func
+        return coro_func
+
+    @staticmethod
+    def interruptible_coro_maker(func):
+        def coro_func(self, *args, loop=None, **kwargs):
+            return self.run_interruptibly(func, *args, loop=loop, **kwargs)
+
         return coro_func
@@ -1,3 +1,4 @@
+from . import util
 from .executor import CoroBuilder
 from .mp import (
     Event,
@@ -133,10 +134,34 @@ class AioCondition(AioBaseLock, AioBaseWaiter):
     delegate = Condition
     pool_workers = 1
     coroutines = ["wait_for", "notify", "notify_all"]
+    interruptible = ["wait", "wait_for"]
+
+    def _interruptible_wait(self, cancelled, timeout=None):
+        # Waiting again after a slice times out is safe: a notify can
+        # only happen while we hold the lock, between slices.
+        for wait in util.wait_slices(timeout, cancelled):
+            if self._obj.wait(wait):
+                return True
+        return False
+
+    def _interruptible_wait_for(self, cancelled, predicate, timeout=None):
+        result = predicate()
+        for wait in util.wait_slices(timeout, cancelled):
+            if result:
+                break
+            result = self._obj.wait_for(predicate, wait)
+        return result
 
 
 class AioEvent(AioBaseWaiter):
     delegate = Event
+    interruptible = ["wait"]
+
+    def _interruptible_wait(self, cancelled, timeout=None):
+        for wait in util.wait_slices(timeout, cancelled):
+            if self._obj.wait(wait):
+                return True
+        return False
 
 
 class AioLock(AioBaseLock):
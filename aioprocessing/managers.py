@@ -1,6 +1,7 @@
 import asyncio
+import itertools
 from multiprocessing.util import register_after_fork
-from queue import Queue
+from queue import PriorityQueue, Queue
 from threading import (
     Barrier,
     BoundedSemaphore,
@@ -171,6 +172,28 @@ class AioConditionProxy(_managers.ConditionProxy, metaclass=ProxyCoroBuilder):
     coroutines = ["wait", "wait_for"]
 
 
+class _FifoPriorityQueue(PriorityQueue):
+    """ A PriorityQueue of (priority, data) items.
+
+    Items are stored as (priority, count, data), where count goes up
+    with each put, so data is never compared, and items of equal
+    priority come out in the order they were put.
+
+    """
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self._count = itertools.count()
+
+    def _put(self, item):
+        priority, data = item
+        super()._put((priority, next(self._count), data))
+
+    def _get(self):
+        priority, _, data = super()._get()
+        return priority, data
+
+
 class AioSyncManager(_managers.SyncManager):
     """ A mp.Manager that provides asyncio-friendly objects. """
 
@@ -178,6 +201,9 @@ class AioSyncManager(_managers.SyncManager):
 
 
 AioSyncManager.register("AioQueue", Queue, AioQueueProxy)
+AioSyncManager.register(
+    "AioPriorityQueue", _FifoPriorityQueue, AioQueueProxy
+)
 AioSyncManager.register("AioBarrier", Barrier, AioBarrierProxy)
 AioSyncManager.register(
     "AioBoundedSemaphore", BoundedSemaphore, AioAcquirerProxy
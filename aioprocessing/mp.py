@@ -4,7 +4,15 @@ try:
     if os.environ.get("AIOPROCESSING_DILL_DISABLED"):
         raise ImportError
     from multiprocess import *
-    from multiprocess import connection, managers, util
+    from multiprocess import connection, managers, pool, reduction, util
+    try:
+        from multiprocess import resource_tracker, shared_memory
+    except ImportError:
+        resource_tracker = shared_memory = None
 except ImportError:
     from multiprocessing import *
-    from multiprocessing import connection, managers, util
+    from multiprocessing import connection, managers, pool, reduction, util
+    try:
+        from multiprocessing import resource_tracker, shared_memory
+    except ImportError:
+        resource_tracker = shared_memory = None
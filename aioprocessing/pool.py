@@ -1,52 +1,534 @@
 from asyncio import Future
 import asyncio
+import itertools
+import os
+import signal
+import threading
+import time
+from collections import deque
 
 from .executor import CoroBuilder
-from .mp import Pool
+from .mp import get_context, pool as mp_pool
 
 __all__ = ["AioPool"]
 
+# Each call that can be cancelled has an entry on its pool's board,
+# which is _PENDING until the call is cancelled.
+_PENDING = 0
+_CANCELLED = 1
+
+# The number of entries on the board. Calls made while this many are
+# unfinished get no entry, and can't be cancelled.
+_BOARD_SIZE = 1024
+
+# The signal that interrupts cancelled work in the workers.
+_INTERRUPT_SIGNAL = getattr(signal, "SIGUSR1", None)
+
+# Whether workers can be made to exit once work with a timeout has
+# run for too long (see _run_cancellable).
+_HARD_DEADLINES = hasattr(signal, "setitimer")
+
+# How long after its timeout work is given to stop when interrupted,
+# before the worker running it is killed.
+_KILL_DELAY = 1.0
+
+# How long after that the Pool's jobs for the work are given up on.
+_ABANDON_DELAY = 0.5
+
+
+class _Pool(mp_pool.Pool):
+    """ A Pool whose work can be cancelled.
+
+    Functions wrapped by a _Call check its entry on a board in shared
+    memory before they run, so work that's cancelled before it starts
+    in a worker is skipped. Work that has started can be interrupted:
+    each worker is sent _INTERRUPT_SIGNAL, which raises _Interrupted in
+    those running cancelled work.
+
+    """
+
+    def __init__(
+        self,
+        processes=None,
+        initializer=None,
+        initargs=(),
+        maxtasksperchild=None,
+        ctx=None,
+    ):
+        if initializer is not None and not callable(initializer):
+            raise TypeError("initializer must be a callable")
+        if ctx is None:
+            ctx = get_context()
+        self._board = ctx.Array("b", _BOARD_SIZE, lock=False)
+        self._free_entries = list(reversed(range(_BOARD_SIZE)))
+        self._board_lock = threading.Lock()
+        super().__init__(
+            processes,
+            _init_worker,
+            (self._board, initializer, initargs),
+            maxtasksperchild,
+            context=ctx,
+        )
+
+    def start_call(self, timeout=None):
+        """ Returns a new _Call, with the given timeout. """
+        call = _Call(self, timeout)
+        with self._board_lock:
+            if self._free_entries:
+                call.entry = self._free_entries.pop()
+                self._board[call.entry] = _PENDING
+        return call
+
+    def _finish(self, call):
+        with self._board_lock:
+            if call.entry is not None:
+                self._free_entries.append(call.entry)
+                call.entry = None
+        call.jobs.clear()
+
+    def _cancel(self, call, interrupt):
+        with self._board_lock:
+            if call.entry is None:
+                return
+            self._board[call.entry] = _CANCELLED
+        if interrupt and _INTERRUPT_SIGNAL is not None:
+            for worker in list(self._pool):
+                try:
+                    os.kill(worker.pid, _INTERRUPT_SIGNAL)
+                except (OSError, TypeError):
+                    # The worker has exited, or not started yet.
+                    pass
+
+
+class _Call:
+    """ Work submitted to a _Pool, which can be cancelled until it's
+    finished.
+
+    The work is run by passing entry and deadline, and the function to
+    run, to _run_cancellable. The Pool's jobs for the work are kept in
+    jobs, so they can be given up on if its worker is killed.
+
+    """
+
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.entry = None
+        self.timeout = timeout
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = time.monotonic() + timeout + _KILL_DELAY
+        self.jobs = {}
+
+    def cancel(self, interrupt=False):
+        """ Skips the work that hasn't started. If interrupt is true,
+        work that's running is interrupted, where signals are supported.
+        """
+        self.pool._cancel(self, interrupt)
+
+    def finish(self):
+        """ Frees the call's entry, once none of its work is left. """
+        self.pool._finish(self)
+
+    def expire(self):
+        """ Cancels and interrupts the work once the timeout has passed.
+
+        Jobs still unfinished once the workers running them have been
+        killed are failed with TimeoutError, so the Pool doesn't wait
+        for them forever. That's arranged from a thread, since the event
+        loop may have stopped by then.
+
+        """
+        self.cancel(interrupt=True)
+        delay = self.deadline - time.monotonic() + _ABANDON_DELAY
+        timer = threading.Timer(delay, self._abandon)
+        timer.daemon = True
+        timer.start()
+
+    def _abandon(self):
+        # The failures are sent to the Pool's result handler thread,
+        # just like the workers' results, so it's the only thread that
+        # ever completes a job, and a result that comes in after all
+        # is either the one used, or dropped.
+        for job in list(self.jobs.values()):
+            if job.ready():
+                continue
+            try:
+                self.pool._outqueue.put(
+                    (job._job, 0, (False, asyncio.TimeoutError()))
+                )
+            except (OSError, ValueError):
+                # The Pool has been terminated.
+                return
+
+
+class _WorkerState:
+    """ The state of a worker: its pool's board, and the entry of the
+    call it's running work for.
+
+    It's pickled by reference. Otherwise dill, which is used instead of
+    pickle when multiprocess is installed, and which can pickle this
+    module's globals by value along with work functions that refer to
+    them, would replace it with the parent's copy in the worker.
+
+    """
+
+    def __init__(self):
+        self.board = None
+        self.entry = None
+
+    def __reduce__(self):
+        return "_worker"
+
+
+_worker = _WorkerState()
+
+
+class _Interrupted(BaseException):
+    """ Raised in a worker to interrupt cancelled work.
+
+    It isn't an Exception, so that the work is less likely to catch it.
+
+    """
+
+
+def _init_worker(board, initializer, initargs):
+    _worker.board = board
+    if _INTERRUPT_SIGNAL is not None:
+        signal.signal(_INTERRUPT_SIGNAL, _on_interrupt)
+    if _HARD_DEADLINES:
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _on_interrupt(signum, frame):
+    # Every worker is signalled, so only cancelled work is interrupted.
+    entry = _worker.entry
+    if entry is not None and _worker.board[entry] == _CANCELLED:
+        raise _Interrupted
+
+
+def _run_cancellable(entry, deadline, func, *args, **kwargs):
+    """ Runs func in a worker, unless its call has been cancelled.
+
+    Returns None instead of func's result if it was skipped or
+    interrupted, since nothing is waiting for the result then.
+
+    If deadline (a time.monotonic() time) is given, and func is still
+    running then, the worker is killed by SIGALRM, which works even if
+    func is stuck in C code. The Pool starts a new worker to replace it.
+
+    """
+    if entry is None and deadline is None:
+        return func(*args, **kwargs)
+    if entry is not None and _worker.board[entry] == _CANCELLED:
+        return None
+    if deadline is not None and _HARD_DEADLINES:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        signal.setitimer(signal.ITIMER_REAL, remaining)
+    try:
+        _worker.entry = entry
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _worker.entry = None
+            if deadline is not None and _HARD_DEADLINES:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+    except _Interrupted:
+        return None
+
 
 class AioPool(metaclass=CoroBuilder):
-    delegate = Pool
+    """ An asyncio-friendly version of mp.Pool.
+
+    Cancelling the Future returned by coro_apply, coro_map or
+    coro_starmap cancels the work it started: items that haven't
+    started running in a worker are skipped. Work that has already
+    started runs to the end, unless the call was made with
+    interrupt=True, in which case it's interrupted.
+
+    Interrupting raises an exception (not derived from Exception) in
+    the work, from a SIGUSR1 handler, so it isn't supported on Windows,
+    and only happens once code running in C returns to Python. Workers
+    running work past its timeout are killed with SIGALRM. The pool's
+    initializer and its work shouldn't handle or use those signals.
+
+    """
+
+    delegate = _Pool
     coroutines = ["join"]
 
-    def _coro_func(self, funcname, *args, loop=None, **kwargs):
+    def _coro_func(
+        self,
+        funcname,
+        call,
+        *args,
+        interrupt=False,
+        convert=None,
+        loop=None,
+        **kwargs
+    ):
         """ Call the given function, and wrap the reuslt in a Future.
 
         funcname should be the name of a function which takes `callback`
-        and `error_callback` keyword arguments (e.g. apply_async).
+        and `error_callback` keyword arguments (e.g. apply_async), and
+        call the _Call that the work it starts belongs to, which is
+        cancelled along with the Future. If given, convert is applied
+        to the result. If the call has a timeout, the Future fails with
+        TimeoutError once it passes.
 
         """
         if not loop:
             loop = asyncio.get_event_loop()
         fut = Future(loop=loop)
+        timer = None
 
         def set_result(result):
-            loop.call_soon_threadsafe(fut.set_result, result)
+            call.finish()
+            if convert is not None and not fut.cancelled():
+                result = convert(result)
+            _call_soon(loop, _resolve, fut, True, result)
 
         def set_exc(exc):
-            loop.call_soon_threadsafe(fut.set_exception, exc)
+            call.finish()
+            _call_soon(loop, _resolve, fut, False, exc)
 
-        func = getattr(self._obj, funcname)
-        func(*args, callback=set_result, error_callback=set_exc, **kwargs)
+        def cancel(fut):
+            if timer is not None:
+                timer.cancel()
+            if fut.cancelled():
+                call.cancel(interrupt)
+
+        def expire():
+            if not fut.done():
+                fut.set_exception(asyncio.TimeoutError())
+                call.expire()
+
+        call.jobs[0] = getattr(self._obj, funcname)(
+            *args, callback=set_result, error_callback=set_exc, **kwargs
+        )
+        if call.timeout is not None:
+            timer = loop.call_later(call.timeout, expire)
+        fut.add_done_callback(cancel)
         return fut
 
-    def coro_apply(self, func, args=(), kwds=None, *, loop=None):
+    def coro_apply(
+        self,
+        func,
+        args=(),
+        kwds=None,
+        *,
+        interrupt=False,
+        timeout=None,
+        loop=None
+    ):
+        """ Returns a Future of the result of func(*args, **kwds).
+
+        If timeout (in seconds) is given, and the result isn't in by
+        then, the Future fails with asyncio.TimeoutError, and the work
+        is cancelled and interrupted. If it's still running a second
+        later (stuck in C code, say), the worker running it is killed,
+        and the Pool starts a new one to replace it.
+
+        """
         if kwds is None:
             kwds = {}
+        call = self._obj.start_call(timeout)
         return self._coro_func(
-            "apply_async", func, args=args, kwds=kwds, loop=loop
+            "apply_async",
+            call,
+            _run_cancellable,
+            args=(call.entry, call.deadline, func) + tuple(args),
+            kwds=kwds,
+            interrupt=interrupt,
+            loop=loop,
         )
 
-    def coro_map(self, func, iterable, chunksize=None, *, loop=None):
-        return self._coro_func(
-            "map_async", func, iterable, chunksize=chunksize, loop=loop
+    def coro_map(
+        self,
+        func,
+        iterable,
+        chunksize=None,
+        *,
+        target_duration=None,
+        interrupt=False,
+        timeout=None,
+        loop=None
+    ):
+        """ Returns a Future of the list of func applied to iterable.
+
+        If target_duration (in seconds) is given, chunk sizes adapt as
+        the work runs, rather than being fixed (see coro_imap), and
+        chunksize is the size of the first chunks. timeout works as it
+        does for coro_apply, for the whole map. With either of them,
+        chunks that haven't been sent to the workers yet aren't sent at
+        all once the Future is cancelled, or times out.
+
+        """
+        return self._map(
+            func,
+            iterable,
+            chunksize,
+            False,
+            target_duration,
+            interrupt,
+            timeout,
+            loop,
+        )
+
+    def coro_starmap(
+        self,
+        func,
+        iterable,
+        chunksize=None,
+        *,
+        target_duration=None,
+        interrupt=False,
+        timeout=None,
+        loop=None
+    ):
+        """ Like coro_map, but unpacks each item of iterable into args. """
+        return self._map(
+            func,
+            iterable,
+            chunksize,
+            True,
+            target_duration,
+            interrupt,
+            timeout,
+            loop,
         )
 
-    def coro_starmap(self, func, iterable, chunksize=None, *, loop=None):
+    def _map(
+        self,
+        func,
+        iterable,
+        chunksize,
+        star,
+        target_duration,
+        interrupt,
+        timeout,
+        loop,
+    ):
+        if not loop:
+            loop = asyncio.get_event_loop()
+        if chunksize is None and target_duration is None:
+            # The same default as map_async.
+            if not hasattr(iterable, "__len__"):
+                iterable = list(iterable)
+            chunksize, extra = divmod(
+                len(iterable), 4 * self._obj._processes
+            )
+            if extra:
+                chunksize += 1
+        chunksize = max(chunksize or 1, 1)
+        if target_duration is not None or timeout is not None:
+            # Each chunk is its own job, so a chunk whose worker was
+            # killed can be given up on without the rest.
+            results = _ImapIterator(
+                self,
+                func,
+                iterable,
+                chunksize,
+                None,
+                True,
+                loop,
+                target_duration=target_duration,
+                interrupt=interrupt,
+                timeout=timeout,
+                star=star,
+            )
+            return asyncio.ensure_future(_collect(results), loop=loop)
+        # The items are split into chunks here, rather than by map_async,
+        # so the workers check for cancellation once per chunk, rather
+        # than once per item.
+        call = self._obj.start_call()
         return self._coro_func(
-            "starmap_async", func, iterable, chunksize=chunksize, loop=loop
+            "map_async",
+            call,
+            _run_map_chunk,
+            [
+                (call.entry, func, chunk, star)
+                for chunk in _chunks(iterable, chunksize)
+            ],
+            chunksize=1,
+            interrupt=interrupt,
+            convert=_join_chunks,
+            loop=loop,
+        )
+
+    def coro_imap(
+        self,
+        func,
+        iterable,
+        chunksize=1,
+        *,
+        max_in_flight=None,
+        target_duration=None,
+        interrupt=False,
+        loop=None
+    ):
+        """ Returns an asynchronous iterator over func applied to iterable.
+
+        Like Pool.imap, iterable is sent to the workers in chunks of
+        chunksize items, and the results come back in order, each one
+        as soon as it (and the ones before it) are ready, rather than
+        all at once at the end, like coro_map. Items are only taken from
+        iterable as there's room for them: at most max_in_flight chunks
+        (twice the number of worker processes, if None) are sent and
+        not yet consumed at once, so iterable can be long, or endless.
+
+        If target_duration (in seconds) is given, chunksize is just the
+        size of the first chunks. The time each chunk takes to run, and
+        the time it takes to get to a worker and back, are measured, and
+        later chunks are sized so each one runs for about
+        target_duration, or for ten times the round trip, if that's
+        longer. Chunks at most double in size from one to the next, but
+        shrink straight away.
+
+        An error raised by func is raised by the iteration, which then
+        ends. Calling the iterator's aclose() coroutine stops it from
+        sending any more chunks, and cancels those sent that haven't
+        finished, as cancelling coro_map does.
+
+        """
+        return _ImapIterator(
+            self,
+            func,
+            iterable,
+            chunksize,
+            max_in_flight,
+            True,
+            loop,
+            target_duration=target_duration,
+            interrupt=interrupt,
+        )
+
+    def coro_imap_unordered(
+        self,
+        func,
+        iterable,
+        chunksize=1,
+        *,
+        max_in_flight=None,
+        target_duration=None,
+        interrupt=False,
+        loop=None
+    ):
+        """ Like coro_imap, but results come back in the order they finish.
+        """
+        return _ImapIterator(
+            self,
+            func,
+            iterable,
+            chunksize,
+            max_in_flight,
+            False,
+            loop,
+            target_duration=target_duration,
+            interrupt=interrupt,
         )
 
     def __enter__(self):
@@ -55,3 +537,306 @@ class AioPool(metaclass=CoroBuilder):
 
     def __exit__(self, *args, **kwargs):
         self._obj.__exit__(*args, **kwargs)
+
+
+def _call_soon(loop, callback, *args):
+    """ Schedules callback on loop, from one of the Pool's threads. """
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        # The loop was closed; raising here would kill the Pool's
+        # result handler thread.
+        pass
+
+
+def _resolve(fut, succeeded, value):
+    if fut.done():
+        # It was cancelled.
+        return
+    if succeeded:
+        fut.set_result(value)
+    else:
+        fut.set_exception(value)
+
+
+def _chunks(iterable, chunksize):
+    items = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(items, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _join_chunks(chunks):
+    """ Returns the results of the chunks _run_map_chunk ran, in one list.
+    """
+    return list(itertools.chain.from_iterable(chunks))
+
+
+def _run_map_chunk(task):
+    entry, func, chunk, star = task
+    return _run_cancellable(entry, None, _run_items, func, chunk, star)
+
+
+def _run_items(func, chunk, star):
+    if star:
+        return [func(*item) for item in chunk]
+    return [func(item) for item in chunk]
+
+
+def _run_chunk(func, chunk, star=False):
+    """ Runs func on each item of chunk, in a worker process.
+
+    Returns how long that took, along with the results.
+
+    """
+    start = time.perf_counter()
+    results = _run_items(func, chunk, star)
+    return time.perf_counter() - start, results
+
+
+async def _collect(results):
+    """ Returns a list of everything an _ImapIterator yields. """
+    out = []
+    while True:
+        try:
+            out.append(await results.__anext__())
+        except StopAsyncIteration:
+            return out
+        except asyncio.CancelledError:
+            results.close()
+            raise
+        # Take the rest of the chunk at once.
+        out.extend(results._results)
+        results._results.clear()
+
+
+class _ChunkSizer:
+    """ Picks chunk sizes so that each chunk runs for about
+    target_duration.
+    """
+
+    # How much each new measurement counts towards the average cost
+    # of an item.
+    SMOOTHING = 0.3
+    # Chunks should take at least this many times the round trip to a
+    # worker and back.
+    OVERHEAD_RATIO = 10
+
+    def __init__(self, chunksize, target_duration):
+        if target_duration <= 0:
+            raise ValueError("target_duration must be positive")
+        self.chunksize = chunksize
+        self.target_duration = target_duration
+        self.item_cost = None
+        # The least time, beyond running it, any chunk has spent being
+        # sent to a worker and having its results sent back. Chunks
+        # that waited for a free worker took longer, so the least is
+        # the best estimate.
+        self.overhead = None
+
+    def update(self, size, elapsed, round_trip):
+        cost = elapsed / size
+        if self.item_cost is None:
+            self.item_cost = cost
+        else:
+            self.item_cost += self.SMOOTHING * (cost - self.item_cost)
+        overhead = max(round_trip - elapsed, 0)
+        if self.overhead is None or overhead < self.overhead:
+            self.overhead = overhead
+        target = max(
+            self.target_duration, self.OVERHEAD_RATIO * self.overhead
+        )
+        # Grow to at most twice the size measured, so one fast chunk
+        # can't send the size soaring, but shrink straight away.
+        limit = max(self.chunksize, 2 * size)
+        if self.item_cost > 0:
+            limit = min(limit, int(target / self.item_cost))
+        self.chunksize = max(1, limit)
+
+
+class _ImapIterator:
+    """ The asynchronous iterator returned by coro_imap and
+    coro_imap_unordered.
+    """
+
+    def __init__(
+        self,
+        pool,
+        func,
+        iterable,
+        chunksize,
+        max_in_flight,
+        ordered,
+        loop,
+        target_duration=None,
+        interrupt=False,
+        timeout=None,
+        star=False,
+    ):
+        if chunksize < 1:
+            raise ValueError("chunksize must be at least 1")
+        self._sizer = None
+        if target_duration is not None:
+            self._sizer = _ChunkSizer(chunksize, target_duration)
+        if max_in_flight is None:
+            max_in_flight = 2 * pool._obj._processes
+        elif max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        self._pool = pool
+        self._func = func
+        self._items = iter(iterable)
+        self._chunksize = chunksize
+        self._max_in_flight = max_in_flight
+        self._ordered = ordered
+        self._loop = loop
+        self._interrupt = interrupt
+        self._star = star
+        self._call = pool._obj.start_call(timeout)
+        self._timer = None
+        if timeout is not None:
+            self._timer = loop.call_later(timeout, self._expire)
+        self._error = None
+        # The number of chunks sent that haven't finished.
+        self._running = 0
+        # Chunks are numbered as they're sent. _finished holds the
+        # outcomes of those that have finished, but not been consumed,
+        # as (succeeded, results or error) pairs, by number.
+        self._sent = 0
+        self._consumed = 0
+        self._finished = {}
+        self._results = deque()
+        self._exhausted = False
+        self._closed = False
+        self._wakeup = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            if self._results:
+                return self._results.popleft()
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            if self._closed:
+                raise StopAsyncIteration
+            outcome = self._next_finished()
+            if outcome is not None:
+                self._consumed += 1
+                self._fill()
+                succeeded, value = outcome
+                if not succeeded:
+                    self.close()
+                    raise value
+                self._results.extend(value)
+                continue
+            self._fill()
+            if self._sent == self._consumed:
+                self.close()
+                raise StopAsyncIteration
+            loop = self._loop if self._loop else asyncio.get_event_loop()
+            self._wakeup = loop.create_future()
+            await self._wakeup
+
+    async def aclose(self):
+        """ Stop sending chunks to the workers, and cancel those sent. """
+        self.close()
+
+    def close(self):
+        self._closed = True
+        self._results.clear()
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._running:
+            self._call.cancel(self._interrupt)
+        else:
+            self._call.finish()
+
+    def _expire(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._results.clear()
+        self._error = asyncio.TimeoutError()
+        if self._running:
+            self._call.expire()
+        else:
+            self._call.finish()
+        self._wake()
+
+    def _next_finished(self):
+        """ Returns the next outcome to hand to the consumer, if any. """
+        if not self._finished:
+            return None
+        if self._ordered:
+            return self._finished.pop(self._consumed, None)
+        return self._finished.pop(next(iter(self._finished)))
+
+    def _fill(self):
+        """ Sends chunks until max_in_flight haven't been consumed. """
+        while (
+            not self._exhausted
+            and self._sent - self._consumed < self._max_in_flight
+        ):
+            if self._sizer is not None:
+                self._chunksize = self._sizer.chunksize
+            chunk = list(itertools.islice(self._items, self._chunksize))
+            if not chunk:
+                self._exhausted = True
+                return
+            self._send(chunk)
+
+    def _send(self, chunk):
+        loop = self._loop if self._loop else asyncio.get_event_loop()
+        number = self._sent
+        size = len(chunk)
+        start = time.perf_counter()
+
+        def on_result(result):
+            if result is None:
+                # It was cancelled.
+                _call_soon(loop, self._on_finished, number, False, None)
+                return
+            elapsed, results = result
+            if self._sizer is not None:
+                round_trip = time.perf_counter() - start
+                _call_soon(
+                    loop, self._sizer.update, size, elapsed, round_trip
+                )
+            _call_soon(loop, self._on_finished, number, True, results)
+
+        def on_error(error):
+            _call_soon(loop, self._on_finished, number, False, error)
+
+        self._call.jobs[number] = self._pool._obj.apply_async(
+            _run_cancellable,
+            (
+                self._call.entry,
+                self._call.deadline,
+                _run_chunk,
+                self._func,
+                chunk,
+                self._star,
+            ),
+            callback=on_result,
+            error_callback=on_error,
+        )
+        self._sent += 1
+        self._running += 1
+
+    def _on_finished(self, number, succeeded, value):
+        self._running -= 1
+        self._call.jobs.pop(number, None)
+        if self._closed:
+            if not self._running:
+                self._call.finish()
+            return
+        self._finished[number] = (succeeded, value)
+        self._wake()
+
+    def _wake(self):
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
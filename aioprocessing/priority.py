@@ -0,0 +1,129 @@
+import time
+from queue import Empty
+
+from .mp import connection, get_context, reduction
+from .shm import _deadline, _left
+
+__all__ = ["PriorityQueue"]
+
+# How long to back off when a level has data, but another
+# process is holding its read lock.
+_CONTENDED_DELAY = 0.001
+
+
+class PriorityQueue:
+    """ A priority queue that can be shared between processes.
+
+    Items are (priority, data) tuples, just like with queue.PriorityQueue,
+    but priority has to be an int from 0 to levels - 1. Lower priorities
+    are taken off the queue first, and items of the same priority come
+    off in the order they were put in.
+
+    Each priority level is its own mp.Queue, and maxsize bounds each
+    level separately. get takes the first item waiting in the highest
+    priority level that has one.
+
+    """
+
+    def __init__(self, levels=3, maxsize=0, *, ctx=None):
+        if levels < 1:
+            raise ValueError("levels must be at least 1")
+        ctx = ctx if ctx else get_context()
+        self._levels = [ctx.Queue(maxsize) for _ in range(levels)]
+
+    def put(self, item, block=True, timeout=None):
+        priority, data = item
+        self._level(priority).put(data, block, timeout)
+
+    def get(self, block=True, timeout=None):
+        deadline = _deadline(block, timeout)
+        while True:
+            items = self._drain(1)
+            if items:
+                return items[0]
+            if not block:
+                raise Empty
+            left = _left(deadline)
+            if left == 0:
+                raise Empty
+            if self._poll():
+                # Data is there, but another consumer is busy reading.
+                time.sleep(_CONTENDED_DELAY)
+            else:
+                connection.wait(self._readers(), left)
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return sum(q.qsize() for q in self._levels)
+
+    def empty(self):
+        return all(q.empty() for q in self._levels)
+
+    def close(self):
+        for q in self._levels:
+            q.close()
+
+    def join_thread(self):
+        for q in self._levels:
+            q.join_thread()
+
+    def cancel_join_thread(self):
+        for q in self._levels:
+            q.cancel_join_thread()
+
+    def _level(self, priority):
+        if not isinstance(priority, int) or not (
+            0 <= priority < len(self._levels)
+        ):
+            raise ValueError(
+                "priority must be an int from 0 to {}, not {!r}".format(
+                    len(self._levels) - 1, priority
+                )
+            )
+        return self._levels[priority]
+
+    def _readers(self):
+        return [q._reader for q in self._levels]
+
+    def _poll(self, timeout=0.0):
+        if any(q._poll() for q in self._levels):
+            return True
+        if timeout is not None and timeout <= 0:
+            return False
+        return bool(connection.wait(self._readers(), timeout))
+
+    def _drain(self, n):
+        """ Read up to n (priority, data) items already waiting.
+
+        Levels are read in priority order. If a level has data, but
+        another consumer holds its read lock, the levels after it are
+        left alone, so lower priority items don't jump the queue.
+
+        """
+        items = []
+        for priority, q in enumerate(self._levels):
+            if len(items) >= n:
+                break
+            if q._closed:
+                raise ValueError("Queue {!r} is closed".format(self))
+            if not q._poll():
+                continue
+            if not q._rlock.acquire(False):
+                break
+            try:
+                frames = []
+                while len(items) + len(frames) < n and q._poll():
+                    frames.append(q._recv_bytes())
+                    q._sem.release()
+            finally:
+                q._rlock.release()
+            # unserialize the data after having released the lock
+            items.extend(
+                (priority, reduction.ForkingPickler.loads(f)) for f in frames
+            )
+        return items
@@ -1,3 +1,4 @@
+from . import util
 from .executor import CoroBuilder
 from .mp import Process
 
@@ -7,3 +8,10 @@ __all__ = ["AioProcess"]
 class AioProcess(metaclass=CoroBuilder):
     delegate = Process
     coroutines = ["join"]
+    interruptible = ["join"]
+
+    def _interruptible_join(self, cancelled, timeout=None):
+        for wait in util.wait_slices(timeout, cancelled):
+            self._obj.join(wait)
+            if self._obj.exitcode is not None:
+                return
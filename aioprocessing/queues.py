@@ -1,41 +1,990 @@
-from .executor import CoroBuilder
-from .mp import Queue, SimpleQueue, JoinableQueue
+import asyncio
+import functools
+import os
+import struct
+import sys
+import time
+from collections import deque
+from queue import Empty, Full
+
+from . import serialization, util
+from .executor import CoroBuilder, shared_executor
+from .mp import Queue, SimpleQueue, JoinableQueue, get_context, reduction
+from .priority import PriorityQueue
+from .shm import ShmQueue
+from .stats import QueueStats
+
+# How long to back off when the pipe is readable, but another
+# process is holding the read lock.
+_CONTENDED_DELAY = 0.001
+# How often blocked producers check whether there's room in the queue
+# again. The delay doubles from the minimum up to the maximum while
+# the queue stays full.
+_MIN_ROOM_DELAY = 0.001
+_MAX_ROOM_DELAY = 0.01
+# How often coro_join rechecks the unfinished task count, in case a
+# task was marked done without ringing the doorbell.
+_JOIN_RECHECK = 0.1
+# Frames at least this big are copied out of the pipe in an executor
+# thread, rather than on the event loop.
+_LARGE_FRAME = 1 << 20
+# Each frame on a queue's pipe starts with its length, as a 4 byte int.
+_HEADER_SIZE = 4
 
 
 class AioBaseQueue(metaclass=CoroBuilder):
-    coroutines = ["get", "put"]
+    coroutines = ["get", "put", "put_many", "put_oob"]
+    wrapper_kwargs = ["serializer", "stats"]
+
+    def __init__(self, *args, serializer=None, stats=False, **kwargs):
+        self._init_options(serializer, stats)
+
+    def _init_options(self, serializer, stats):
+        self._serializer = serialization.get_serializer(serializer)
+        self._stats = QueueStats() if stats else None
+        # How many large items are being read in the executor. Those a
+        # cancelled get was reading go to the orphans once they're in.
+        self._receiving = 0
+        # Items taken off the queue by cancelled gets, which are handed
+        # to the next get instead.
+        self._orphans = deque()
+        # So put_oob's blocks aren't removed when a producer exits.
+        serialization.share_resource_tracker()
+
+    def put(self, obj, *args, **kwargs):
+        start = self._now()
+        self._obj.put(self._encode(obj), *args, **kwargs)
+        self._record("put", start)
+
+    def get(self, *args, **kwargs):
+        start = self._now()
+        if self._orphans:
+            item = self._orphans.popleft()
+        else:
+            item = self._decode(self._obj.get(*args, **kwargs))
+        self._record("get", start)
+        return item
+
+    def put_nowait(self, obj):
+        start = self._now()
+        self._obj.put_nowait(self._encode(obj))
+        self._record("put", start)
+
+    def get_nowait(self):
+        start = self._now()
+        if self._orphans:
+            item = self._orphans.popleft()
+        else:
+            item = self._decode(self._obj.get_nowait())
+        self._record("get", start)
+        return item
+
+    def stats(self):
+        """ Returns a snapshot of the queue's stats, as a dict.
+
+        Only available if the queue was created with stats=True.
+        See QueueStats for what's recorded.
+
+        """
+        if self._stats is None:
+            raise ValueError("Queue was created without stats=True")
+        return self._stats.snapshot()
+
+    def run_in_executor(self, callback, *args, loop=None, **kwargs):
+        if self._stats is not None:
+            callback = self._stats.timed(callback)
+        return super().run_in_executor(callback, *args, loop=loop, **kwargs)
+
+    def coro_get(self, block=True, timeout=None, *, loop=None):
+        """ Asynchronous version of get.
+
+        Rather than parking an executor thread in a blocking get,
+        this waits for the queue's reader pipe to become readable using
+        the event loop, and only then pulls an item off the queue, so
+        cancelling it never loses an item. Items that are still being
+        written, or are 1 MiB or more when pickled, are read (and
+        unpickled) in an executor thread, so the loop is never held up
+        waiting on the pipe; if cancelled meanwhile, the item is handed
+        to the next get. On platforms
+        where the event loop can't watch the pipe, the get is run in
+        the ThreadPoolExecutor instead, in short slices so that
+        cancelling it frees the thread. An item it took off the queue
+        anyway is handed to the next get.
+
+        """
+        if not loop:
+            loop = asyncio.get_event_loop()
+        if not util.supports_readers(loop):
+            return self.run_interruptibly(
+                "get", block, timeout, loop=loop
+            )
+        return asyncio.ensure_future(
+            self._get_when_ready(block, timeout, loop), loop=loop
+        )
+
+    async def _get_when_ready(self, block, timeout, loop):
+        start = self._now()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            items = await self._drain_when_ready(1, loop)
+            if items:
+                self._record("get", start)
+                return items[0]
+            if not block:
+                raise Empty
+            if self._obj._poll() or self._receiving:
+                # Data is there, but another consumer is busy reading,
+                # or an item is on its way to the orphans.
+                await asyncio.sleep(_CONTENDED_DELAY)
+                continue
+            fut = util.wait_readable(self._reader_fds(), loop=loop)
+            if deadline is None:
+                await fut
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                fut.cancel()
+                raise Empty
+            try:
+                await asyncio.wait_for(fut, remaining)
+            except asyncio.TimeoutError:
+                raise Empty
+
+    def get_many(self, n, block=True, timeout=None):
+        """ Remove and return a list of up to n items from the queue.
+
+        Blocks for the first item exactly like get, then takes
+        whatever else is already waiting in the pipe, without blocking
+        again, under a single acquisition of the read lock. Raises
+        ValueError if n is less than 1.
+
+        """
+        self._check_count(n)
+        if block and timeout is None:
+            items = [self.get()]
+        else:
+            items = [self.get(block, timeout)]
+        rest = self._drain(n - 1)
+        self._record("get", items=len(rest))
+        items.extend(rest)
+        return items
+
+    def coro_get_many(self, n, block=True, timeout=None, *, loop=None):
+        """ Asynchronous version of get_many.
+
+        Waits for the first item the same way coro_get does.
+
+        """
+        self._check_count(n)
+        if not loop:
+            loop = asyncio.get_event_loop()
+        if not util.supports_readers(loop):
+            return self.run_interruptibly(
+                "get_many", n, block, timeout, loop=loop
+            )
+        return asyncio.ensure_future(
+            self._get_many_when_ready(n, block, timeout, loop), loop=loop
+        )
+
+    async def _get_many_when_ready(self, n, block, timeout, loop):
+        items = [await self._get_when_ready(block, timeout, loop)]
+        try:
+            rest = await self._drain_when_ready(n - 1, loop)
+        except asyncio.CancelledError:
+            self._orphans.appendleft(items[0])
+            raise
+        self._record("get", items=len(rest))
+        items.extend(rest)
+        return items
+
+    def put_many(self, items, block=True, timeout=None):
+        """ Put every item in items into the queue. """
+        start = self._now()
+        count = 0
+        try:
+            for item in items:
+                self._obj.put(self._encode(item), block, timeout)
+                count += 1
+        finally:
+            self._record("put", start, count)
+
+    def put_oob(
+        self,
+        obj,
+        block=True,
+        timeout=None,
+        *,
+        threshold=serialization.OOB_THRESHOLD
+    ):
+        """ Put obj into the queue, passing large buffers out-of-band.
+
+        Every buffer in obj of at least threshold bytes (e.g. the data
+        of a NumPy array, a memoryview or a pickle.PickleBuffer) is
+        copied once into its own shared memory block, instead of being
+        pickled and pushed through the queue's pipe. Consumers don't
+        need to do anything special: get() rebuilds obj on top of the
+        shared memory, without copying the buffers again. The blocks
+        of items that are never taken off the queue are removed by the
+        resource tracker, once the processes sharing it have all
+        exited.
+
+        Falls back to a regular put on platforms without pickle
+        protocol 5 or shared memory that outlives its creator. Can't
+        be used on a queue with a custom serializer.
+
+        """
+        self._check_oob()
+        if serialization.shm_supported:
+            item = serialization.SharedBuffers(obj, threshold)
+        else:
+            item = obj
+        try:
+            if block and timeout is None:
+                self.put(item)
+            else:
+                self.put(item, block, timeout)
+        except BaseException:
+            if item is not obj:
+                item.discard()
+            raise
+
+    def iterate(self, prefetch=0, *, sentinel=util._NO_SENTINEL, loop=None):
+        """ Returns an asynchronous iterator over items taken off the queue.
+
+        Each item is taken with coro_get. If prefetch is more than 0,
+        up to that many items are taken off the queue ahead of the
+        consumer. Items that were prefetched when the iteration is
+        abandoned are returned by the iterator's aclose() coroutine.
+
+        Iteration ends once sentinel is taken off the queue, if given.
+
+        """
+        return util.PrefetchIterator(
+            functools.partial(self.coro_get, loop=loop),
+            prefetch,
+            sentinel=sentinel,
+            loop=loop,
+        )
+
+    def __aiter__(self):
+        return self.iterate()
+
+    def _interruptible_get(self, cancelled, block=True, timeout=None):
+        start = self._now()
+        if block:
+            for wait in util.wait_slices(timeout, cancelled):
+                if not self._orphans and not self._obj._poll(wait):
+                    continue
+                try:
+                    item = self._get_nowait()
+                    break
+                except Empty:
+                    # Another consumer beat us to it.
+                    time.sleep(_CONTENDED_DELAY)
+            else:
+                raise Empty
+        else:
+            item = self._get_nowait()
+        self._record("get", start)
+        return item
+
+    def _interruptible_get_many(self, cancelled, n, block=True, timeout=None):
+        items = [self._interruptible_get(cancelled, block, timeout)]
+        rest = self._drain(n - 1)
+        self._record("get", items=len(rest))
+        items.extend(rest)
+        return items
+
+    def _hand_back(self, func, result):
+        if func == "get":
+            self._orphans.append(result)
+        elif func == "get_many":
+            self._orphans.extend(result)
+
+    def _reader_fds(self):
+        return [reader.fileno() for reader in self._select_readers()]
+
+    def _select_readers(self):
+        """ Returns the connections coro_select watches for this queue. """
+        return [self._obj._reader]
+
+    def _select_pending(self):
+        """ Returns True if get has an item to return without reading. """
+        return bool(self._orphans)
+
+    def _encode(self, obj):
+        """ Returns what actually goes on the queue for obj. """
+        if self._serializer is None:
+            return obj
+        return self._dumps(obj)
+
+    def _now(self):
+        """ Returns the time an operation started, if keeping stats. """
+        if self._stats is None:
+            return None
+        return time.perf_counter()
+
+    def _record(self, op, start=None, items=1):
+        if self._stats is not None and (start is not None or items):
+            self._stats.record(op, start, items)
+
+    def _decode(self, item):
+        """ Returns the object for an item taken off the queue. """
+        if self._serializer is None:
+            return item
+        return self._loads(item)
+
+    def _dumps(self, obj):
+        data = self._serializer.dumps(obj)
+        if self._stats is not None:
+            self._stats.add_bytes("put", "serialized_bytes", len(data))
+        return data
+
+    def _loads(self, data):
+        if self._stats is not None:
+            self._stats.add_bytes("get", "serialized_bytes", len(data))
+        return self._serializer.loads(data)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_orphans"] = deque()
+        state["_receiving"] = 0
+        return state
+
+    def _check_count(self, n):
+        if n < 1:
+            raise ValueError("n must be at least 1, not {!r}".format(n))
+
+    def _check_oob(self):
+        if self._serializer is not None:
+            raise ValueError(
+                "put_oob can't be used with a custom serializer"
+            )
+
+    def _get_nowait(self):
+        """ Pull an item off the queue without blocking.
+
+        Raises queue.Empty if there's nothing to read, or if another
+        consumer currently holds the read lock.
+
+        """
+        items = self._drain(1)
+        if not items:
+            raise Empty
+        return items[0]
+
+    def _drain(self, n):
+        """ Take up to n items that are already waiting.
+
+        Items handed back by cancelled gets come first, followed by
+        items read from the pipe. Returns an empty list if nothing is
+        waiting, or if another consumer currently holds the read lock.
+
+        """
+        items = []
+        while self._orphans and len(items) < n:
+            items.append(self._orphans.popleft())
+        items.extend(self._read(n - len(items)))
+        return items
+
+    async def _drain_when_ready(self, n, loop):
+        """ Asynchronous version of _drain, used by the coroutines. """
+        items = []
+        while self._orphans and len(items) < n:
+            items.append(self._orphans.popleft())
+        try:
+            items.extend(await self._read_when_ready(n - len(items), loop))
+        except BaseException:
+            # Hand the orphans taken so far to the next get, in order.
+            self._orphans.extendleft(reversed(items))
+            raise
+        return items
+
+    def _read(self, n):
+        """ Read up to n items that are already waiting in the pipe. """
+        obj = self._obj
+        if getattr(obj, "_closed", False):
+            raise ValueError("Queue {!r} is closed".format(obj))
+        if n <= 0 or not obj._rlock.acquire(False):
+            return []
+        try:
+            frames = []
+            while len(frames) < n and obj._poll():
+                frames.append(self._recv_frame())
+        finally:
+            obj._rlock.release()
+        # unserialize the data after having released the lock
+        return self._load(frames)
+
+    async def _read_when_ready(self, n, loop):
+        """ Like _read, but never blocks the event loop.
+
+        Only frames that are already whole in the pipe, and smaller than
+        _LARGE_FRAME bytes, are read on the event loop. Reading the next
+        frame is handed to the shared executor if the writer hasn't
+        finished writing it yet, or if it's large, in which case it's
+        unpickled there too. The read lock is held until it's in, and it
+        ends the batch. If this is cancelled meanwhile, the items are
+        handed to the next get once the frame is in.
+
+        """
+        obj = self._obj
+        if getattr(obj, "_closed", False):
+            raise ValueError("Queue {!r} is closed".format(obj))
+        if n <= 0 or not obj._rlock.acquire(False):
+            return []
+        fd = obj._reader.fileno()
+        frames = []
+        # The length of the frame to read in the executor, or None if
+        # its header hasn't been read either.
+        size = None
+        handoff = False
+        try:
+            while len(frames) < n and obj._poll():
+                available = util.bytes_available(fd)
+                if available < _HEADER_SIZE:
+                    size = None
+                    handoff = True
+                    break
+                size = self._recv_size()
+                if not 0 <= size < _LARGE_FRAME or (
+                    size > available - _HEADER_SIZE
+                ):
+                    handoff = True
+                    break
+                frames.append(self._recv_body(size))
+        except BaseException:
+            obj._rlock.release()
+            raise
+        if not handoff:
+            obj._rlock.release()
+            return self._load(frames)
+        # Not the queue's own executor, whose only thread could be
+        # blocked in a put, waiting for us to make room in the pipe.
+        fut = util.run_in_executor(
+            shared_executor(), self._recv_large, size, loop=loop
+        )
+        items = self._load(frames)
+        self._receiving += 1
+        try:
+            items.extend(await asyncio.shield(fut))
+        except asyncio.CancelledError:
+            fut.add_done_callback(functools.partial(self._orphan, items))
+            raise
+        except BaseException:
+            self._receiving -= 1
+            raise
+        self._receiving -= 1
+        return items
+
+    def _recv_large(self, size):
+        try:
+            if size is None:
+                frame = self._recv_frame()
+            else:
+                frame = self._recv_body(size)
+        finally:
+            self._obj._rlock.release()
+        return self._load([frame])
+
+    def _orphan(self, items, fut):
+        if not fut.cancelled() and fut.exception() is None:
+            items.extend(fut.result())
+        self._orphans.extend(items)
+        self._receiving -= 1
+
+    def _load(self, frames):
+        """ Returns the items for frames read off the pipe. """
+        if self._stats is not None:
+            self._stats.add_bytes(
+                "get", "frame_bytes", sum(len(f) for f in frames)
+            )
+        return [
+            self._decode(reduction.ForkingPickler.loads(f)) for f in frames
+        ]
+
+    def _recv_frame(self):
+        """ Reads the next frame off the pipe, with the read lock held. """
+        frame = self._obj._reader.recv_bytes()
+        self._frame_read()
+        return frame
+
+    def _recv_size(self):
+        """ Reads the length header of the next frame off the pipe.
+
+        Frames of 2 GiB or more have a length of -1, and their actual
+        length follows the header.
+
+        """
+        header = self._obj._reader._recv(_HEADER_SIZE).getvalue()
+        return struct.unpack("!i", header)[0]
+
+    def _recv_body(self, size):
+        """ Reads the rest of a frame whose header has been read. """
+        reader = self._obj._reader
+        if size == -1:
+            (size,) = struct.unpack("!Q", reader._recv(8).getvalue())
+        frame = reader._recv(size).getvalue()
+        self._frame_read()
+        return frame
+
+    def _frame_read(self):
+        """ Called after each frame is read off the pipe. """
 
 
 class AioSimpleQueue(AioBaseQueue):
     """ An asyncio-friendly version of mp.SimpleQueue.
 
-    Provides two coroutines: coro_get and coro_put,
-    which are asynchronous version of get and put, respectively.
+    Provides the coroutines coro_get, coro_put, coro_get_many,
+    coro_put_many and coro_put_oob, which are asynchronous versions
+    of get, put, get_many, put_many and put_oob, respectively. Use
+    `async for item in queue` or queue.iterate() to iterate over items
+    as they arrive.
 
     """
 
     delegate = SimpleQueue
 
+    def put_many(self, items):
+        """ Put every item in items into the queue.
+
+        The items are pickled up front, and then written to the pipe
+        under a single acquisition of the write lock.
+
+        """
+        obj = self._obj
+        start = self._now()
+        frames = [
+            reduction.ForkingPickler.dumps(self._encode(item))
+            for item in items
+        ]
+        if self._stats is not None:
+            self._stats.add_bytes(
+                "put", "frame_bytes", sum(len(f) for f in frames)
+            )
+        if obj._wlock is None:
+            # writes to a message oriented win32 pipe are atomic
+            for frame in frames:
+                obj._writer.send_bytes(frame)
+        else:
+            with obj._wlock:
+                for frame in frames:
+                    obj._writer.send_bytes(frame)
+        self._record("put", start, len(frames))
+
+
+class _Room:
+    """ Tracks the producers in one event loop waiting for queue space. """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+        self.waiters = 0
+        self.task = None
+
 
 class AioQueue(AioBaseQueue):
-    """ An asyncio-friendly version of mp.SimpleQueue.
+    """ An asyncio-friendly version of mp.Queue.
 
-    Provides two coroutines: coro_get and coro_put,
-    which are asynchronous version of get and put, respectively.
+    Provides the coroutines coro_get, coro_put, coro_get_many,
+    coro_put_many and coro_put_oob, which are asynchronous versions
+    of get, put, get_many, put_many and put_oob, respectively. Use
+    `async for item in queue` or queue.iterate() to iterate over items
+    as they arrive.
+
+    coro_put never blocks a thread. If the queue is full, the producer
+    waits on the event loop until there's room again. Flow control can
+    be made smoother with high_watermark and low_watermark: once the
+    queue holds high_watermark items, coro_put in this process holds off
+    until it has drained to low_watermark items (half of high_watermark
+    by default), instead of trickling items in as space frees up.
 
     """
 
     delegate = Queue
+    wrapper_kwargs = [
+        "high_watermark",
+        "low_watermark",
+        "serializer",
+        "stats",
+    ]
+
+    def __init__(
+        self,
+        maxsize=0,
+        *,
+        high_watermark=None,
+        low_watermark=None,
+        serializer=None,
+        stats=False,
+        ctx=None
+    ):
+        self._init_options(serializer, stats)
+        self._init_flow_control(maxsize, high_watermark, low_watermark)
+
+    def _init_flow_control(self, maxsize, high_watermark, low_watermark):
+        if high_watermark is None:
+            if low_watermark is not None:
+                raise ValueError("low_watermark requires high_watermark")
+        else:
+            if maxsize > 0 and high_watermark > maxsize:
+                raise ValueError("high_watermark can't exceed maxsize")
+            if low_watermark is None:
+                low_watermark = high_watermark // 2
+            if not 0 <= low_watermark < high_watermark:
+                raise ValueError(
+                    "low_watermark must be at least 0 and less than "
+                    "high_watermark"
+                )
+        self._high_watermark = high_watermark
+        self._low_watermark = low_watermark
+        self._paused = False
+        self._room = None
+
+    def coro_put(self, obj, block=True, timeout=None, *, loop=None):
+        """ Asynchronous version of put.
+
+        The item is put on the queue without blocking from the event
+        loop. If the queue is full, or above its high watermark, this
+        waits on the event loop for room, rather than in a thread.
+
+        """
+        if not loop:
+            loop = asyncio.get_event_loop()
+        return asyncio.ensure_future(
+            self._put_when_ready(obj, block, timeout, loop), loop=loop
+        )
+
+    async def _put_when_ready(self, obj, block, timeout, loop):
+        start = self._now()
+        deadline = None if timeout is None else loop.time() + timeout
+        obj = self._encode(obj)
+        while True:
+            if not self._update_paused():
+                try:
+                    self._obj.put(obj, False)
+                    self._record("put", start)
+                    return
+                except Full:
+                    pass
+            remaining = None if deadline is None else deadline - loop.time()
+            if not block or (remaining is not None and remaining <= 0):
+                raise Full
+            room = self._wait_for_room(loop)
+            room.waiters += 1
+            try:
+                await asyncio.wait_for(room.event.wait(), remaining)
+            except asyncio.TimeoutError:
+                raise Full
+            finally:
+                room.waiters -= 1
+
+    @property
+    def producers_paused(self):
+        """ True if the queue is above its high watermark.
+
+        It stays True until the queue drains to its low watermark.
 
+        """
+        return self._update_paused()
 
-class AioJoinableQueue(AioBaseQueue):
+    def fill_level(self):
+        """ Returns how full the queue is, from 0.0 to 1.0.
+
+        This is based on qsize, so it raises NotImplementedError on
+        platforms where that isn't available, like macOS.
+
+        """
+        if self._obj._maxsize <= 0:
+            raise ValueError("An unbounded queue has no fill level")
+        return self._obj.qsize() / self._obj._maxsize
+
+    def _update_paused(self):
+        """ Returns True if producers should hold off on putting. """
+        if self._high_watermark is None:
+            return False
+        try:
+            level = self._obj.qsize()
+        except NotImplementedError:
+            return False
+        if self._paused:
+            self._paused = level > self._low_watermark
+        else:
+            self._paused = level >= self._high_watermark
+        return self._paused
+
+    def _wait_for_room(self, loop):
+        """ Returns the _Room for loop, watching the queue for space. """
+        room = self._room
+        if room is None or room.loop is not loop:
+            room = self._room = _Room(loop)
+        if room.task is None or room.task.done():
+            room.event.clear()
+            room.task = asyncio.ensure_future(
+                self._watch_room(room), loop=loop
+            )
+        return room
+
+    async def _watch_room(self, room):
+        # Consumers may be in other processes, so there's nothing to be
+        # woken by; poll the queue's semaphore instead.
+        delay = _MIN_ROOM_DELAY
+        while room.waiters:
+            await asyncio.sleep(delay)
+            if not self._update_paused() and not self._obj.full():
+                room.event.set()
+                return
+            delay = min(delay * 2, _MAX_ROOM_DELAY)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_paused"] = False
+        state["_room"] = None
+        return state
+
+    def _frame_read(self):
+        self._obj._sem.release()
+
+
+class AioJoinableQueue(AioQueue):
     """ An asyncio-friendly version of mp.JoinableQueue.
 
-    Provides three coroutines: coro_get, coro_put, and
-    coro_join, which are asynchronous version of get put, and
-    join, respectively.
+    Provides the same coroutines as AioQueue, plus coro_join and
+    coro_task_done_many, which are asynchronous versions of join and
+    task_done_many, respectively.
 
     """
 
-    coroutines = ["join"]
+    coroutines = ["join", "task_done_many"]
     delegate = JoinableQueue
+
+    def __init__(
+        self,
+        maxsize=0,
+        *,
+        high_watermark=None,
+        low_watermark=None,
+        serializer=None,
+        stats=False,
+        ctx=None
+    ):
+        self._init_options(serializer, stats)
+        self._init_flow_control(maxsize, high_watermark, low_watermark)
+        # A pipe that task_done writes to whenever the count of
+        # unfinished tasks drops to zero, so coro_join can wait for
+        # it to become readable.
+        if sys.platform == "win32":
+            self._doorbell = None
+        else:
+            self._doorbell = (ctx if ctx else get_context()).Pipe(
+                duplex=False
+            )
+            self._set_doorbell_nonblocking()
+
+    def task_done(self):
+        """ Indicate that a formerly enqueued task is complete. """
+        self.task_done_many(1)
+
+    def task_done_many(self, n):
+        """ Mark n formerly enqueued tasks as complete.
+
+        This does the work of n calls to task_done, but only acquires
+        the queue's condition once. Raises ValueError if that's more
+        tasks than are unfinished, in which case none are marked
+        complete.
+
+        """
+        obj = self._obj
+        with obj._cond:
+            done = 0
+            try:
+                while done < n:
+                    if not obj._unfinished_tasks.acquire(False):
+                        raise ValueError("task_done() called too many times")
+                    done += 1
+            except BaseException:
+                # Every task_done holds the condition, so nobody has
+                # seen the tasks taken so far.
+                for _ in range(done):
+                    obj._unfinished_tasks.release()
+                raise
+            if obj._unfinished_tasks._semlock._is_zero():
+                obj._cond.notify_all()
+                self._ring_doorbell()
+
+    def coro_join(self, *, loop=None):
+        """ Asynchronous version of join.
+
+        Instead of waiting on the queue's condition in a thread, this
+        waits on the event loop for task_done to report that the count
+        of unfinished tasks dropped to zero. Tasks marked done through
+        the underlying mp.JoinableQueue, rather than an
+        AioJoinableQueue, are noticed by a periodic recheck.
+
+        """
+        if not loop:
+            loop = asyncio.get_event_loop()
+        if self._doorbell is None or not util.supports_readers(loop):
+            return self.run_in_executor(self.join, loop=loop)
+        return asyncio.ensure_future(self._join_when_done(loop), loop=loop)
+
+    async def _join_when_done(self, loop):
+        reader = self._doorbell[0]
+        while True:
+            # Clear old rings first, so a ring that happens after
+            # the check below isn't lost.
+            self._drain_doorbell()
+            if self._obj._unfinished_tasks._semlock._is_zero():
+                return
+            fut = util.wait_readable([reader.fileno()], loop=loop)
+            try:
+                await asyncio.wait_for(fut, _JOIN_RECHECK)
+            except asyncio.TimeoutError:
+                pass
+
+    def _ring_doorbell(self):
+        if self._doorbell is None:
+            return
+        try:
+            os.write(self._doorbell[1].fileno(), b"\0")
+        except BlockingIOError:
+            # The pipe is full, so it's readable already.
+            pass
+
+    def _drain_doorbell(self):
+        fd = self._doorbell[0].fileno()
+        try:
+            while os.read(fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _set_doorbell_nonblocking(self):
+        for conn in self._doorbell:
+            os.set_blocking(conn.fileno(), False)
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if self._doorbell is not None:
+            self._set_doorbell_nonblocking()
+
+
+class AioPriorityQueue(AioBaseQueue):
+    """ An asyncio-friendly version of PriorityQueue.
+
+    Items are (priority, data) tuples, with priority an int from 0 to
+    levels - 1, lowest first. Provides the same coroutines as
+    AioQueue, and coro_get waits on every priority level at once.
+
+    """
+
+    delegate = PriorityQueue
+
+    def put_oob(
+        self,
+        item,
+        block=True,
+        timeout=None,
+        *,
+        threshold=serialization.OOB_THRESHOLD
+    ):
+        """ Put a (priority, data) item into the queue.
+
+        Large buffers in data are passed out-of-band, as described in
+        AioQueue.put_oob.
+
+        """
+        self._check_oob()
+        priority, data = item
+        self._obj._level(priority)
+        if not serialization.shm_supported:
+            return self.put(item, block, timeout)
+        shared = serialization.SharedBuffers(data, threshold)
+        try:
+            self.put((priority, shared), block, timeout)
+        except BaseException:
+            shared.discard()
+            raise
+
+    def _select_readers(self):
+        return self._obj._readers()
+
+    def _read(self, n):
+        if n <= 0:
+            return []
+        return [self._decode(item) for item in self._obj._drain(n)]
+
+    async def _read_when_ready(self, n, loop):
+        # Each level's frames are read whole by the PriorityQueue.
+        return self._read(n)
+
+    def _encode(self, item):
+        if self._serializer is None:
+            return item
+        priority, data = item
+        return priority, self._dumps(data)
+
+    def _decode(self, item):
+        if self._serializer is None:
+            return item
+        priority, data = item
+        return priority, self._loads(data)
+
+
+class AioShmQueue(metaclass=CoroBuilder):
+    """ An asyncio-friendly version of ShmQueue.
+
+    Provides two coroutines: coro_get and coro_put,
+    which are asynchronous version of get and put, respectively.
+    Both block their executor thread in short slices, so cancelling
+    them frees the thread. An item taken off the queue by a cancelled
+    coro_get is handed to the next get, but note that a cancelled
+    coro_put may still have put its item.
+
+    """
+
+    coroutines = ["get", "put"]
+    interruptible = ["get", "put"]
+    delegate = ShmQueue
+
+    def __init__(self, *args, **kwargs):
+        self._orphans = deque()
+
+    def get(self, block=True, timeout=None):
+        if self._orphans:
+            return self._orphans.popleft()
+        return self._obj.get(block, timeout)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def _interruptible_get(self, cancelled, block=True, timeout=None):
+        if self._orphans or not block:
+            return self.get(block)
+        for wait in util.wait_slices(timeout, cancelled):
+            if self._orphans:
+                return self._orphans.popleft()
+            try:
+                return self._obj.get(True, wait)
+            except Empty:
+                pass
+        raise Empty
+
+    def _interruptible_put(self, cancelled, obj, block=True, timeout=None):
+        if not block:
+            return self._obj.put(obj, False)
+        for wait in util.wait_slices(timeout, cancelled):
+            try:
+                return self._obj.put(obj, True, wait)
+            except Full:
+                pass
+        raise Full
+
+    def _hand_back(self, func, result):
+        if func == "get":
+            self._orphans.append(result)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_orphans"] = deque()
+        return state
@@ -0,0 +1,268 @@
+import asyncio
+import functools
+import itertools
+
+from .executor import shared_executor
+from .util import run_in_executor
+
+__all__ = ["RpcClient", "serve"]
+
+# Calls are sent as (_CALL, call id, request), and (_CANCEL, call id)
+# asks for a call's handler to be cancelled. Every call gets exactly
+# one reply, (call id, True, result) or (call id, False, error), even
+# if it was cancelled.
+_CALL = 0
+_CANCEL = 1
+
+
+class RpcClient:
+    """ Makes calls to a serve() at the other end of an AioConnection.
+
+    Each request is sent tagged with an id, and a single task reads the
+    replies and hands each one to the call it answers, so any number of
+    coroutines can have calls in flight over one connection at once,
+    rather than taking turns to send a request and wait for its reply.
+    The reading task only runs while replies are outstanding.
+
+    If the connection fails, calls in flight raise the error (EOFError,
+    if the other end closed the connection), and later calls raise
+    OSError.
+
+    """
+
+    def __init__(self, conn, *, loop=None):
+        self._conn = conn
+        self._loop = loop
+        self._ids = itertools.count()
+        # Futures of the calls waiting for their replies, by call id.
+        self._pending = {}
+        # The ids of the calls sent whose replies haven't been read.
+        self._awaiting = set()
+        self._reader = None
+        self._send_lock = None
+        self._closed = False
+
+    async def call(self, request):
+        """ Sends request, and returns the handler's result for it.
+
+        An error raised by the handler is raised here. If this is
+        cancelled after the request was sent, the other end is asked to
+        cancel the handler.
+
+        """
+        if self._closed:
+            raise OSError("client is closed")
+        loop = self._loop if self._loop else asyncio.get_event_loop()
+        if self._send_lock is None:
+            self._send_lock = asyncio.Lock()
+        call_id = next(self._ids)
+        fut = loop.create_future()
+        self._pending[call_id] = fut
+        try:
+            await _send(
+                self._conn,
+                self._send_lock,
+                (_CALL, call_id, request),
+                loop,
+                on_sent=functools.partial(self._sent, call_id, loop),
+            )
+            return await fut
+        except asyncio.CancelledError:
+            if call_id in self._awaiting and not self._closed:
+                cancel = asyncio.ensure_future(
+                    _send(
+                        self._conn,
+                        self._send_lock,
+                        (_CANCEL, call_id),
+                        loop,
+                    ),
+                    loop=loop,
+                )
+                cancel.add_done_callback(_retrieve)
+            raise
+        finally:
+            self._pending.pop(call_id, None)
+
+    def close(self):
+        """ Closes the connection, failing any calls in flight. """
+        self._fail(OSError("client is closed"))
+        self._conn.close()
+
+    def _sent(self, call_id, loop, fut):
+        self._awaiting.add(call_id)
+        fut.add_done_callback(functools.partial(self._check_sent, call_id))
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.ensure_future(self._read(loop), loop=loop)
+
+    def _check_sent(self, call_id, fut):
+        if fut.exception() is not None:
+            # No reply is coming for a request that couldn't be sent.
+            self._awaiting.discard(call_id)
+
+    async def _read(self, loop):
+        try:
+            while self._awaiting:
+                call_id, ok, result = await self._conn.coro_recv(loop=loop)
+                self._awaiting.discard(call_id)
+                fut = self._pending.pop(call_id, None)
+                if fut is None or fut.done():
+                    continue
+                if ok:
+                    fut.set_result(result)
+                else:
+                    fut.set_exception(result)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._reader = None
+            self._fail(e)
+
+    def _fail(self, error):
+        self._closed = True
+        self._awaiting.clear()
+        if self._reader is not None and not self._reader.done():
+            self._reader.cancel()
+        pending = list(self._pending.values())
+        self._pending.clear()
+        for fut in pending:
+            if not fut.done():
+                fut.set_exception(error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+
+def serve(conn, handler, max_concurrency=None, *, loop=None):
+    """ Answers the calls an RpcClient makes over conn, an AioConnection.
+
+    handler is a coroutine function that's called with each request,
+    and run as its own task, so many calls are handled at once, and
+    their replies are sent in whatever order they finish. Up to
+    max_concurrency handlers (any number, if None) run at once. An error
+    raised by handler is sent back to be raised by the call, as is
+    an error sending the result.
+
+    Returns a Future that finishes when the other end closes the
+    connection. Handlers still running then, or when the Future is
+    cancelled, are cancelled.
+
+    """
+    if max_concurrency is not None and max_concurrency < 1:
+        raise ValueError("max_concurrency must be at least 1")
+    if not loop:
+        loop = asyncio.get_event_loop()
+    return asyncio.ensure_future(
+        _Server(conn, handler, max_concurrency, loop).run(), loop=loop
+    )
+
+
+class _Server:
+    def __init__(self, conn, handler, max_concurrency, loop):
+        self._conn = conn
+        self._handler = handler
+        self._max_concurrency = max_concurrency
+        self._loop = loop
+        self._tasks = {}
+        self._closing = False
+
+    async def run(self):
+        self._sem = None
+        if self._max_concurrency is not None:
+            self._sem = asyncio.Semaphore(self._max_concurrency)
+        self._send_lock = asyncio.Lock()
+        try:
+            while True:
+                try:
+                    msg = await self._conn.coro_recv(loop=self._loop)
+                except EOFError:
+                    return
+                if msg[0] == _CANCEL:
+                    task = self._tasks.get(msg[1])
+                    if task is not None:
+                        task.cancel()
+                    continue
+                _, call_id, request = msg
+                task = asyncio.ensure_future(
+                    self._answer(call_id, request), loop=self._loop
+                )
+                self._tasks[call_id] = task
+                task.add_done_callback(
+                    functools.partial(self._forget, call_id)
+                )
+        finally:
+            self._closing = True
+            tasks = list(self._tasks.values())
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.wait(tasks)
+
+    def _forget(self, call_id, task):
+        self._tasks.pop(call_id, None)
+
+    async def _answer(self, call_id, request):
+        try:
+            if self._sem is None:
+                result = await self._handler(request)
+            else:
+                async with self._sem:
+                    result = await self._handler(request)
+            reply = (call_id, True, result)
+        except asyncio.CancelledError:
+            if self._closing:
+                raise
+            reply = (call_id, False, asyncio.CancelledError())
+        except Exception as e:
+            reply = (call_id, False, e)
+        try:
+            await self._reply(reply)
+        except (EOFError, OSError):
+            # The other end has gone, and the reading loop will stop.
+            pass
+        except Exception as e:
+            # The reply couldn't be serialized.
+            await self._reply(
+                (
+                    call_id,
+                    False,
+                    RuntimeError("Couldn't send reply: {!r}".format(e)),
+                )
+            )
+
+    def _reply(self, reply):
+        return _send(self._conn, self._send_lock, reply, self._loop)
+
+
+async def _send(conn, lock, msg, loop, on_sent=None):
+    """ Sends msg over conn, one message at a time.
+
+    The lock is held until the message has been sent, even if this is
+    cancelled, so messages never interleave. If given, on_sent is called
+    with the Future of the send once it has been started, after which
+    the message is sent in full, or not at all.
+
+    """
+    await lock.acquire()
+    try:
+        if conn._natively(loop):
+            fut = conn.coro_send(msg, loop=loop)
+        else:
+            # The connection's own executor may have just one thread,
+            # which a coro_recv in progress is holding.
+            fut = run_in_executor(shared_executor(), conn.send, msg, loop=loop)
+    except BaseException:
+        lock.release()
+        raise
+    fut.add_done_callback(lambda fut: lock.release())
+    if on_sent is not None:
+        on_sent(fut)
+    await asyncio.shield(fut)
+
+
+def _retrieve(fut):
+    """ Fetches fut's error, if any, so it isn't reported as unhandled. """
+    if not fut.cancelled():
+        fut.exception()
@@ -0,0 +1,412 @@
+""" Helpers for serializing objects that are sent between processes. """
+import io
+import marshal
+import pickle
+import struct
+import sys
+import types
+import zlib
+
+from .mp import reduction, resource_tracker, shared_memory
+
+try:
+    import lzma
+except ImportError:  # Python can be built without it
+    lzma = None
+
+__all__ = [
+    "OOB_THRESHOLD",
+    "dumps_oob",
+    "loads_oob",
+    "SharedBuffers",
+    "PickleSerializer",
+    "MarshalSerializer",
+    "FunctionSerializer",
+    "get_serializer",
+    "COMPRESSION_THRESHOLD",
+    "compress_frame",
+    "compress_frames",
+    "decompress_frame",
+]
+
+# Buffers smaller than this are cheaper to copy in-band than
+# to ship separately.
+OOB_THRESHOLD = 1 << 16
+
+# Out-of-band pickling needs pickle protocol 5, which arrived in
+# Python 3.8, along with shared_memory.
+oob_supported = pickle.HIGHEST_PROTOCOL >= 5
+# Windows destroys a shared memory block as soon as the last handle to
+# it is closed, so a block can't outlive the process that put it on
+# a queue until the consumer gets around to reading it.
+shm_supported = (
+    oob_supported and shared_memory is not None and sys.platform != "win32"
+)
+
+
+class PickleSerializer:
+    """ Serializes objects with the standard library's pickle module.
+
+    Unlike the default serialization, this never uses dill, even if
+    multiprocess is installed, so it's a good deal faster for plain
+    data. protocol defaults to pickle.HIGHEST_PROTOCOL.
+
+    """
+
+    def __init__(self, protocol=None):
+        self.protocol = (
+            pickle.HIGHEST_PROTOCOL if protocol is None else protocol
+        )
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MarshalSerializer:
+    """ Serializes objects with the marshal module.
+
+    marshal only handles builtin types (numbers, strings, bytes, and
+    tuples, lists, sets and dicts of those), but is faster than pickle.
+    The format can change between Python versions, so all processes
+    must run the same Python.
+
+    """
+
+    def __init__(self, version=marshal.version):
+        self.version = version
+
+    def dumps(self, obj):
+        return marshal.dumps(obj, self.version)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+
+class FunctionSerializer:
+    """ Serializes objects with a user supplied dumps/loads pair.
+
+    dumps must return a bytes-like object. Both functions must be
+    picklable (e.g. defined at module level), so the serializer can be
+    sent to child processes along with the queue or connection.
+
+    """
+
+    def __init__(self, dumps, loads):
+        self.dumps = dumps
+        self.loads = loads
+
+
+_SERIALIZERS = {"pickle": PickleSerializer, "marshal": MarshalSerializer}
+
+
+def get_serializer(serializer):
+    """ Returns a serializer object for the serializer= option.
+
+    serializer may be None (use the default multiprocessing pickler),
+    "pickle", "marshal", a (dumps, loads) pair, or any object with
+    dumps and loads methods, such as a PickleSerializer, or a module.
+
+    """
+    if serializer is None:
+        return None
+    if isinstance(serializer, str):
+        try:
+            return _SERIALIZERS[serializer]()
+        except KeyError:
+            raise ValueError(
+                "Unknown serializer {!r}, expected one of {}".format(
+                    serializer, ", ".join(sorted(_SERIALIZERS))
+                )
+            ) from None
+    if isinstance(serializer, tuple):
+        return FunctionSerializer(*serializer)
+    if not (hasattr(serializer, "dumps") and hasattr(serializer, "loads")):
+        raise TypeError(
+            "serializer must have dumps and loads methods, "
+            "not {!r}".format(serializer)
+        )
+    if isinstance(serializer, types.ModuleType):
+        # Modules can't be pickled, but their functions can.
+        return FunctionSerializer(serializer.dumps, serializer.loads)
+    return serializer
+
+
+# Frames smaller than this aren't worth compressing.
+COMPRESSION_THRESHOLD = 1 << 12
+
+# Every frame sent with compression enabled starts with one of these
+# flag bytes, saying how the rest of it is encoded.
+_RAW = b"\x00"
+_CODECS = {"zlib": (b"\x01", zlib)}
+if lzma is not None:
+    _CODECS["lzma"] = (b"\x02", lzma)
+# Incremental compressors, which give the same output as the codecs.
+_COMPRESSORS = {"zlib": zlib.compressobj}
+if lzma is not None:
+    _COMPRESSORS["lzma"] = lzma.LZMACompressor
+_DECOMPRESSORS = {_CODECS["zlib"][0][0]: zlib.decompressobj}
+if lzma is not None:
+    _DECOMPRESSORS[_CODECS["lzma"][0][0]] = lzma.LZMADecompressor
+
+
+def check_compression(compression):
+    """ Raises ValueError if compression isn't a known codec or None. """
+    if compression is not None and compression not in _CODECS:
+        raise ValueError(
+            "Unknown compression {!r}, expected one of {}".format(
+                compression, ", ".join(sorted(_CODECS))
+            )
+        )
+
+
+def compress_frame(data, compression, threshold=COMPRESSION_THRESHOLD):
+    """ Returns data, flagged and compressed if that's worthwhile.
+
+    Data smaller than threshold, or that doesn't get any smaller, is
+    sent as it is, after a flag byte.
+
+    """
+    if len(data) >= threshold:
+        flag, codec = _CODECS[compression]
+        packed = codec.compress(data)
+        if len(packed) < len(data):
+            return flag + packed
+    return _RAW + data
+
+
+def compress_frames(buffers, compression, threshold=COMPRESSION_THRESHOLD):
+    """ Like compress_frame, for data made up of several buffers.
+
+    Returns a list of buffers that together make up the frame. Data
+    that isn't compressed is sent from the original buffers, and data
+    that is gets compressed a buffer at a time, so the buffers are
+    never joined together.
+
+    """
+    size = sum(memoryview(buf).nbytes for buf in buffers)
+    if size >= threshold:
+        flag, _ = _CODECS[compression]
+        compressor = _COMPRESSORS[compression]()
+        packed = [compressor.compress(buf) for buf in buffers]
+        packed.append(compressor.flush())
+        if sum(len(chunk) for chunk in packed) < size:
+            return [flag] + packed
+    return [_RAW] + list(buffers)
+
+
+def decompress_frame(frame, maxlength=None):
+    """ Returns the original data of a frame built by compress_frame.
+
+    If maxlength is given and the original data is longer than that,
+    OSError is raised, without decompressing more than maxlength + 1
+    bytes of it.
+
+    """
+    if not len(frame):
+        raise ValueError("Frame is empty, so has no compression flag")
+    flag = frame[0]
+    if flag == _RAW[0]:
+        data = frame[1:]
+    else:
+        try:
+            decompressor = _DECOMPRESSORS[flag]()
+        except KeyError:
+            raise ValueError(
+                "Frame has unknown compression flag {}".format(flag)
+            ) from None
+        data = memoryview(frame)[1:]
+        if maxlength is None:
+            data = decompressor.decompress(data)
+            truncated = not decompressor.eof
+        else:
+            # One byte over the limit is enough to know it's exceeded.
+            data = decompressor.decompress(data, maxlength + 1)
+            truncated = not decompressor.eof and len(data) <= maxlength
+        if truncated:
+            raise ValueError("Compressed frame is truncated")
+    if maxlength is not None and len(data) > maxlength:
+        raise OSError("bad message length")
+    return data
+
+
+class _OOBPickler(reduction.ForkingPickler):
+    """ A ForkingPickler that collects large buffers out-of-band.
+
+    Objects that support pickle protocol 5 (e.g. NumPy arrays, or
+    pickle.PickleBuffer) hand their buffers to buffer_callback.
+    memoryview objects can't be pickled at all normally, so they're
+    wrapped in a PickleBuffer via reducer_override. Note that bytes and
+    bytearray objects are always pickled in-band; wrap them in a
+    memoryview or PickleBuffer to send them out-of-band.
+
+    """
+
+    def __init__(self, file, buffer_callback):
+        # ForkingPickler.__init__ doesn't pass keyword arguments on.
+        super(reduction.ForkingPickler, self).__init__(
+            file, 5, buffer_callback=buffer_callback
+        )
+        self.dispatch_table = self._copyreg_dispatch_table.copy()
+        self.dispatch_table.update(self._extra_reducers)
+
+    def reducer_override(self, obj):
+        if type(obj) is not memoryview or not obj.c_contiguous:
+            return NotImplemented
+        return (
+            _rebuild_memoryview,
+            (pickle.PickleBuffer(obj), obj.format, obj.shape),
+        )
+
+
+def _rebuild_memoryview(buf, fmt, shape):
+    # No copy needed; the view just keeps the buffer alive.
+    return memoryview(buf).cast("B").cast(fmt, shape)
+
+
+def dumps_oob(obj, threshold=OOB_THRESHOLD):
+    """ Pickle obj, keeping buffers of threshold bytes or more out-of-band.
+
+    Returns a tuple of (payload, buffers), where buffers is a list of
+    memoryviews of the original objects' data. Pass both to loads_oob
+    to rebuild obj.
+
+    """
+    if not oob_supported:
+        raise NotImplementedError(
+            "Out-of-band pickling requires pickle protocol 5"
+        )
+    buffers = []
+
+    # This mustn't be a method of the pickler: the reference cycle
+    # would keep the buffers (and so their exporters) alive until the
+    # garbage collector runs.
+    def collect(buf):
+        raw = buf.raw()
+        if raw.nbytes < threshold:
+            # Returning True serializes the buffer in-band.
+            return True
+        buffers.append(raw)
+        return False
+
+    buf = io.BytesIO()
+    _OOBPickler(buf, collect).dump(obj)
+    return buf.getbuffer(), buffers
+
+
+def loads_oob(payload, buffers):
+    """ Rebuild an object pickled by dumps_oob. """
+    return reduction.ForkingPickler.loads(payload, buffers=buffers)
+
+
+# A buffer count, followed by that many buffer sizes. This is a format
+# string, not a struct.Struct, which dill couldn't pickle along with
+# the module's globals.
+_COUNT = "!I"
+_COUNT_SIZE = struct.calcsize(_COUNT)
+
+
+def pack_oob_header(payload, buffers):
+    """ Returns a frame holding the payload and the sizes of buffers. """
+    sizes = [b.nbytes for b in buffers]
+    header = struct.pack(_COUNT, len(sizes))
+    header += struct.pack("!{}Q".format(len(sizes)), *sizes)
+    return header + payload
+
+
+def unpack_oob_header(frame):
+    """ Returns (payload, sizes) from a frame built by pack_oob_header. """
+    (count,) = struct.unpack_from(_COUNT, frame)
+    sizes = struct.unpack_from("!{}Q".format(count), frame, _COUNT_SIZE)
+    offset = _COUNT_SIZE + 8 * count
+    return memoryview(frame)[offset:], sizes
+
+
+def share_resource_tracker():
+    """ Starts this process's resource tracker, if it isn't running yet.
+
+    Processes forked from this one afterwards report to the same
+    tracker, rather than each starting their own, so shared memory
+    blocks one of them puts on a queue outlive it until they've all
+    exited.
+
+    """
+    if shm_supported:
+        resource_tracker.ensure_running()
+
+
+class SharedBuffers:
+    """ Carries an object's out-of-band buffers in shared memory.
+
+    Each large buffer is copied into its own shared memory block when
+    the SharedBuffers is created, and only a small payload and the
+    names of the blocks are pickled. Unpickling a SharedBuffers maps the
+    blocks and returns the original object, with its buffers pointing
+    straight into shared memory. The blocks are unlinked as soon as
+    they're mapped, and unmapped once the rebuilt object goes away.
+    Blocks that are never unpickled are removed by the resource
+    tracker, once the processes sharing it have all exited.
+
+    """
+
+    def __init__(self, obj, threshold=OOB_THRESHOLD):
+        payload, buffers = dumps_oob(obj, threshold)
+        self._payload = bytes(payload)
+        self._segments = []
+        try:
+            for buf in buffers:
+                self._segments.append(_copy_to_segment(buf))
+        except BaseException:
+            self.discard()
+            raise
+
+    def __reduce__(self):
+        return _load_shared, (self._payload, self._segments)
+
+    def discard(self):
+        """ Remove the shared memory blocks, if they'll never be read. """
+        for name, _ in self._segments:
+            shm = shared_memory.SharedMemory(name=name)
+            shm.close()
+            shm.unlink()
+        self._segments = []
+
+
+def _copy_to_segment(buf):
+    size = buf.nbytes
+    # The block stays registered with the resource tracker, which is
+    # shared by every process started from the one that started it, so
+    # if nobody ever reads the block, it's removed once they've all
+    # exited. Unlinking it when it's read unregisters it there.
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        shm.buf[:size] = buf
+        return shm.name, size
+    finally:
+        shm.close()
+
+
+def _map_segment(name, size):
+    """ Returns a writable memoryview of the named shared memory block.
+
+    The view owns the mapping, so it stays valid for as long as any
+    object built on top of it is alive, and is unmapped after that.
+
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    # Take over the mapping so closing the SharedMemory doesn't unmap it
+    # from under the view.
+    mapping = shm._mmap
+    shm._buf.release()
+    shm._buf = None
+    shm._mmap = None
+    shm.close()
+    shm.unlink()
+    return memoryview(mapping)[:size]
+
+
+def _load_shared(payload, segments):
+    buffers = [_map_segment(name, size) for name, size in segments]
+    return loads_oob(payload, buffers)
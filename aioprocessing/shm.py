@@ -0,0 +1,182 @@
+import struct
+import time
+from queue import Empty, Full
+
+from .mp import get_context, reduction, shared_memory, util as _util
+
+__all__ = ["ShmQueue"]
+
+# head, tail and item count. head and tail are byte offsets that only
+# ever grow; their difference is the number of bytes in use.
+# These are kept as format strings rather than struct.Struct objects,
+# which can't be pickled, as dill does with module globals.
+_HEADER = "QQQ"
+_HEADER_SIZE = struct.calcsize(_HEADER)
+_LENGTH = "I"
+_LENGTH_SIZE = struct.calcsize(_LENGTH)
+
+
+class ShmQueue:
+    """ A FIFO queue backed by a shared memory ring buffer.
+
+    Items are pickled and copied straight into a fixed-size block of
+    shared memory, rather than being written to a pipe by a feeder
+    thread, the way mp.Queue works. Readers and writers in all
+    processes coordinate using a lock and two conditions from the
+    given context.
+
+    capacity is the size of the ring in bytes. Every item takes up
+    its pickled size plus a four byte length prefix, and an item that
+    can never fit raises ValueError from put.
+
+    """
+
+    def __init__(self, capacity=1 << 20, *, ctx=None):
+        if shared_memory is None:
+            raise NotImplementedError(
+                "ShmQueue requires multiprocessing.shared_memory"
+            )
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        ctx = ctx if ctx else get_context()
+        self._capacity = capacity
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=_HEADER_SIZE + capacity
+        )
+        self._set_header(0, 0, 0)
+        self._lock = ctx.Lock()
+        self._not_empty = ctx.Condition(self._lock)
+        self._not_full = ctx.Condition(self._lock)
+        # Only the creating process removes the block, once it exits.
+        _util.Finalize(
+            self, ShmQueue._unlink, (self._shm,), exitpriority=10
+        )
+
+    def __getstate__(self):
+        return (
+            self._capacity,
+            self._shm,
+            self._lock,
+            self._not_empty,
+            self._not_full,
+        )
+
+    def __setstate__(self, state):
+        (
+            self._capacity,
+            self._shm,
+            self._lock,
+            self._not_empty,
+            self._not_full,
+        ) = state
+
+    @staticmethod
+    def _unlink(shm):
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def put(self, obj, block=True, timeout=None):
+        # serialize the data before acquiring the lock
+        data = reduction.ForkingPickler.dumps(obj)
+        size = _LENGTH_SIZE + len(data)
+        if size > self._capacity:
+            raise ValueError(
+                "Item of {} bytes can't fit in a queue of {} bytes".format(
+                    size, self._capacity
+                )
+            )
+        deadline = _deadline(block, timeout)
+        with self._not_full:
+            while self._free() < size:
+                if not block or not self._not_full.wait(_left(deadline)):
+                    raise Full
+            head, tail, count = self._header()
+            self._copy_in(tail, struct.pack(_LENGTH, len(data)))
+            self._copy_in(tail + _LENGTH_SIZE, data)
+            self._set_header(head, tail + size, count + 1)
+            self._not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        deadline = _deadline(block, timeout)
+        with self._not_empty:
+            while not self._count():
+                if not block or not self._not_empty.wait(_left(deadline)):
+                    raise Empty
+            head, tail, count = self._header()
+            prefix = self._copy_out(head, _LENGTH_SIZE)
+            (length,) = struct.unpack(_LENGTH, prefix)
+            data = self._copy_out(head + _LENGTH_SIZE, length)
+            size = _LENGTH_SIZE + length
+            self._set_header(head + size, tail, count - 1)
+            self._not_full.notify()
+        # unserialize the data after having released the lock
+        return reduction.ForkingPickler.loads(data)
+
+    def put_nowait(self, obj):
+        return self.put(obj, False)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return self._count()
+
+    def empty(self):
+        return not self._count()
+
+    def close(self):
+        """ Stop using the queue's shared memory in this process. """
+        self._shm.close()
+
+    def _header(self):
+        """ Returns the ring's (head, tail, count). """
+        return struct.unpack_from(_HEADER, self._shm.buf, 0)
+
+    def _set_header(self, head, tail, count):
+        struct.pack_into(_HEADER, self._shm.buf, 0, head, tail, count)
+
+    def _count(self):
+        return self._header()[2]
+
+    def _free(self):
+        head, tail, _ = self._header()
+        return self._capacity - (tail - head)
+
+    def _copy_in(self, offset, data):
+        """ Copy data into the ring, starting at the byte offset given. """
+        buf = self._shm.buf
+        data = memoryview(data)
+        pos = offset % self._capacity
+        first = min(len(data), self._capacity - pos)
+        start = _HEADER_SIZE + pos
+        buf[start:start + first] = data[:first]
+        if first < len(data):
+            rest = len(data) - first
+            buf[_HEADER_SIZE:_HEADER_SIZE + rest] = data[first:]
+
+    def _copy_out(self, offset, length):
+        """ Copy length bytes out of the ring, starting at offset. """
+        buf = self._shm.buf
+        pos = offset % self._capacity
+        first = min(length, self._capacity - pos)
+        start = _HEADER_SIZE + pos
+        if first == length:
+            return bytes(buf[start:start + length])
+        out = bytearray(length)
+        out[:first] = buf[start:start + first]
+        out[first:] = buf[_HEADER_SIZE:_HEADER_SIZE + length - first]
+        return out
+
+
+def _deadline(block, timeout):
+    if not block or timeout is None:
+        return None
+    return time.monotonic() + timeout
+
+
+def _left(deadline):
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
@@ -0,0 +1,157 @@
+import threading
+import time
+from functools import wraps
+
+__all__ = ["Histogram", "QueueStats"]
+
+# Bucket i of a Histogram counts durations of less than 2 ** i
+# microseconds (and at least 2 ** (i - 1)); the last bucket also counts
+# everything longer than that.
+_BUCKETS = 32
+
+
+class Histogram:
+    """ Counts durations in power-of-two buckets, from 1µs up. """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * _BUCKETS
+
+    def add(self, seconds):
+        index = min(int(seconds * 1e6).bit_length(), _BUCKETS - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """ Returns an upper bound for the q quantile, in seconds. """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(_upper_bound(index), self.max)
+        return self.max
+
+    def snapshot(self):
+        """ Returns a dict describing the histogram. """
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            # (upper bound in seconds, count) for every non-empty bucket
+            "buckets": [
+                (_upper_bound(index), n)
+                for index, n in enumerate(self.buckets)
+                if n
+            ],
+        }
+
+
+def _upper_bound(index):
+    return (1 << index) / 1e6
+
+
+class QueueStats:
+    """ Throughput and latency figures for one queue, in one process.
+
+    Records how many items were put and got, how long each put and get
+    took, and for calls run in the ThreadPoolExecutor, how long they
+    waited for a worker thread versus how long the call itself took.
+
+    Two byte counts are kept for each of put and get. serialized_bytes
+    is the size of the data a custom serializer= produced or took back,
+    and is 0 without one. frame_bytes is the size of the pickled frames
+    the queue wrapper itself wrote to or read from the pipe: those of
+    AioSimpleQueue.put_many, and of gets made by the coroutines and
+    get_many. Frames pickled by a queue's feeder thread, or read by the
+    underlying queue's own get, aren't seen, so the two sides' frame
+    counts needn't match.
+
+    The figures are per process: a queue sent to a child process starts
+    over with empty stats there.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops = {
+            op: {
+                "count": 0,
+                "serialized_bytes": 0,
+                "frame_bytes": 0,
+                "latency": Histogram(),
+            }
+            for op in ("put", "get")
+        }
+        self._executor_wait = Histogram()
+        self._executor_call = Histogram()
+
+    def __reduce__(self):
+        return QueueStats, ()
+
+    def record(self, op, started=None, items=1):
+        """ Record items handled by op, and its latency if started.
+
+        started is a time.perf_counter() value from when the
+        operation began.
+
+        """
+        with self._lock:
+            stats = self._ops[op]
+            stats["count"] += items
+            if started is not None:
+                stats["latency"].add(time.perf_counter() - started)
+
+    def add_bytes(self, op, field, nbytes):
+        """ Adds nbytes to op's serialized_bytes or frame_bytes. """
+        with self._lock:
+            self._ops[op][field] += nbytes
+
+    def timed(self, callback):
+        """ Wraps callback to record its executor wait and call times.
+
+        The wrapper must be submitted to the executor right away.
+
+        """
+        submitted = time.perf_counter()
+
+        @wraps(callback)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                finished = time.perf_counter()
+                with self._lock:
+                    self._executor_wait.add(started - submitted)
+                    self._executor_call.add(finished - started)
+
+        return wrapper
+
+    def snapshot(self):
+        """ Returns the current figures as a dict. """
+        with self._lock:
+            out = {
+                op: {
+                    "count": stats["count"],
+                    "serialized_bytes": stats["serialized_bytes"],
+                    "frame_bytes": stats["frame_bytes"],
+                    "latency": stats["latency"].snapshot(),
+                }
+                for op, stats in self._ops.items()
+            }
+            out["executor"] = {
+                "wait": self._executor_wait.snapshot(),
+                "call": self._executor_call.snapshot(),
+            }
+        return out
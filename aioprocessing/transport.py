@@ -0,0 +1,652 @@
+import asyncio
+import itertools
+import math
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from collections import deque
+
+from . import buffers, util
+from .mp import connection as _connection, reduction
+
+__all__ = ["NativeConnection", "supported"]
+
+# Whether NativeConnection can be used on this platform. Windows pipe
+# handles can't be made non-blocking or watched by the event loop.
+supported = sys.platform != "win32"
+
+# Messages are framed exactly the way multiprocessing.connection frames
+# them on POSIX: a signed 4 byte big-endian length, or for messages of
+# 2 GiB or more, a length of -1 followed by an unsigned 8 byte length.
+_HEADER = "!i"
+_HEADER_SIZE = struct.calcsize(_HEADER)
+_LONG_HEADER = "!Q"
+_LONG_HEADER_SIZE = struct.calcsize(_LONG_HEADER)
+_MAX_SHORT = 0x7FFFFFFF
+# The most buffers passed to a single writev call.
+_MAX_IOV = 64
+
+
+def byte_view(buf, offset=0, size=None):
+    """ Returns the bytes of buf that send_bytes(buf, offset, size) sends.
+
+    offset and size are counted in items of buf, like Connection does.
+
+    """
+    m = memoryview(buf)
+    itemsize = m.itemsize
+    m = m.cast("B")
+    start = offset * itemsize
+    end = m.nbytes if size is None else start + size * itemsize
+    if start < 0 or not start <= end <= m.nbytes:
+        raise ValueError("buffer length < offset + size")
+    return m[start:end]
+
+
+def _wait_fd(fd, writable, timeout):
+    """ Blocks until fd is readable (or writable), or timeout passes. """
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        poller.register(fd, select.POLLOUT if writable else select.POLLIN)
+        poller.poll(None if timeout is None else math.ceil(timeout * 1000))
+    elif writable:
+        select.select([], [fd], [], timeout)
+    else:
+        select.select([fd], [], [], timeout)
+
+
+class NativeConnection:
+    """ A multiprocessing Connection that can be used without threads.
+
+    Wraps a Connection, switches its file descriptor to non-blocking
+    mode, and reads and writes the Connection's length-prefixed frames
+    itself, so they stay compatible with a plain Connection on the other
+    end. It has the same blocking API as Connection, which waits for the
+    file descriptor with select, plus coro_send_bytes, coro_recv_bytes
+    and coro_poll coroutines that wait for it on the event loop.
+
+    Reads never go past the end of the message being received, but a
+    message that was partly read, or partly written by a cancelled
+    coroutine, is kept in this object. Writes left over from a cancelled
+    coroutine are finished on the event loop.
+
+    Only available where supported is True.
+
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._fd = conn.fileno()
+        os.set_blocking(self._fd, False)
+        self._lock = threading.Lock()
+        # The message being read: its header, once complete its size,
+        # and if it didn't arrive in one piece, a buffer for it.
+        self._header = b""
+        self._size = None
+        self._buf = None
+        self._got = 0
+        # Complete messages that poll read ahead.
+        self._messages = deque()
+        # Buffers waiting to be written, and how many bytes have been
+        # queued and written in total.
+        self._out = deque()
+        self._queued = 0
+        self._written = 0
+        # (bytes written, Future) pairs for coro_send_bytes calls
+        # waiting for their message to be written.
+        self._send_waiters = deque()
+        self._drainer = None
+
+    def __reduce__(self):
+        return NativeConnection, (self._conn,)
+
+    @property
+    def closed(self):
+        return self._conn.closed
+
+    @property
+    def readable(self):
+        return self._conn.readable
+
+    @property
+    def writable(self):
+        return self._conn.writable
+
+    def fileno(self):
+        return self._conn.fileno()
+
+    def close(self):
+        """ Close the connection, after writing anything still queued. """
+        if self._conn.closed:
+            return
+        try:
+            self._flush_all()
+        except OSError:
+            pass
+        finally:
+            # The fd is left non-blocking: a forked process may share it,
+            # and expect it to stay that way.
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def send_bytes(self, buf, offset=0, size=None):
+        self.send_buffers([byte_view(buf, offset, size)])
+
+    def send_buffers(self, bufs):
+        """ Send the contents of the buffers in bufs as one message.
+
+        The buffers are written with writev, after the header, rather
+        than being joined together first.
+
+        """
+        self._conn._check_closed()
+        self._conn._check_writable()
+        views = [byte_view(buf) for buf in bufs]
+        with self._lock:
+            end = self._queue(views)
+        self._flush_all(end)
+
+    def send(self, obj):
+        self.send_buffers([reduction.ForkingPickler.dumps(obj)])
+
+    def recv_bytes(self, maxlength=None):
+        return self.recv_bytes_pooled(None, maxlength)
+
+    def recv_bytes_pooled(self, pool, maxlength=None):
+        """ Like recv_bytes, but receives into a buffer from pool.
+
+        Returns a memoryview from pool.acquire(), or bytes if pool is
+        None.
+
+        """
+        self._check_recv(maxlength)
+        while True:
+            with self._lock:
+                data = self._read_message(pool)
+            if data is not None:
+                return self._checked(data, maxlength)
+            _wait_fd(self._fd, False, None)
+
+    def recv_bytes_into(self, buf, offset=0):
+        data = self.recv_bytes()
+        m = memoryview(buf)
+        itemsize = m.itemsize
+        m = m.cast("B")
+        start = offset * itemsize
+        if start < 0 or start > m.nbytes:
+            raise ValueError("negative offset")
+        if len(data) > m.nbytes - start:
+            raise _connection.BufferTooShort(data)
+        m[start:start + len(data)] = data
+        return len(data) // itemsize
+
+    def recv(self):
+        return reduction.ForkingPickler.loads(self.recv_bytes())
+
+    def poll(self, timeout=0.0):
+        self._conn._check_closed()
+        self._conn._check_readable()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._ready():
+                return True
+            left = None
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+            _wait_fd(self._fd, False, left)
+
+    def coro_recv_bytes(self, maxlength=None, *, loop=None):
+        """ Receive a message, waiting for it on the event loop. """
+        return self.coro_recv_bytes_pooled(None, maxlength, loop=loop)
+
+    async def coro_recv_bytes_pooled(self, pool, maxlength=None, *, loop=None):
+        """ Asynchronous version of recv_bytes_pooled. """
+        self._check_recv(maxlength)
+        while True:
+            with self._lock:
+                data = self._read_message(pool)
+            if data is not None:
+                return self._checked(data, maxlength)
+            await util.wait_readable([self._fd], loop=loop)
+
+    def _check_recv(self, maxlength):
+        self._conn._check_closed()
+        self._conn._check_readable()
+        if maxlength is not None and maxlength < 0:
+            raise ValueError("negative maxlength")
+
+    def _checked(self, data, maxlength):
+        if maxlength is not None and len(data) > maxlength:
+            if isinstance(data, memoryview):
+                buffers.release(data)
+            self._conn._bad_message_length()
+        return data
+
+    async def coro_poll(self, timeout=0.0, *, loop=None):
+        """ Asynchronous version of poll. """
+        self._conn._check_closed()
+        self._conn._check_readable()
+        if not loop:
+            loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            if self._ready():
+                return True
+            fut = util.wait_readable([self._fd], loop=loop)
+            if deadline is None:
+                await fut
+                continue
+            left = deadline - loop.time()
+            if left <= 0:
+                fut.cancel()
+                return False
+            try:
+                await asyncio.wait_for(fut, left)
+            except asyncio.TimeoutError:
+                pass
+
+    def coro_send_bytes(self, buf, offset=0, size=None, *, loop=None):
+        """ Send a message, waiting for room on the event loop.
+
+        If this is cancelled after the message was queued, the rest of
+        it is still written, so the stream of messages stays intact.
+
+        """
+        return self.coro_send_buffers(
+            [byte_view(buf, offset, size)], loop=loop
+        )
+
+    async def coro_send_buffers(self, bufs, *, loop=None):
+        """ Asynchronous version of send_buffers. """
+        self._conn._check_closed()
+        self._conn._check_writable()
+        if not loop:
+            loop = asyncio.get_event_loop()
+        views = [byte_view(buf) for buf in bufs]
+        with self._lock:
+            end = self._queue(views)
+            self._flush()
+            if self._written >= end:
+                return
+            fut = loop.create_future()
+            self._send_waiters.append((end, fut))
+            if self._drainer is None:
+                self._drainer = asyncio.ensure_future(
+                    self._drain(loop), loop=loop
+                )
+        await fut
+
+    def has_message(self):
+        """ Returns True if a complete message has been read ahead. """
+        return bool(self._messages)
+
+    def _ready(self):
+        """ Returns True if recv_bytes wouldn't block. """
+        with self._lock:
+            if self._messages:
+                return True
+            try:
+                data = self._read_body(None)
+            except (EOFError, OSError):
+                # recv_bytes will raise the error too.
+                return True
+            if data is None:
+                return False
+            self._messages.appendleft(data)
+            return True
+
+    def _read_message(self, pool=None):
+        """ Reads the next message, or as much of it as is waiting.
+
+        Returns the message, or None if it hasn't all arrived yet. If
+        pool is given, the message is read into a buffer from it, and
+        returned as a memoryview, rather than as bytes. Must be called
+        with _lock held.
+
+        """
+        if self._messages:
+            return _converted(self._messages.popleft(), pool)
+        data = self._read_body(pool)
+        if data is None:
+            return None
+        return _converted(data, pool)
+
+    def _read_body(self, pool):
+        """ Does the reading for _read_message.
+
+        Returns the message as bytes, or as a memoryview from the pool
+        its buffer was taken from, if a pool was given when the message
+        started arriving.
+
+        """
+        while self._size is None:
+            need = _HEADER_SIZE - len(self._header)
+            if need <= 0:
+                need += _LONG_HEADER_SIZE
+            chunk = self._read(need)
+            if chunk is None:
+                return None
+            self._header += chunk
+            if len(self._header) < _HEADER_SIZE:
+                continue
+            size, = struct.unpack_from(_HEADER, self._header)
+            if size == -1:
+                if len(self._header) < _HEADER_SIZE + _LONG_HEADER_SIZE:
+                    continue
+                size, = struct.unpack_from(
+                    _LONG_HEADER, self._header, _HEADER_SIZE
+                )
+            self._header = b""
+            if size == 0:
+                return b""
+            self._size = size
+        while True:
+            if self._buf is None and pool is not None:
+                self._buf = pool.acquire(self._size)
+                continue
+            if self._buf is None:
+                chunk = self._read(self._size)
+                if chunk is None:
+                    return None
+                if len(chunk) == self._size:
+                    self._size = None
+                    return chunk
+                # The message didn't arrive in one piece; read the rest
+                # of it straight into a buffer.
+                self._buf = bytearray(self._size)
+                self._buf[:len(chunk)] = chunk
+                self._got = len(chunk)
+                continue
+            try:
+                n = os.readv(self._fd, [memoryview(self._buf)[self._got:]])
+            except BlockingIOError:
+                return None
+            if n == 0:
+                raise OSError("got end of file during message")
+            self._got += n
+            if self._got == self._size:
+                data = self._buf
+                if not isinstance(data, memoryview):
+                    data = bytes(data)
+                self._buf = self._size = None
+                self._got = 0
+                return data
+
+    def _read(self, n):
+        try:
+            chunk = os.read(self._fd, n)
+        except BlockingIOError:
+            return None
+        if not chunk:
+            if self._size is None and not self._header:
+                raise EOFError
+            raise OSError("got end of file during message")
+        return chunk
+
+    def _queue(self, views):
+        """ Queues views, memoryviews of bytes, to be sent as one message.
+
+        Returns how many bytes will have been written in total once
+        the message has been. Must be called with _lock held.
+
+        """
+        header = _frame_header(views)
+        self._out.append(memoryview(header))
+        self._out.extend(view for view in views if view.nbytes)
+        self._queued += len(header) + sum(view.nbytes for view in views)
+        return self._queued
+
+    def _flush(self):
+        """ Writes as much queued data as it can without blocking.
+
+        Must be called with _lock held.
+
+        """
+        while self._out:
+            bufs = list(itertools.islice(self._out, _MAX_IOV))
+            try:
+                n = os.writev(self._fd, bufs)
+            except BlockingIOError:
+                return
+            self._written += n
+            while n:
+                buf = self._out[0]
+                if n < len(buf):
+                    self._out[0] = buf[n:]
+                    break
+                n -= len(buf)
+                self._out.popleft()
+
+    def _flush_all(self, end=None):
+        """ Blocks until everything up to end (or everything) is written. """
+        while True:
+            with self._lock:
+                self._flush()
+                if not self._out or (
+                    end is not None and self._written >= end
+                ):
+                    return
+            _wait_fd(self._fd, True, None)
+
+    async def _drain(self, loop):
+        """ Writes queued data as room frees up, until there's none left. """
+        try:
+            while True:
+                await util.wait_writable([self._fd], loop=loop)
+                with self._lock:
+                    self._flush()
+                    self._wake_senders(None)
+                    if not self._out:
+                        self._drainer = None
+                        return
+        except asyncio.CancelledError:
+            with self._lock:
+                self._drainer = None
+                for _, fut in self._send_waiters:
+                    fut.cancel()
+                self._send_waiters.clear()
+            raise
+        except Exception as e:
+            with self._lock:
+                self._drainer = None
+                self._wake_senders(e)
+
+    def _wake_senders(self, error):
+        """ Completes the coro_send_bytes calls whose data was written.
+
+        If error is given, all waiting calls fail with it instead.
+
+        """
+        waiters = self._send_waiters
+        while waiters and (error or waiters[0][0] <= self._written):
+            _, fut = waiters.popleft()
+            if fut.done():
+                continue
+            if error is None:
+                fut.set_result(None)
+            else:
+                fut.set_exception(error)
+
+
+def _converted(data, pool):
+    """ Returns a message as bytes, or if pool is given, as a view from it.
+    """
+    if pool is None:
+        if not isinstance(data, memoryview):
+            return data
+        out = bytes(data)
+        buffers.release(data)
+        return out
+    if isinstance(data, memoryview):
+        if data.obj.pool is pool:
+            return data
+        view = pool.copy(data)
+        buffers.release(data)
+        return view
+    return pool.copy(data)
+
+
+def recv_bytes_pooled(conn, pool, maxlength=None):
+    """ Receive a message from conn into a buffer from pool.
+
+    Returns a memoryview of the message, from pool.acquire(). conn can
+    be a NativeConnection, or a multiprocessing Connection, in which
+    case the message is read straight into the pooled buffer, rather
+    than into a new bytes object first, on POSIX platforms.
+
+    """
+    if isinstance(conn, NativeConnection):
+        return conn.recv_bytes_pooled(pool, maxlength)
+    if not supported or type(conn) is not _connection.Connection:
+        return _converted(conn.recv_bytes(maxlength), pool)
+    conn._check_closed()
+    conn._check_readable()
+    if maxlength is not None and maxlength < 0:
+        raise ValueError("negative maxlength")
+    fd = conn.fileno()
+    size = _read_header(fd)
+    if maxlength is not None and size > maxlength:
+        conn._bad_message_length()
+    view = pool.acquire(size)
+    try:
+        _read_exactly(fd, view, False)
+    except BaseException:
+        buffers.release(view)
+        raise
+    return view
+
+
+def send_buffers(conn, bufs):
+    """ Send the contents of the buffers in bufs over conn as one message.
+
+    conn can be a NativeConnection, or a multiprocessing Connection, in
+    which case the header and the buffers are written with writev on
+    POSIX platforms, rather than being joined into one bytes object.
+
+    """
+    if isinstance(conn, NativeConnection):
+        return conn.send_buffers(bufs)
+    views = [byte_view(buf) for buf in bufs]
+    if not supported or type(conn) is not _connection.Connection:
+        return conn.send_bytes(b"".join(views))
+    conn._check_closed()
+    conn._check_writable()
+    out = deque([memoryview(_frame_header(views))])
+    out.extend(view for view in views if view.nbytes)
+    fd = conn.fileno()
+    while out:
+        n = os.writev(fd, list(itertools.islice(out, _MAX_IOV)))
+        while n:
+            if n < out[0].nbytes:
+                out[0] = out[0][n:]
+                break
+            n -= out.popleft().nbytes
+
+
+def recv_into_buffers(conn, bufs):
+    """ Receive a message from conn, filling the buffers in bufs in turn.
+
+    Returns a list of memoryviews of the bytes of each buffer that were
+    filled. Raises BufferTooShort, holding the message, if the buffers
+    are too small for it. For a multiprocessing Connection, the message
+    is read straight into the buffers with readv on POSIX platforms.
+
+    """
+    views = [memoryview(buf).cast("B") for buf in bufs]
+    if supported and type(conn) is _connection.Connection:
+        conn._check_closed()
+        conn._check_readable()
+        fd = conn.fileno()
+        size = _read_header(fd)
+        if size > sum(view.nbytes for view in views):
+            raise _connection.BufferTooShort(
+                bytes(_read_exactly(fd, bytearray(size), False))
+            )
+        return _readv_exactly(fd, views, size)
+    return scatter(conn.recv_bytes(), views)
+
+
+def scatter(data, bufs):
+    """ Copies data into the buffers in bufs, filling each in turn.
+
+    Returns a list of memoryviews of the bytes of each buffer that were
+    filled. Raises BufferTooShort if data doesn't fit.
+
+    """
+    views = [memoryview(buf).cast("B") for buf in bufs]
+    if len(data) > sum(view.nbytes for view in views):
+        raise _connection.BufferTooShort(bytes(data))
+    data = memoryview(data).cast("B")
+    out = []
+    for view in views:
+        n = min(view.nbytes, data.nbytes)
+        view[:n] = data[:n]
+        data = data[n:]
+        out.append(view[:n])
+    return out
+
+
+def _frame_header(views):
+    """ Returns the header of a message made up of views. """
+    n = sum(view.nbytes for view in views)
+    if n > _MAX_SHORT:
+        return struct.pack(_HEADER, -1) + struct.pack(_LONG_HEADER, n)
+    return struct.pack(_HEADER, n)
+
+
+def _read_header(fd):
+    """ Reads a message header from the blocking fd, and returns the size.
+    """
+    header = _read_exactly(fd, bytearray(_HEADER_SIZE), True)
+    size, = struct.unpack(_HEADER, header)
+    if size == -1:
+        header = _read_exactly(fd, bytearray(_LONG_HEADER_SIZE), False)
+        size, = struct.unpack(_LONG_HEADER, header)
+    return size
+
+
+def _readv_exactly(fd, views, size):
+    """ Reads size bytes from the blocking fd into views, filling each in
+    turn, and returns the filled part of each.
+    """
+    out = []
+    left = size
+    for view in views:
+        n = min(view.nbytes, left)
+        out.append(view[:n])
+        left -= n
+    pending = deque(view for view in out if view.nbytes)
+    while pending:
+        n = os.readv(fd, list(itertools.islice(pending, _MAX_IOV)))
+        if n == 0:
+            raise OSError("got end of file during message")
+        while n:
+            if n < pending[0].nbytes:
+                pending[0] = pending[0][n:]
+                break
+            n -= pending.popleft().nbytes
+    return out
+
+
+def _read_exactly(fd, buf, at_start):
+    """ Fills buf from the blocking file descriptor fd, and returns it. """
+    view = memoryview(buf)
+    got = 0
+    while got < len(view):
+        n = os.readv(fd, [view[got:]])
+        if n == 0:
+            if at_start and got == 0:
+                raise EOFError
+            raise OSError("got end of file during message")
+        got += n
+    return buf
@@ -1,4 +1,15 @@
+import array
+import sys
+import time
 import asyncio
+import weakref
+from collections import deque
+
+try:
+    import fcntl
+    import termios
+except ImportError:  # Windows
+    fcntl = termios = None
 
 
 def run_in_executor(executor, callback, *args, loop=None, **kwargs):
@@ -10,3 +21,267 @@ def run_in_executor(executor, callback, *args, loop=None, **kwargs):
         )
     else:
         return loop.run_in_executor(executor, callback, *args)
+
+
+# How long interruptible calls block in one go, before checking
+# whether they've been cancelled.
+_WAIT_SLICE = 0.1
+
+
+def wait_slices(timeout, cancelled, interval=_WAIT_SLICE):
+    """ Splits a blocking wait of timeout seconds into short slices.
+
+    Yields how long to block for each time around, at most interval
+    seconds, forever if timeout is None, and stops once timeout has
+    passed. Raises CancelledError as soon as the threading.Event
+    cancelled is set, so a thread running a cancelled coroutine's
+    blocking call can get back to the executor.
+
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        if cancelled.is_set():
+            raise asyncio.CancelledError
+        if deadline is None:
+            yield interval
+            continue
+        left = max(deadline - time.monotonic(), 0)
+        if left <= interval:
+            yield left
+            return
+        yield interval
+
+
+def supports_readers(loop):
+    """ Returns True if we can watch file descriptors with the given loop.
+
+    Windows event loops can't watch pipe handles with add_reader, so
+    callers need to fall back to blocking calls in an executor there.
+
+    """
+    return sys.platform != "win32" and hasattr(loop, "add_reader")
+
+
+def bytes_available(fd):
+    """ Returns how many bytes can be read from the pipe fd right now.
+
+    Reading no more than that never blocks, even though the pipe is in
+    blocking mode, which it has to stay in for the other processes
+    sharing it. Only available where supports_readers is.
+
+    """
+    count = array.array("i", [0])
+    fcntl.ioctl(fd, termios.FIONREAD, count, True)
+    return count[0]
+
+
+# loop -> {fd: deque of futures waiting for fd to become readable}
+_read_waiters = weakref.WeakKeyDictionary()
+# loop -> {fd: deque of futures waiting for fd to become writable}
+_write_waiters = weakref.WeakKeyDictionary()
+
+
+def wait_readable(fds, *, loop=None):
+    """ Returns a Future that completes when any of fds becomes readable.
+
+    The result of the Future is the fd that became readable. Only one
+    reader callback is registered per fd and loop, no matter how many
+    waiters there are, so many coroutines can wait on the same pipe
+    concurrently. Each time the fd is reported readable a single waiter
+    is woken, so waiters don't stampede for one message.
+
+    Cancelling the returned Future unregisters the waiter.
+
+    """
+    if not loop:
+        loop = asyncio.get_event_loop()
+    return _wait_fds(
+        fds, loop, _read_waiters, loop.add_reader, loop.remove_reader
+    )
+
+
+def wait_writable(fds, *, loop=None):
+    """ Returns a Future that completes when any of fds becomes writable.
+
+    Works just like wait_readable, but for writing.
+
+    """
+    if not loop:
+        loop = asyncio.get_event_loop()
+    return _wait_fds(
+        fds, loop, _write_waiters, loop.add_writer, loop.remove_writer
+    )
+
+
+def _wait_fds(fds, loop, all_waiters, add, remove):
+    waiters = all_waiters.setdefault(loop, {})
+    fut = loop.create_future()
+
+    def cleanup(fut):
+        for fd in fds:
+            queue = waiters.get(fd)
+            if queue is None:
+                continue
+            try:
+                queue.remove(fut)
+            except ValueError:
+                pass
+            if not queue:
+                _unwatch(loop, waiters, fd, remove)
+
+    for fd in fds:
+        if fd not in waiters:
+            waiters[fd] = deque()
+            add(fd, _on_ready, loop, waiters, fd, remove)
+        waiters[fd].append(fut)
+    fut.add_done_callback(cleanup)
+    return fut
+
+
+def _on_ready(loop, waiters, fd, remove):
+    queue = waiters.get(fd)
+    while queue:
+        waiter = queue.popleft()
+        if not waiter.done():
+            waiter.set_result(fd)
+            break
+    if not queue:
+        _unwatch(loop, waiters, fd, remove)
+
+
+def _unwatch(loop, waiters, fd, remove):
+    waiters.pop(fd, None)
+    if not loop.is_closed():
+        remove(fd)
+
+
+# Marks that a PrefetchIterator has no sentinel.
+_NO_SENTINEL = object()
+
+
+class PrefetchIterator:
+    """ An asynchronous iterator over the results of a fetch coroutine.
+
+    fetch is called with no arguments to get each item, and must return
+    an awaitable. With a prefetch of 0, each step of the iteration just
+    awaits fetch(). Otherwise a background task keeps up to prefetch
+    items fetched ahead of the consumer, so the wait for the next item
+    overlaps with the consumer's processing of the current one.
+
+    Iteration stops when fetch returns an item equal to sentinel (if one
+    was given), or when it raises one of the exceptions in stop_on.
+    Any other exception is raised from the step it was reached on.
+
+    """
+
+    def __init__(
+        self,
+        fetch,
+        prefetch=0,
+        *,
+        sentinel=_NO_SENTINEL,
+        stop_on=(),
+        loop=None
+    ):
+        if prefetch < 0:
+            raise ValueError("prefetch must not be negative")
+        self._fetch = fetch
+        self._prefetch = prefetch
+        self._sentinel = sentinel
+        self._stop_on = tuple(stop_on)
+        self._loop = loop
+        self._items = deque()
+        self._end = None
+        self._task = None
+        self._ready = None
+        self._space = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._end is not None and not self._items:
+            self._raise_end()
+        if not self._prefetch:
+            try:
+                item = await self._fetch()
+            except self._stop_on:
+                self._end = StopAsyncIteration()
+                raise StopAsyncIteration
+            if self._is_sentinel(item):
+                self._end = StopAsyncIteration()
+                raise StopAsyncIteration
+            return item
+        if self._task is None:
+            self._start()
+        while not self._items:
+            if self._end is not None:
+                self._raise_end()
+            self._ready.clear()
+            await self._ready.wait()
+        self._space.release()
+        return self._items.popleft()
+
+    async def aclose(self):
+        """ Stop fetching items ahead.
+
+        Returns a list of the items that were prefetched, but never
+        handed to the consumer, so they can be dealt with rather than
+        lost. An item that was being fetched when aclose was called may
+        still be lost if fetch can't be cancelled cleanly.
+
+        """
+        if self._end is None:
+            self._end = StopAsyncIteration()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        items = list(self._items)
+        self._items.clear()
+        return items
+
+    def _start(self):
+        loop = self._loop if self._loop else asyncio.get_event_loop()
+        # Before 3.10, asyncio's primitives bind to the default loop
+        # unless they're given one.
+        kwargs = {"loop": loop} if sys.version_info < (3, 10) else {}
+        self._ready = asyncio.Event(**kwargs)
+        self._space = asyncio.Semaphore(self._prefetch, **kwargs)
+        self._task = asyncio.ensure_future(self._run(), loop=loop)
+
+    async def _run(self):
+        try:
+            while True:
+                await self._space.acquire()
+                item = await self._fetch()
+                if self._is_sentinel(item):
+                    break
+                self._items.append(item)
+                self._ready.set()
+        except self._stop_on:
+            pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._end = e
+        finally:
+            if self._end is None:
+                self._end = StopAsyncIteration()
+            self._ready.set()
+
+    def _raise_end(self):
+        end = self._end
+        # An error is only raised once; iteration is over after that.
+        self._end = StopAsyncIteration()
+        raise end
+
+    def _is_sentinel(self, item):
+        sentinel = self._sentinel
+        if sentinel is _NO_SENTINEL:
+            return False
+        return item is sentinel or (
+            type(item) is type(sentinel) and item == sentinel
+        )
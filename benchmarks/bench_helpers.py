@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+
+""" Benchmark the module-level helpers in aioprocessing.connection.
+
+Measures calls per second for coro_wait, and for a full
+coro_deliver_challenge/coro_answer_challenge handshake, and how many
+threads are alive afterwards. The "per-call executor" rows run the same
+calls the way the helpers used to, with a new ThreadPoolExecutor for
+every call, for comparison.
+
+Usage:
+  python3 benchmarks/bench_helpers.py [calls]
+
+"""
+
+import asyncio
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aioprocessing
+from aioprocessing import connection
+from aioprocessing.mp import connection as mp_connection
+
+AUTHKEY = b"benchmark"
+
+
+def per_call_executor(func, *args):
+    executor = ThreadPoolExecutor(max_workers=1)
+    return asyncio.get_event_loop().run_in_executor(executor, func, *args)
+
+
+async def bench_wait(wait, calls):
+    conn1, conn2 = aioprocessing.AioPipe()
+    conn1.send_bytes(b"x")
+    for _ in range(calls):
+        await wait([conn2])
+
+
+async def bench_challenge(deliver, answer, calls, native=False):
+    conn1, conn2 = aioprocessing.AioPipe(native=native)
+    for _ in range(calls):
+        await asyncio.gather(
+            deliver(conn1, AUTHKEY),
+            answer(conn2, AUTHKEY),
+        )
+        await asyncio.gather(
+            deliver(conn2, AUTHKEY),
+            answer(conn1, AUTHKEY),
+        )
+
+
+def report(name, coro, calls):
+    loop = asyncio.get_event_loop()
+    start = time.perf_counter()
+    loop.run_until_complete(coro)
+    elapsed = time.perf_counter() - start
+    print(
+        "{:<40} {:>10.0f} calls/s {:>6} threads".format(
+            name, calls / elapsed, threading.active_count()
+        )
+    )
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    report(
+        "coro_wait, per-call executor",
+        bench_wait(
+            lambda objs: per_call_executor(mp_connection.wait, objs), calls
+        ),
+        calls,
+    )
+    report("coro_wait", bench_wait(connection.coro_wait, calls), calls)
+    report(
+        "handshake, per-call executor",
+        bench_challenge(
+            lambda conn, key: per_call_executor(
+                mp_connection.deliver_challenge, conn, key
+            ),
+            lambda conn, key: per_call_executor(
+                mp_connection.answer_challenge, conn, key
+            ),
+            calls // 10,
+        ),
+        calls // 10,
+    )
+    report(
+        "handshake, shared executor",
+        bench_challenge(
+            connection.coro_deliver_challenge,
+            connection.coro_answer_challenge,
+            calls // 10,
+        ),
+        calls // 10,
+    )
+    report(
+        "handshake, native=True",
+        bench_challenge(
+            connection.coro_deliver_challenge,
+            connection.coro_answer_challenge,
+            calls // 10,
+            native=True,
+        ),
+        calls // 10,
+    )
+
+
+if __name__ == "__main__":
+    main()
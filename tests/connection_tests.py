@@ -1,9 +1,25 @@
+import asyncio
+import functools
+import marshal
+import threading
 import unittest
+from unittest import mock
 from array import array
 
 import aioprocessing
 import aioprocessing.mp as multiprocessing
-from aioprocessing.connection import AioConnection, AioListener, AioClient
+from aioprocessing.connection import (
+    AioClient,
+    AioClientPool,
+    AioConnection,
+    AioListener,
+    coro_answer_challenge,
+    coro_deliver_challenge,
+    coro_wait,
+)
+from aioprocessing.executor import shared_executor
+from aioprocessing import serialization, transport
+from aioprocessing.buffers import BufferPool
 from aioprocessing.mp import Process
 
 from ._base_test import BaseTest
@@ -13,6 +29,45 @@ def conn_send(conn, val):
     conn.send(val)
 
 
+def conn_send_all(conn, vals):
+    for val in vals:
+        conn.send(val)
+    conn.close()
+
+
+def conn_send_stream(conn, count, size):
+    conn.send_stream(
+        (bytes([i % 256]) * size for i in range(count)), chunk_size=1000
+    )
+
+
+def conn_send_oob(conn, val):
+    conn.send_oob(val, threshold=1024)
+
+
+def conn_echo(conn, n):
+    for _ in range(n):
+        conn.send_bytes(conn.recv_bytes())
+    conn.close()
+
+
+def conn_echo_pipelined(conn, other_end):
+    other_end.close()
+    loop = asyncio.new_event_loop()
+
+    async def echo():
+        data = await conn.coro_recv_bytes(loop=loop)
+        # The next receive starts before the reply is sent.
+        received = conn.coro_recv_bytes(loop=loop)
+        await conn.coro_send_bytes(data, loop=loop)
+        data = await received
+        await conn.coro_send_bytes(data, loop=loop)
+
+    loop.run_until_complete(echo())
+    loop.close()
+    conn.close()
+
+
 def client_sendback(event, address, authkey):
     event.wait()
     conn = multiprocessing.connection.Client(address, authkey=authkey)
@@ -44,6 +99,704 @@ class PipeTest(BaseTest):
 
         self.loop.run_until_complete(conn_recv())
 
+    @unittest.skipIf(
+        not serialization.oob_supported, "Requires pickle protocol 5"
+    )
+    def test_pipe_oob(self):
+        conn1, conn2 = aioprocessing.AioPipe()
+        val = {"data": b"a" * 2048, "view": memoryview(b"b" * (1 << 17))}
+        p = Process(target=conn_send_oob, args=(conn1, val))
+        p.start()
+
+        async def conn_recv():
+            return await conn2.coro_recv_oob()
+
+        out = self.loop.run_until_complete(conn_recv())
+        p.join()
+        self.assertEqual(out, val)
+
+    def test_pipe_iterate(self):
+        conn1, conn2 = aioprocessing.AioPipe()
+        p = Process(target=conn_send_all, args=(conn1, list(range(10))))
+        p.start()
+        conn1.close()
+
+        async def conn_recv():
+            out = []
+            async for val in conn2.iterate(prefetch=3):
+                out.append(val)
+            return out
+
+        out = self.loop.run_until_complete(conn_recv())
+        p.join()
+        self.assertEqual(out, list(range(10)))
+
+    def test_pipe_serializer(self):
+        conn1, conn2 = aioprocessing.AioPipe(serializer="marshal")
+        val = {"a": [1, 2.5, "c"]}
+        p = Process(target=conn_send, args=(conn1, val))
+        p.start()
+
+        async def conn_recv():
+            return await conn2.coro_recv()
+
+        self.assertEqual(self.loop.run_until_complete(conn_recv()), val)
+        p.join()
+        # The other end really got marshal data.
+        conn1.send(val)
+        self.assertEqual(marshal.loads(conn2.recv_bytes()), val)
+
+    def test_pipe_compression(self):
+        conn1, conn2 = aioprocessing.AioPipe(compression="zlib")
+        val = {"data": "abc" * 10000}
+        p = Process(target=conn_send, args=(conn1, val))
+        p.start()
+
+        async def conn_recv():
+            return await conn2.coro_recv()
+
+        self.assertEqual(self.loop.run_until_complete(conn_recv()), val)
+        p.join()
+
+        # Large frames go over the wire compressed, small ones don't.
+        conn1.send_bytes(b"x" * 100000)
+        frame = conn2._obj.recv_bytes()
+        self.assertEqual(frame[0], 1)
+        self.assertLess(len(frame), 1000)
+        conn1.send_bytes(b"small")
+        self.assertEqual(conn2._obj.recv_bytes(), b"\x00small")
+
+    def test_compressed_bytes(self):
+        conn1, conn2 = aioprocessing.AioPipe(
+            compression="zlib", compression_threshold=16
+        )
+        arr = array("i", range(100))
+
+        async def send_recv():
+            await conn1.coro_send_bytes(arr, 10, 20)
+            return await conn2.coro_recv_bytes()
+
+        out = self.loop.run_until_complete(send_recv())
+        self.assertEqual(out, arr[10:30].tobytes())
+        conn1.send_bytes(arr)
+        into = array("i", [0] * 110)
+        self.assertEqual(conn2.recv_bytes_into(into, 10), 100)
+        self.assertEqual(into[10:].tolist(), list(range(100)))
+        conn1.send_bytes(arr)
+        with self.assertRaises(multiprocessing.BufferTooShort):
+            conn2.recv_bytes_into(array("i", [0] * 10))
+
+    def test_bad_compression(self):
+        with self.assertRaises(ValueError):
+            aioprocessing.AioPipe(compression="rot13")
+
+    def test_decompress_bad_frames(self):
+        with self.assertRaises(ValueError):
+            serialization.decompress_frame(b"")
+        with self.assertRaises(ValueError):
+            serialization.decompress_frame(b"\x7fxyz")
+        frame = serialization.compress_frame(b"x" * 100000, "zlib")
+        with self.assertRaises(ValueError):
+            serialization.decompress_frame(frame[:-10])
+
+    def test_decompress_bounded(self):
+        sizes = []
+
+        class Recorder:
+            def __init__(self, decompressor):
+                self._decompressor = decompressor
+                self.eof = False
+
+            def decompress(self, data, *args):
+                out = self._decompressor.decompress(data, *args)
+                self.eof = self._decompressor.eof
+                sizes.append(len(out))
+                return out
+
+        for compression in sorted(serialization._COMPRESSORS):
+            frame = serialization.compress_frame(b"x" * 100000, compression)
+            real = serialization._DECOMPRESSORS[frame[0]]
+            self.assertEqual(
+                len(serialization.decompress_frame(frame, 100000)), 100000
+            )
+            del sizes[:]
+            with mock.patch.dict(
+                serialization._DECOMPRESSORS,
+                {frame[0]: lambda: Recorder(real())},
+            ):
+                with self.assertRaises(OSError):
+                    serialization.decompress_frame(frame, 1000)
+            # Only just past the limit was decompressed, not the lot.
+            self.assertEqual(sizes, [1001])
+
+    def test_compressed_maxlength(self):
+        conn1, conn2 = aioprocessing.AioPipe(compression="zlib")
+        conn1.send_bytes(b"x" * 100000)
+        with self.assertRaises(OSError):
+            conn2.recv_bytes(maxlength=1000)
+
+        async def send_recv():
+            await conn1.coro_send_bytes(b"x" * 100000)
+            return await conn2.coro_recv_bytes(1000)
+
+        with self.assertRaises(OSError):
+            self.loop.run_until_complete(send_recv())
+
+    def test_cancelled_recv(self):
+        conn1, conn2 = aioprocessing.AioPipe()
+
+        async def cancel_then_send():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(conn2.coro_recv(), 0.05)
+            conn1.send("msg")
+            return await asyncio.wait_for(conn2.coro_recv(), 2)
+
+        self.assertEqual(
+            self.loop.run_until_complete(cancel_then_send()), "msg"
+        )
+
+
+@unittest.skipIf(not transport.supported, "Not supported on Windows")
+class NativeConnectionTest(BaseTest):
+    def test_native_plain_peer(self):
+        raw1, raw2 = multiprocessing.Pipe()
+        conn = AioConnection(raw1, native=True)
+        vals = [1, "two", b"x" * (1 << 20), {"four": [4]}, None]
+        p = Process(target=conn_echo, args=(raw2, len(vals) + 2))
+        p.start()
+        raw2.close()
+
+        async def echo():
+            out = []
+            for val in vals:
+                await conn.coro_send(val)
+                out.append(await conn.coro_recv())
+            await conn.coro_send_bytes(b"abcdef", 1, 3)
+            out.append(await conn.coro_recv_bytes())
+            await conn.coro_send_bytes(b"")
+            self.assertTrue(await conn.coro_poll(2))
+            out.append(await conn.coro_recv_bytes())
+            with self.assertRaises(EOFError):
+                await conn.coro_recv()
+            return out
+
+        out = self.loop.run_until_complete(echo())
+        p.join()
+        self.assertEqual(out, vals + [b"bcd", b""])
+
+    def test_native_close_shared(self):
+        # Closing a native connection in one process mustn't make its
+        # fd blocking for another process that has it open too.
+        conn1, conn2 = aioprocessing.AioPipe(native=True)
+        p = Process(target=conn_echo_pipelined, args=(conn2, conn1))
+        p.daemon = True
+        p.start()
+        conn2.close()
+
+        async def echo():
+            out = []
+            for i in range(2):
+                await conn1.coro_send_bytes(b"x" * i)
+                out.append(await conn1.coro_recv_bytes())
+            return out
+
+        out = self.loop.run_until_complete(
+            asyncio.wait_for(echo(), 10)
+        )
+        p.join()
+        self.assertEqual(out, [b"", b"x"])
+
+    def test_native_sync(self):
+        conn1, conn2 = aioprocessing.AioPipe(native=True)
+        conn1.send_bytes(array("i", range(100)))
+        self.assertTrue(conn2.poll(1))
+        into = array("i", [0] * 110)
+        self.assertEqual(conn2.recv_bytes_into(into, 10), 100)
+        self.assertEqual(into[10:].tolist(), list(range(100)))
+        self.assertFalse(conn2.poll())
+        conn1.send("a")
+        with self.assertRaises(OSError):
+            conn2.recv_bytes(maxlength=1)
+
+    def test_native_options(self):
+        conn1, conn2 = aioprocessing.AioPipe(
+            native=True, compression="zlib", serializer="marshal"
+        )
+        val = {"data": "abc" * 10000}
+
+        async def send_recv():
+            await conn1.coro_send(val)
+            return await conn2.coro_recv()
+
+        self.assertEqual(self.loop.run_until_complete(send_recv()), val)
+        conn2.send(val)
+        self.assertEqual(conn1.recv(), val)
+
+    def test_native_cancelled(self):
+        conn1, conn2 = aioprocessing.AioPipe(native=True)
+        # Big enough to fill the pipe, so it's written in pieces.
+        big = b"y" * (4 << 20)
+
+        async def cancel_then_send():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(conn2.coro_recv_bytes(), 0.05)
+            send = conn1.coro_send_bytes(big)
+            await asyncio.sleep(0.01)
+            send.cancel()
+            first = await asyncio.wait_for(conn2.coro_recv_bytes(), 2)
+            await conn1.coro_send_bytes(b"next")
+            return first, await asyncio.wait_for(conn2.coro_recv_bytes(), 2)
+
+        first, second = self.loop.run_until_complete(cancel_then_send())
+        self.assertEqual(first, big)
+        self.assertEqual(second, b"next")
+
+    def test_native_pickle(self):
+        conn1, conn2 = aioprocessing.AioPipe(native=True)
+        p = Process(target=conn_send, args=(conn1, 25))
+        p.start()
+        out = self.loop.run_until_complete(conn2.coro_recv(loop=self.loop))
+        self.assertEqual(out, 25)
+        p.join()
+
+    def test_native_select(self):
+        conn1, conn2 = aioprocessing.AioPipe(native=True)
+        conn1.send("a")
+        self.assertTrue(conn2.poll())
+        ready = self.loop.run_until_complete(
+            aioprocessing.coro_select(conn2, timeout=0, loop=self.loop)
+        )
+        self.assertEqual(ready, [conn2])
+        self.assertEqual(conn2.recv(), "a")
+
+
+class BufferPoolTest(unittest.TestCase):
+    def test_reuse(self):
+        pool = BufferPool(min_size=1024, max_size=1 << 16, max_buffers=1)
+        view = pool.acquire(1500)
+        self.assertEqual(len(view), 1500)
+        buf = view.obj
+        pool.release(view)
+        self.assertEqual(pool.free_buffers(), 1)
+        again = pool.acquire(2048)
+        self.assertIs(again.obj, buf)
+        self.assertEqual(pool.free_buffers(), 0)
+        other = pool.acquire(2000)
+        self.assertIsNot(other.obj, buf)
+        pool.release(again)
+        pool.release(other)
+        # Only max_buffers free buffers are kept per size class.
+        self.assertEqual(pool.free_buffers(), 1)
+
+    def test_release_errors(self):
+        pool = BufferPool()
+        view = pool.acquire(10)
+        pool.release(view)
+        with self.assertRaises(ValueError):
+            pool.release(view)
+        with self.assertRaises(ValueError):
+            pool.release(memoryview(bytearray(10)))
+        with self.assertRaises(ValueError):
+            BufferPool().release(pool.acquire(10))
+
+    def test_oversized(self):
+        pool = BufferPool(min_size=512, max_size=1024)
+        view = pool.acquire(5000)
+        self.assertEqual(len(view.obj), 5000)
+        pool.release(view)
+        self.assertEqual(pool.free_buffers(), 0)
+
+
+class PooledRecvTest(BaseTest):
+    def _check_pooled(self, **kwargs):
+        conn1, conn2 = aioprocessing.AioPipe(**kwargs)
+        pool = BufferPool(min_size=1024)
+        frames = [b"a" * 3000, b"", b"b" * (1 << 20)]
+
+        async def recv():
+            out = []
+            for frame in frames:
+                sent = self.loop.run_in_executor(None, conn1.send_bytes, frame)
+                view = await conn2.coro_recv_bytes_pooled(pool, loop=self.loop)
+                await sent
+                out.append(bytes(view))
+                pool.release(view)
+            return out
+
+        self.assertEqual(self.loop.run_until_complete(recv()), frames)
+        self.assertGreaterEqual(pool.free_buffers(), 3)
+        conn1.send_bytes(frames[0])
+        view = conn2.recv_bytes_pooled(pool)
+        self.assertEqual(view, frames[0])
+        conn1.send_bytes(frames[0])
+        with self.assertRaises(OSError):
+            conn2.recv_bytes_pooled(pool, maxlength=10)
+
+    def test_pooled(self):
+        self._check_pooled()
+
+    def test_pooled_compression(self):
+        self._check_pooled(compression="zlib", compression_threshold=2048)
+
+    @unittest.skipIf(not transport.supported, "Not supported on Windows")
+    def test_pooled_native(self):
+        self._check_pooled(native=True)
+
+    def test_pooled_cancelled(self):
+        conn1, conn2 = aioprocessing.AioPipe()
+        pool = BufferPool()
+
+        async def cancel_then_send():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    conn2.coro_recv_bytes_pooled(pool), 0.05
+                )
+            conn1.send_bytes(b"msg")
+            return await asyncio.wait_for(
+                conn2.coro_recv_bytes_pooled(pool), 2
+            )
+
+        view = self.loop.run_until_complete(cancel_then_send())
+        self.assertEqual(view, b"msg")
+        pool.release(view)
+
+
+class _AsyncChunks:
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(0)
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class StreamTest(BaseTest):
+    def _check_stream(self, **kwargs):
+        conn1, conn2 = aioprocessing.AioPipe(**kwargs)
+        p = Process(target=conn_send_stream, args=(conn1, 50, 2500))
+        p.start()
+
+        async def recv():
+            sizes = set()
+            data = bytearray()
+            async for chunk in conn2.coro_recv_stream(loop=self.loop):
+                sizes.add(len(chunk))
+                data += chunk
+            return sizes, data
+
+        sizes, data = self.loop.run_until_complete(recv())
+        p.join()
+        self.assertEqual(sizes, {1000, 500})
+        self.assertEqual(
+            data, b"".join(bytes([i]) * 2500 for i in range(50))
+        )
+
+        def recv_sync():
+            return [b"".join(conn1.recv_stream()) for _ in range(2)]
+
+        async def send():
+            received = self.loop.run_in_executor(None, recv_sync)
+            await conn2.coro_send_stream(
+                _AsyncChunks([b"x" * i for i in range(5)]),
+                chunk_size=3,
+                loop=self.loop,
+            )
+            await conn2.coro_send_stream([array("i", [1, 2])], loop=self.loop)
+            return await received
+
+        self.assertEqual(
+            self.loop.run_until_complete(send()),
+            [b"x" * 10, array("i", [1, 2]).tobytes()],
+        )
+
+    def test_stream(self):
+        self._check_stream()
+
+    def test_stream_compression(self):
+        self._check_stream(compression="zlib", compression_threshold=100)
+
+    @unittest.skipIf(not transport.supported, "Not supported on Windows")
+    def test_stream_native(self):
+        self._check_stream(native=True)
+
+    def test_stream_abort(self):
+        conn1, conn2 = aioprocessing.AioPipe()
+
+        def gen():
+            yield b"data"
+            raise ValueError("oops")
+
+        with self.assertRaises(ValueError):
+            conn1.send_stream(gen())
+
+        async def recv():
+            chunks = []
+            async for chunk in conn2.coro_recv_stream(
+                prefetch=2, loop=self.loop
+            ):
+                chunks.append(chunk)
+            return chunks
+
+        with self.assertRaisesRegex(OSError, "ValueError: oops"):
+            self.loop.run_until_complete(recv())
+        conn1.send_bytes(b"after")
+        self.assertEqual(conn2.recv_bytes(), b"after")
+
+        with self.assertRaises(TypeError):
+            conn1.send_stream([b"ok", "not bytes"])
+        with self.assertRaisesRegex(OSError, "TypeError"):
+            list(conn2.recv_stream())
+
+        async def send_bad():
+            with self.assertRaises(TypeError):
+                await conn1.coro_send_stream([b"ok", 1.5], loop=self.loop)
+            with self.assertRaisesRegex(OSError, "TypeError"):
+                await recv()
+
+        self.loop.run_until_complete(send_bad())
+
+
+class ScatterGatherTest(BaseTest):
+    def _check_buffers(self, **kwargs):
+        conn1, conn2 = aioprocessing.AioPipe(**kwargs)
+        header = b"head"
+        payload = array("i", range(300000))
+        parts = [header, b"", payload, memoryview(b"tail")]
+        whole = b"".join(bytes(part) for part in parts)
+
+        async def send_recv():
+            sent = conn1.coro_send_buffers(parts, loop=self.loop)
+            got = await conn2.coro_recv_bytes(loop=self.loop)
+            await sent
+            self.assertEqual(got, whole)
+            into = [bytearray(4), bytearray(len(whole))]
+            sent = conn1.coro_send_buffers(parts, loop=self.loop)
+            views = await conn2.coro_recv_into_buffers(into, loop=self.loop)
+            await sent
+            return views
+
+        views = self.loop.run_until_complete(send_recv())
+        self.assertEqual([len(v) for v in views], [4, len(whole) - 4])
+        self.assertEqual(views[0], header)
+        self.assertEqual(bytes(views[1]), whole[4:])
+
+        # More buffers than fit in one writev call.
+        many = [bytes([i]) * 10 for i in range(200)]
+        conn1.send_buffers(many)
+        self.assertEqual(conn2.recv_bytes(), b"".join(many))
+        conn1.send_buffers([])
+        self.assertEqual(conn2.recv_into_buffers([bytearray(1)]), [b""])
+        conn1.send_buffers([header, header])
+        with self.assertRaises(multiprocessing.BufferTooShort) as e:
+            conn2.recv_into_buffers([bytearray(3), bytearray(3)])
+        self.assertEqual(e.exception.args[0], header * 2)
+
+    def test_buffers(self):
+        self._check_buffers()
+
+    def test_buffers_compression(self):
+        self._check_buffers(compression="zlib", compression_threshold=100)
+
+    @unittest.skipIf(not transport.supported, "Not supported on Windows")
+    def test_buffers_native(self):
+        self._check_buffers(native=True)
+
+    def test_buffers_plain_peer(self):
+        raw1, raw2 = multiprocessing.Pipe()
+        conn = AioConnection(raw2)
+        raw1.send_bytes(b"abcdef")
+        into = [bytearray(2), array("b", [0] * 10)]
+        views = conn.recv_into_buffers(into)
+        self.assertEqual([bytes(v) for v in views], [b"ab", b"cdef"])
+        self.assertEqual(into[1][:4].tobytes(), b"cdef")
+        conn.send_buffers([b"x", b"yz"])
+        self.assertEqual(raw1.recv_bytes(), b"xyz")
+
+        async def cancel_then_send():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    conn.coro_recv_into_buffers([bytearray(10)]), 0.05
+                )
+            raw1.send_bytes(b"msg")
+            return await asyncio.wait_for(conn.coro_recv_bytes(), 2)
+
+        self.assertEqual(
+            self.loop.run_until_complete(cancel_then_send()), b"msg"
+        )
+
+    def test_compress_frames(self):
+        parts = [b"a" * 5000, array("i", range(1000)), b"xyz"]
+        whole = b"".join(bytes(part) for part in parts)
+        frame = serialization.compress_frames(parts, "zlib")
+        self.assertLess(sum(len(f) for f in frame), len(whole))
+        self.assertEqual(
+            serialization.decompress_frame(b"".join(frame)), whole
+        )
+        self.assertEqual(
+            serialization.compress_frames([b"ab"], "zlib"), [b"\x00", b"ab"]
+        )
+
+
+class SelectTest(BaseTest):
+    def test_select(self):
+        conns = [aioprocessing.AioPipe() for _ in range(20)]
+        queues = [aioprocessing.AioQueue() for _ in range(20)]
+        raw1, raw2 = multiprocessing.Pipe()
+        sources = [c2 for _, c2 in conns] + queues + [raw2]
+
+        async def select():
+            self.assertEqual(
+                await aioprocessing.coro_select(*sources, timeout=0.05), []
+            )
+            conns[3][0].send("a")
+            queues[7].put("b")
+            raw1.send("c")
+            ready = await aioprocessing.coro_select(*sources, timeout=2)
+            while len(ready) < 3:
+                await asyncio.sleep(0.01)
+                ready = await aioprocessing.coro_select(*sources)
+            return ready
+
+        ready = self.loop.run_until_complete(select())
+        self.assertEqual(ready, [conns[3][1], queues[7], raw2])
+        # Nothing was taken off the sources.
+        self.assertEqual(conns[3][1].recv(), "a")
+        self.assertEqual(queues[7].get(), "b")
+        self.assertEqual(raw2.recv(), "c")
+
+    def test_select_waits(self):
+        conn1, conn2 = aioprocessing.AioPipe()
+        queue = aioprocessing.AioPriorityQueue()
+
+        async def select():
+            fut = aioprocessing.coro_select(conn2, queue)
+            await asyncio.sleep(0.05)
+            self.assertFalse(fut.done())
+            queue.put((1, "x"))
+            return await asyncio.wait_for(fut, 2)
+
+        self.assertEqual(self.loop.run_until_complete(select()), [queue])
+        self.assertEqual(queue.get(), (1, "x"))
+
+    def test_select_closed(self):
+        conn1, conn2 = aioprocessing.AioPipe()
+        conn1.close()
+        ready = self.loop.run_until_complete(
+            aioprocessing.coro_select(conn2, loop=self.loop)
+        )
+        self.assertEqual(ready, [conn2])
+        with self.assertRaises(EOFError):
+            conn2.recv()
+
+    def test_select_executor(self):
+        conn1, conn2 = aioprocessing.AioPipe()
+        queue = aioprocessing.AioQueue()
+
+        async def select():
+            fut = aioprocessing.coro_select(conn2, queue)
+            await asyncio.sleep(0.05)
+            conn1.send("msg")
+            return await asyncio.wait_for(fut, 2)
+
+        with mock.patch(
+            "aioprocessing.connection.supports_readers", return_value=False
+        ):
+            ready = self.loop.run_until_complete(select())
+        self.assertEqual(ready, [conn2])
+
+    def test_select_bad_source(self):
+        with self.assertRaises(TypeError):
+            aioprocessing.coro_select(object(), loop=self.loop)
+
+    def test_select_cancelled(self):
+        conn1, conn2 = aioprocessing.AioPipe()
+
+        async def select():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(aioprocessing.coro_select(conn2), 0.05)
+            conn1.send("msg")
+            return await asyncio.wait_for(conn2.coro_recv(), 2)
+
+        self.assertEqual(self.loop.run_until_complete(select()), "msg")
+
+
+class HelperTest(BaseTest):
+    def test_coro_wait(self):
+        raw1, raw2 = multiprocessing.Pipe()
+        conn1, conn2 = aioprocessing.AioPipe()
+
+        async def wait():
+            self.assertEqual(
+                await coro_wait([raw2, conn2], 0.05), []
+            )
+            fut = coro_wait([raw2, conn2])
+            await asyncio.sleep(0.01)
+            conn1.send("a")
+            return await asyncio.wait_for(fut, 2)
+
+        self.assertEqual(self.loop.run_until_complete(wait()), [conn2])
+        with mock.patch(
+            "aioprocessing.connection.supports_readers", return_value=False
+        ):
+            ready = self.loop.run_until_complete(
+                coro_wait([raw2, conn2], 1, loop=self.loop)
+            )
+        self.assertEqual(ready, [conn2])
+
+    def test_challenge(self):
+        authkey = b"abcdefg"
+        for native in (False, True):
+            raw, conn = multiprocessing.Pipe()
+            conn = AioConnection(conn, native=native)
+
+            def answer():
+                multiprocessing.connection.answer_challenge(raw, authkey)
+                multiprocessing.connection.deliver_challenge(raw, authkey)
+
+            async def deliver():
+                answered = self.loop.run_in_executor(None, answer)
+                await coro_deliver_challenge(conn, authkey)
+                await coro_answer_challenge(conn, authkey)
+                await answered
+
+            self.loop.run_until_complete(deliver())
+
+            def answer_wrong():
+                with self.assertRaises(multiprocessing.AuthenticationError):
+                    multiprocessing.connection.answer_challenge(raw, b"x")
+
+            async def deliver_wrong():
+                answered = self.loop.run_in_executor(None, answer_wrong)
+                with self.assertRaises(multiprocessing.AuthenticationError):
+                    await coro_deliver_challenge(conn, authkey)
+                await answered
+
+            self.loop.run_until_complete(deliver_wrong())
+
+    def test_no_thread_per_call(self):
+        conn1, conn2 = aioprocessing.AioPipe()
+        conn1.send("a")
+
+        async def wait_many():
+            for _ in range(100):
+                await coro_wait([conn2])
+
+        before = threading.active_count()
+        with mock.patch(
+            "aioprocessing.connection.supports_readers", return_value=False
+        ):
+            self.loop.run_until_complete(wait_many())
+        self.assertLessEqual(
+            threading.active_count() - before,
+            shared_executor()._max_workers,
+        )
+
 
 class ListenerTest(BaseTest):
     def test_listener(self):
@@ -99,6 +852,221 @@ class ListenerTest(BaseTest):
         self.loop.run_until_complete(do_work())
         p.join()
 
+    def _serve_clients(self, listener, handler, clients, **kwargs):
+        errors = []
+        self.loop.set_exception_handler(
+            lambda loop, context: errors.append(context["exception"])
+        )
+
+        async def serve():
+            server = listener.coro_serve(handler, loop=self.loop, **kwargs)
+            try:
+                return await asyncio.gather(
+                    *[
+                        self.loop.run_in_executor(None, client)
+                        for client in clients
+                    ]
+                )
+            finally:
+                server.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await server
+
+        return self.loop.run_until_complete(serve()), errors
+
+    def test_serve(self):
+        authkey = b"abcdefg"
+        listener = AioListener(
+            ("localhost", 0), authkey=authkey, backlog=32
+        )
+        active = []
+        most_active = []
+
+        async def handler(conn):
+            active.append(conn)
+            most_active.append(len(active))
+            val = await conn.coro_recv()
+            await asyncio.sleep(0.01)
+            await conn.coro_send(val * 2)
+            active.remove(conn)
+
+        def client(val, authkey=authkey):
+            conn = multiprocessing.connection.Client(
+                listener.address, authkey=authkey
+            )
+            conn.send(val)
+            return conn.recv()
+
+        def bad_client():
+            with self.assertRaises(multiprocessing.AuthenticationError):
+                client(0, b"wrong")
+
+        try:
+            clients = [functools.partial(client, i) for i in range(20)]
+            out, errors = self._serve_clients(
+                listener, handler, clients + [bad_client], max_concurrency=5
+            )
+        finally:
+            listener.close()
+        self.assertEqual(out[:-1], [i * 2 for i in range(20)])
+        self.assertLessEqual(max(most_active), 5)
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], multiprocessing.AuthenticationError)
+
+    def test_serve_native_no_authkey(self):
+        listener = AioListener(("localhost", 0), native=True)
+
+        async def handler(conn):
+            await conn.coro_send_bytes(await conn.coro_recv_bytes())
+
+        def client():
+            conn = multiprocessing.connection.Client(listener.address)
+            conn.send_bytes(b"ping")
+            return conn.recv_bytes()
+
+        try:
+            out, errors = self._serve_clients(listener, handler, [client])
+        finally:
+            listener.close()
+        self.assertEqual(out, [b"ping"])
+        self.assertEqual(errors, [])
+
+    def test_serve_executor(self):
+        authkey = b"abcdefg"
+        listener = AioListener(
+            ("localhost", 0), authkey=authkey, backlog=32
+        )
+
+        async def handler(conn):
+            await conn.coro_send(await conn.coro_recv() + 1)
+
+        def client(val):
+            conn = multiprocessing.connection.Client(
+                listener.address, authkey=authkey
+            )
+            conn.send(val)
+            return conn.recv()
+
+        try:
+            with mock.patch(
+                "aioprocessing.connection.supports_readers",
+                return_value=False,
+            ):
+                out, errors = self._serve_clients(
+                    listener,
+                    handler,
+                    [functools.partial(client, i) for i in range(3)],
+                )
+        finally:
+            listener.close()
+        self.assertEqual(out, [1, 2, 3])
+        self.assertEqual(errors, [])
+
+    def test_client_pool(self):
+        authkey = b"abcdefg"
+        listener = AioListener(
+            ("localhost", 0), authkey=authkey, backlog=32
+        )
+        served = []
+        active = []
+        most_active = []
+
+        async def handler(conn):
+            served.append(conn)
+            try:
+                while True:
+                    val = await conn.coro_recv()
+                    if val == "hang up":
+                        return
+                    active.append(val)
+                    most_active.append(len(active))
+                    await asyncio.sleep(0.01)
+                    active.remove(val)
+                    await conn.coro_send(val * 2)
+            except EOFError:
+                pass
+
+        pool = AioClientPool(listener.address, authkey=authkey, max_size=2)
+
+        async def request(val):
+            async with pool.connection(loop=self.loop) as conn:
+                await conn.coro_send(val)
+                return await conn.coro_recv()
+
+        async def failing_request():
+            with self.assertRaises(ZeroDivisionError):
+                async with pool.connection(loop=self.loop) as conn:
+                    await conn.coro_send(1)
+                    1 / 0
+
+        async def run():
+            server = listener.coro_serve(handler, loop=self.loop)
+            try:
+                for i in range(5):
+                    self.assertEqual(await request(i), i * 2)
+                self.assertEqual(len(served), 1)
+                self.assertEqual(pool.idle_connections(), 1)
+                out = await asyncio.gather(*[request(i) for i in range(6)])
+                self.assertEqual(out, [i * 2 for i in range(6)])
+                self.assertEqual(len(served), 2)
+                self.assertLessEqual(max(most_active), 2)
+                # A connection released after an error isn't reused.
+                await failing_request()
+                self.assertEqual(pool.idle_connections(), 1)
+                # Nor is one the listener has hung up on.
+                async with pool.connection(loop=self.loop) as conn:
+                    await conn.coro_send("hang up")
+                await asyncio.sleep(0.05)
+                self.assertEqual(await request(3), 6)
+                self.assertEqual(len(served), 3)
+            finally:
+                server.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await server
+
+        try:
+            with pool:
+                self.loop.run_until_complete(run())
+            self.assertEqual(pool.idle_connections(), 0)
+            with self.assertRaises(OSError):
+                self.loop.run_until_complete(pool.acquire(loop=self.loop))
+        finally:
+            listener.close()
+
+    def test_client_pool_idle_timeout(self):
+        pool = AioClientPool(None, idle_timeout=0.01)
+        with self.assertRaises(ValueError):
+            AioClientPool(None, max_size=0)
+        conns = [mock.Mock(closed=False) for _ in range(2)]
+        pool._connect = functools.partial(next, iter(conns))
+        conn = self.loop.run_until_complete(pool.acquire(loop=self.loop))
+        self.assertIs(conn, conns[0])
+        pool.release(conn)
+        self.assertEqual(pool.idle_connections(), 1)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(pool.idle_connections(), 0)
+        conns[0].close.assert_called_once_with()
+        conn = self.loop.run_until_complete(pool.acquire(loop=self.loop))
+        self.assertIs(conn, conns[1])
+
+    def test_client_pool_unbounded(self):
+        pool = AioClientPool(None, max_size=None)
+        conns = [mock.Mock(closed=False) for _ in range(20)]
+        pool._connect = functools.partial(next, iter(conns))
+
+        async def acquire_all():
+            # None of them wait for a connection to be released.
+            return await asyncio.wait_for(
+                asyncio.gather(*[pool.acquire(loop=self.loop) for _ in conns]),
+                5,
+            )
+
+        out = self.loop.run_until_complete(acquire_all())
+        self.assertEqual(sorted(out, key=conns.index), conns)
+        for conn in out:
+            pool.release(conn)
+        self.assertEqual(pool.idle_connections(), 20)
+
     def test_listener_ctxmgr(self):
         address = ("localhost", 8999)
         authkey = b"abcdefg"
@@ -389,6 +389,19 @@ class EventTest(BaseTest):
         self.loop.run_until_complete(wait_event())
         p.join()
 
+    def test_cancelled_wait_frees_thread(self):
+        async def cancel_then_wait():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(self.event.coro_wait(), 0.1)
+            # AioEvent only has one executor thread, so this would hang
+            # if the cancelled wait were still holding it.
+            waiter = asyncio.ensure_future(self.event.coro_wait())
+            await asyncio.sleep(0.05)
+            self.event.set()
+            return await asyncio.wait_for(waiter, 2)
+
+        self.assertTrue(self.loop.run_until_complete(cancel_then_wait()))
+
 
 def cond_notify(cond, event):
     time.sleep(2)
@@ -1,3 +1,13 @@
+import asyncio
+import functools
+import itertools
+import os
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+
 import aioprocessing
 
 from ._base_test import BaseTest, _GenMixin
@@ -12,6 +22,37 @@ def map_func(z):
     return z * 3
 
 
+def sleepy_func(z):
+    time.sleep(z)
+    return z
+
+
+def failing_func(z):
+    if z == 3:
+        raise ValueError("bad item")
+    return z
+
+
+def touch_func(path):
+    with open(path, "w"):
+        pass
+
+
+def touch_then_sleep(path, delay):
+    touch_func(path)
+    time.sleep(delay)
+
+
+def stuck_func(delay):
+    # Stands in for code stuck in C, which never sees the interruption.
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGUSR1})
+    try:
+        time.sleep(delay)
+    finally:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGUSR1})
+    return delay
+
+
 def starmap(func, it):
     return map(func, *zip(*it))
 
@@ -76,3 +117,297 @@ class PoolTest(BaseTest):
 
         self.pool.close()
         self.loop.run_until_complete(do_join())
+
+    def test_coro_imap(self):
+        async def do_imap():
+            out = []
+            async for val in self.pool.coro_imap(
+                map_func, range(50), chunksize=3
+            ):
+                out.append(val)
+            return out
+
+        out = self.loop.run_until_complete(do_imap())
+        self.assertEqual(out, [map_func(i) for i in range(50)])
+
+    def test_coro_imap_unordered(self):
+        delays = [0.3, 0.01, 0.01, 0.01]
+
+        async def do_imap(pool):
+            out = []
+            async for val in pool.coro_imap_unordered(
+                sleepy_func, delays, max_in_flight=4
+            ):
+                out.append(val)
+            return out
+
+        with aioprocessing.AioPool(4) as pool:
+            out = self.loop.run_until_complete(do_imap(pool))
+        self.assertEqual(sorted(out), sorted(delays))
+        self.assertEqual(out[-1], 0.3)
+
+    def test_coro_imap_bounded(self):
+        # An endless iterable is only consumed as results are taken.
+        items = itertools.count()
+
+        async def take(n):
+            out = []
+            it = self.pool.coro_imap(map_func, items, max_in_flight=2)
+            async for val in it:
+                out.append(val)
+                if len(out) == n:
+                    await it.aclose()
+            return out
+
+        out = self.loop.run_until_complete(take(5))
+        self.assertEqual(out, [map_func(i) for i in range(5)])
+        self.assertLessEqual(next(items), 7)
+
+    def test_coro_imap_error(self):
+        async def do_imap():
+            out = []
+            with self.assertRaisesRegex(ValueError, "bad item"):
+                async for val in self.pool.coro_imap(failing_func, range(6)):
+                    out.append(val)
+            return out
+
+        self.assertEqual(self.loop.run_until_complete(do_imap()), [0, 1, 2])
+        with self.assertRaises(ValueError):
+            self.pool.coro_imap(map_func, [], chunksize=0)
+
+    def test_coro_map_adaptive(self):
+        it = list(range(2000))
+        star_it = list(zip(range(50), range(50, 100)))
+
+        async def do_map():
+            out = await self.pool.coro_map(
+                map_func, it, target_duration=0.01
+            )
+            self.assertEqual(out, list(map(map_func, it)))
+            out = await self.pool.coro_starmap(
+                work_func, star_it, 5, target_duration=0.01
+            )
+            self.assertEqual(out, list(starmap(work_func, star_it)))
+
+        self.loop.run_until_complete(do_map())
+        with self.assertRaises(ValueError):
+            self.pool.coro_map(map_func, it, target_duration=0)
+
+    def test_coro_imap_adaptive(self):
+        async def do_imap():
+            results = self.pool.coro_imap(
+                map_func, range(5000), target_duration=0.01
+            )
+            out = []
+            async for val in results:
+                out.append(val)
+            return out, results._chunksize
+
+        out, chunksize = self.loop.run_until_complete(do_imap())
+        self.assertEqual(out, [map_func(i) for i in range(5000)])
+        # Cheap items are sent in ever larger chunks.
+        self.assertGreater(chunksize, 1)
+
+    def test_chunk_sizer(self):
+        sizer = aioprocessing.pool._ChunkSizer(1, 0.1)
+        # Chunks at most double from the size measured...
+        sizer.update(1, 0.001, 0.0015)
+        self.assertEqual(sizer.chunksize, 2)
+        sizer.update(2, 0.002, 0.0025)
+        self.assertEqual(sizer.chunksize, 4)
+        sizer.update(64, 0.064, 0.0645)
+        self.assertEqual(sizer.chunksize, 100)
+        # ...but shrink at once when items get more expensive.
+        sizer.update(100, 10, 10.0005)
+        self.assertLess(sizer.chunksize, 4)
+        # Chunks last at least ten times the overhead of sending them.
+        sizer = aioprocessing.pool._ChunkSizer(1, 0.001)
+        for _ in range(10):
+            elapsed = sizer.chunksize * 0.001
+            sizer.update(sizer.chunksize, elapsed, elapsed + 0.1)
+        self.assertAlmostEqual(sizer.overhead, 0.1)
+        self.assertAlmostEqual(sizer.chunksize, 1000, delta=1)
+
+
+class PoolCancelTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.pool = aioprocessing.AioPool(1)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.pool.close()
+        self.pool.join()
+        shutil.rmtree(self.dir)
+
+    async def _wait_for(self, path):
+        deadline = time.monotonic() + 10
+        while not os.path.exists(path):
+            self.assertLess(time.monotonic(), deadline)
+            await asyncio.sleep(0.01)
+
+    def test_cancel_unstarted(self):
+        started = os.path.join(self.dir, "started")
+        skipped = os.path.join(self.dir, "skipped")
+
+        async def cancel():
+            blocker = self.pool.coro_apply(
+                touch_then_sleep, (started, 0.3)
+            )
+            fut = self.pool.coro_apply(touch_func, (skipped,))
+            fut.cancel()
+            await blocker
+            # The only worker takes tasks in order.
+            self.assertEqual(await self.pool.coro_apply(map_func, (1,)), 3)
+
+        self.loop.run_until_complete(cancel())
+        self.assertTrue(os.path.exists(started))
+        self.assertFalse(os.path.exists(skipped))
+
+    @unittest.skipIf(
+        not hasattr(signal, "SIGUSR1"), "Not supported on Windows"
+    )
+    def test_cancel_interrupt(self):
+        started = os.path.join(self.dir, "started")
+
+        async def cancel():
+            fut = self.pool.coro_apply(
+                touch_then_sleep, (started, 30), interrupt=True
+            )
+            await self._wait_for(started)
+            fut.cancel()
+            start = time.monotonic()
+            self.assertEqual(await self.pool.coro_apply(map_func, (1,)), 3)
+            return time.monotonic() - start
+
+        self.assertLess(self.loop.run_until_complete(cancel()), 5)
+
+    def test_cancel_map(self):
+        started = os.path.join(self.dir, "started")
+        # Skipped items still have to be sent to the worker, which takes
+        # a while with dill, so they're few and slow.
+        items = [(started, 0.5)] * 20
+
+        async def cancel():
+            fut = self.pool.coro_starmap(touch_then_sleep, items, 1)
+            await self._wait_for(started)
+            fut.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await fut
+            start = time.monotonic()
+            self.assertEqual(await self.pool.coro_apply(map_func, (1,)), 3)
+            return time.monotonic() - start
+
+        # Without cancellation, the rest of the map would take 10s.
+        self.assertLess(self.loop.run_until_complete(cancel()), 5)
+
+    @unittest.skipIf(
+        not hasattr(signal, "SIGUSR1"), "Not supported on Windows"
+    )
+    def test_imap_aclose_interrupts(self):
+        started = os.path.join(self.dir, "started")
+        func = functools.partial(touch_then_sleep, started)
+
+        async def close():
+            results = self.pool.coro_imap(func, [30, 30], interrupt=True)
+            first = asyncio.ensure_future(results.__anext__())
+            await self._wait_for(started)
+            first.cancel()
+            await results.aclose()
+            start = time.monotonic()
+            self.assertEqual(await self.pool.coro_apply(map_func, (1,)), 3)
+            return time.monotonic() - start
+
+        self.assertLess(self.loop.run_until_complete(close()), 5)
+
+
+class PoolTimeoutTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.pool = aioprocessing.AioPool(1)
+
+    def tearDown(self):
+        super().tearDown()
+        # This would hang if the jobs of a killed worker were left in
+        # the Pool.
+        self.pool.close()
+        self.pool.join()
+
+    def _check_free(self):
+        async def check():
+            start = time.monotonic()
+            self.assertEqual(
+                await self.pool.coro_apply(map_func, (1,), timeout=10), 3
+            )
+            return time.monotonic() - start
+
+        return self.loop.run_until_complete(check())
+
+    def test_in_time(self):
+        async def calls():
+            self.assertEqual(
+                await self.pool.coro_apply(work_func, (2, 3), timeout=5), 6
+            )
+            out = await self.pool.coro_map(map_func, range(10), timeout=5)
+            self.assertEqual(out, [map_func(i) for i in range(10)])
+
+        self.loop.run_until_complete(calls())
+
+    @unittest.skipIf(
+        not hasattr(signal, "SIGUSR1"), "Not supported on Windows"
+    )
+    def test_apply_timeout(self):
+        async def call():
+            start = time.monotonic()
+            with self.assertRaises(asyncio.TimeoutError):
+                await self.pool.coro_apply(sleepy_func, (30,), timeout=0.2)
+            return time.monotonic() - start
+
+        self.assertLess(self.loop.run_until_complete(call()), 1)
+        # The sleep was interrupted, rather than the worker killed.
+        self.assertLess(self._check_free(), 1)
+
+    @unittest.skipIf(
+        not hasattr(signal, "pthread_sigmask"), "Not supported on Windows"
+    )
+    def test_stuck_worker_replaced(self):
+        async def call():
+            pid = await self.pool.coro_apply(os.getpid)
+            with self.assertRaises(asyncio.TimeoutError):
+                await self.pool.coro_apply(stuck_func, (30,), timeout=0.2)
+            return pid
+
+        pid = self.loop.run_until_complete(call())
+        self.assertLess(self._check_free(), 5)
+        new_pid = self.loop.run_until_complete(
+            self.pool.coro_apply(os.getpid, loop=self.loop)
+        )
+        self.assertNotEqual(pid, new_pid)
+
+    @unittest.skipIf(
+        not hasattr(signal, "pthread_sigmask"), "Not supported on Windows"
+    )
+    def test_map_timeout(self):
+        async def call():
+            with self.assertRaises(asyncio.TimeoutError):
+                await self.pool.coro_map(
+                    stuck_func, [0.01, 0.01, 30, 0.01], 1, timeout=0.5
+                )
+
+        self.loop.run_until_complete(call())
+        self.assertLess(self._check_free(), 5)
+
+    def test_abandon_then_result(self):
+        call = self.pool._obj.start_call()
+        job = self.pool._obj.apply_async(sleepy_func, (0.2,))
+        call.jobs[0] = job
+        call._abandon()
+        with self.assertRaises(asyncio.TimeoutError):
+            job.get(5)
+        # The real result comes in afterwards, and is dropped.
+        time.sleep(0.3)
+        with self.assertRaises(asyncio.TimeoutError):
+            job.get(5)
+        call.finish()
+        self.assertLess(self._check_free(), 1)
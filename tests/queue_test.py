@@ -1,8 +1,21 @@
+import asyncio
+import json
+import os
+import pickle
+import struct
+import subprocess
+import sys
+import threading
+import time
 import unittest
+from unittest import mock
 from concurrent.futures import ProcessPoolExecutor
+from queue import Empty, Full
 
 import aioprocessing
-from aioprocessing.mp import Process, Event, util
+from aioprocessing import queues, serialization
+from aioprocessing.stats import Histogram, QueueStats
+from aioprocessing.mp import Process, Event, get_context, shared_memory, util
 from ._base_test import BaseTest, _GenMixin
 
 
@@ -11,6 +24,29 @@ def queue_put(q, val):
     return val
 
 
+def queue_put_all(q, vals):
+    for val in vals:
+        q.put(val)
+
+
+def queue_put_oob(q, val):
+    q.put_oob(val, threshold=1024)
+
+
+def json_dumps(obj):
+    return json.dumps(obj).encode()
+
+
+def json_loads(data):
+    return json.loads(data.decode())
+
+
+def queue_consume(q, n):
+    for _ in range(n):
+        q.get()
+        q.task_done()
+
+
 def queue_get(q, e):
     val = q.get()
     e.set()
@@ -45,6 +81,13 @@ class GenAioJoinableQueueTest(GenQueueMixin, BaseTest):
         super().setUp()
 
 
+@unittest.skipIf(shared_memory is None, "shared_memory is not available")
+class GenAioShmQueueTest(GenQueueMixin, BaseTest):
+    def setUp(self):
+        self.Obj = aioprocessing.AioShmQueue
+        super().setUp()
+
+
 class QueueTest(BaseTest):
     def test_blocking_put(self):
         q = aioprocessing.AioQueue()
@@ -95,6 +138,656 @@ class QueueTest(BaseTest):
         out = q.get()
         self.assertEqual(val, out)
 
+    def test_concurrent_getters(self):
+        q = aioprocessing.AioQueue()
+        vals = list(range(50))
+
+        async def queue_get():
+            getters = [q.coro_get() for _ in vals]
+            p = Process(target=queue_put_all, args=(q, vals))
+            p.start()
+            out = await asyncio.gather(*getters)
+            p.join()
+            return out
+
+        out = self.loop.run_until_complete(queue_get())
+        self.assertEqual(sorted(out), vals)
+        # Waiting on the pipe shouldn't have needed any threads.
+        self.assertFalse(hasattr(q, "_executor"))
+
+    def test_get_timeout(self):
+        q = aioprocessing.AioQueue()
+
+        async def queue_get():
+            await q.coro_get(timeout=0.1)
+
+        with self.assertRaises(Empty):
+            self.loop.run_until_complete(queue_get())
+
+    def test_simple_queue_get(self):
+        q = aioprocessing.AioSimpleQueue()
+        val = 9
+        p = Process(target=queue_put, args=(q, val))
+
+        async def queue_get():
+            return await q.coro_get()
+
+        p.start()
+        out = self.loop.run_until_complete(queue_get())
+        p.join()
+        self.assertEqual(out, val)
+
+
+class LargeItemQueueTest(BaseTest):
+    def _send_slowly(self, q, val, delay):
+        """ Writes val's frame to q, leaving most of it until later. """
+        frame = pickle.dumps(val)
+        if hasattr(q._obj, "_sem"):
+            q._obj._sem.acquire()
+        writer = q._obj._writer
+        writer._send(struct.pack("!i", len(frame)) + frame[:1000])
+        timer = threading.Timer(delay, writer._send, args=(frame[1000:],))
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def _check_loop_free(self, q, val=b"x" * (2 * queues._LARGE_FRAME)):
+        self._send_slowly(q, val, 0.5)
+
+        async def queue_get():
+            fut = q.coro_get(loop=self.loop)
+            await asyncio.sleep(0.05)
+            # The loop ran while the rest of the item was on its way.
+            self.assertFalse(fut.done())
+            return await fut
+
+        self.assertEqual(self.loop.run_until_complete(queue_get()), val)
+
+    def test_queue(self):
+        self._check_loop_free(aioprocessing.AioQueue())
+
+    def test_simple_queue(self):
+        self._check_loop_free(aioprocessing.AioSimpleQueue())
+
+    def test_partial_small_item(self):
+        # Small enough to be read on the event loop, if it were whole.
+        self._check_loop_free(aioprocessing.AioQueue(), b"y" * 4000)
+
+    def test_cancelled_get_loses_nothing(self):
+        q = aioprocessing.AioQueue()
+        val = b"x" * (2 * queues._LARGE_FRAME)
+        self._send_slowly(q, val, 0.2)
+
+        async def cancel_then_get():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(q.coro_get(loop=self.loop), 0.05)
+            return await asyncio.wait_for(q.coro_get(loop=self.loop), 2)
+
+        self.assertEqual(self.loop.run_until_complete(cancel_then_get()), val)
+
+    def test_cancelled_get_many_keeps_orphans(self):
+        q = aioprocessing.AioSimpleQueue()
+        val = b"x" * (2 * queues._LARGE_FRAME)
+        # Items handed back by earlier cancelled gets.
+        q._orphans.extend(["a", "b"])
+        self._send_slowly(q, val, 0.2)
+
+        async def cancel_then_get():
+            # Takes "a", then "b", then waits for the large item.
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    q.coro_get_many(5, loop=self.loop), 0.05
+                )
+            await asyncio.sleep(0.4)
+            return await q.coro_get_many(5, loop=self.loop)
+
+        out = self.loop.run_until_complete(cancel_then_get())
+        self.assertEqual(out, ["a", "b", val])
+
+    def test_get_many(self):
+        q = aioprocessing.AioSimpleQueue()
+        val = b"x" * (2 * queues._LARGE_FRAME)
+        q.put_many([1, 2])
+        self._send_slowly(q, val, 0.2)
+
+        async def queue_get():
+            return await q.coro_get_many(10, loop=self.loop)
+
+        out = self.loop.run_until_complete(queue_get())
+        self.assertEqual(out, [1, 2, val])
+
+
+class BatchQueueTest(BaseTest):
+    def _test_put_many_get_many(self, q):
+        vals = list(range(20))
+
+        async def queue_batch():
+            await q.coro_put_many(vals)
+            out = []
+            while len(out) < len(vals):
+                batch = await q.coro_get_many(8)
+                self.assertTrue(1 <= len(batch) <= 8)
+                out.extend(batch)
+            return out
+
+        out = self.loop.run_until_complete(queue_batch())
+        self.assertEqual(out, vals)
+
+    def test_queue(self):
+        self._test_put_many_get_many(aioprocessing.AioQueue())
+
+    def test_simple_queue(self):
+        self._test_put_many_get_many(aioprocessing.AioSimpleQueue())
+
+    def test_joinable_queue(self):
+        self._test_put_many_get_many(aioprocessing.AioJoinableQueue())
+
+    def test_get_many_from_process(self):
+        q = aioprocessing.AioQueue()
+        vals = list(range(10))
+        p = Process(target=queue_put_all, args=(q, vals))
+        p.start()
+        p.join()
+        out = q.get_many(len(vals))
+        while len(out) < len(vals):
+            out.extend(q.get_many(len(vals) - len(out)))
+        self.assertEqual(out, vals)
+
+    def test_get_many_timeout(self):
+        q = aioprocessing.AioQueue()
+
+        async def queue_get():
+            await q.coro_get_many(5, timeout=0.1)
+
+        with self.assertRaises(Empty):
+            self.loop.run_until_complete(queue_get())
+
+    def test_get_many_bad_count(self):
+        q = aioprocessing.AioQueue()
+        q.put(1)
+        for n in (0, -1):
+            with self.assertRaises(ValueError):
+                q.get_many(n)
+            with self.assertRaises(ValueError):
+                q.coro_get_many(n, loop=self.loop)
+        # Nothing was taken off the queue.
+        self.assertEqual(q.get(), 1)
+
+
+@unittest.skipIf(shared_memory is None, "shared_memory is not available")
+class ShmQueueTest(BaseTest):
+    def test_put_get(self):
+        q = aioprocessing.AioShmQueue(256)
+        # Enough data to wrap around the ring a few times.
+        vals = [("x" * (i % 40), i) for i in range(100)]
+        p = Process(target=queue_put_all, args=(q, vals))
+
+        async def queue_get():
+            return [await q.coro_get() for _ in vals]
+
+        p.start()
+        out = self.loop.run_until_complete(queue_get())
+        p.join()
+        self.assertEqual(out, vals)
+
+    def test_spawn(self):
+        ctx = get_context("spawn")
+        q = aioprocessing.AioShmQueue(context=ctx)
+        val = 3
+        e = ctx.Event()
+        p = ctx.Process(target=queue_get, args=(q, e))
+
+        async def queue_put():
+            await q.coro_put(val)
+
+        p.start()
+        self.loop.run_until_complete(queue_put())
+        p.join()
+        self.assertEqual(q.get(), val)
+
+    def test_full_empty(self):
+        q = aioprocessing.AioShmQueue(64)
+        self.assertTrue(q.empty())
+        self.assertRaises(Empty, q.get, timeout=0.01)
+        q.put(b"a" * 20)
+        self.assertEqual(q.qsize(), 1)
+        self.assertRaises(Full, q.put, b"b" * 20, timeout=0.01)
+        self.assertRaises(ValueError, q.put, b"c" * 100)
+        self.assertEqual(q.get(), b"a" * 20)
+        q.close()
+
+
+@unittest.skipIf(
+    not serialization.shm_supported, "Out-of-band buffers aren't supported"
+)
+class OOBQueueTest(BaseTest):
+    def test_put_oob(self):
+        q = aioprocessing.AioQueue()
+        val = {
+            "view": memoryview(bytearray(range(16)) * 256).cast("i"),
+            "buffer": pickle.PickleBuffer(b"a" * 4096),
+            "small": memoryview(b"b"),
+        }
+        p = Process(target=queue_put_oob, args=(q, val))
+        p.start()
+
+        async def queue_get():
+            return await q.coro_get()
+
+        out = self.loop.run_until_complete(queue_get())
+        p.join()
+        self.assertIsInstance(out["view"], memoryview)
+        self.assertEqual(out["view"].format, "i")
+        self.assertEqual(out["view"].tolist(), val["view"].tolist())
+        # The view maps the shared memory block directly, so it's writable.
+        self.assertFalse(out["view"].readonly)
+        self.assertEqual(bytes(out["buffer"]), b"a" * 4096)
+        self.assertEqual(out["small"], b"b")
+
+    def test_coro_put_oob(self):
+        q = aioprocessing.AioSimpleQueue()
+        val = memoryview(b"d" * (1 << 17))
+
+        async def queue_put_get():
+            await q.coro_put_oob(val)
+            return await q.coro_get()
+
+        out = self.loop.run_until_complete(queue_put_get())
+        self.assertEqual(out, val)
+
+    def test_put_oob_outlives_producer(self):
+        q = aioprocessing.AioQueue()
+        val = memoryview(b"e" * (1 << 17))
+        p = Process(target=queue_put_oob, args=(q, val))
+        p.start()
+        p.join()
+        self.assertEqual(q.get(), val)
+
+    @unittest.skipUnless(os.path.isdir("/dev/shm"), "Needs /dev/shm")
+    def test_unread_blocks_removed(self):
+        script = (
+            "from aioprocessing import serialization\n"
+            "val = memoryview(b'f' * (1 << 17))\n"
+            "shared = serialization.SharedBuffers(val)\n"
+            "print(shared._segments[0][0])\n"
+        )
+        out = subprocess.run(
+            [sys.executable, "-W", "ignore", "-c", script],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+        path = os.path.join("/dev/shm", out.stdout.strip().lstrip("/"))
+        # The resource tracker removes the block once the process that
+        # made it has exited, in its own time.
+        deadline = time.monotonic() + 5
+        while os.path.exists(path) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(os.path.exists(path))
+
+
+class IterQueueTest(BaseTest):
+    def _iterate(self, q, **kwargs):
+        p = Process(target=queue_put_all, args=(q, list(range(20)) + [None]))
+        p.start()
+
+        async def consume():
+            out = []
+            async for item in q.iterate(sentinel=None, **kwargs):
+                out.append(item)
+            return out
+
+        out = self.loop.run_until_complete(consume())
+        p.join()
+        self.assertEqual(out, list(range(20)))
+
+    def test_queue(self):
+        self._iterate(aioprocessing.AioQueue())
+
+    def test_simple_queue(self):
+        self._iterate(aioprocessing.AioSimpleQueue())
+
+    def test_prefetch(self):
+        self._iterate(aioprocessing.AioQueue(), prefetch=4)
+
+    def test_prefetch_given_loop(self):
+        # self.loop isn't the default loop, so on older Pythons the
+        # prefetcher's primitives have to be bound to it explicitly.
+        self._iterate(aioprocessing.AioQueue(), prefetch=4, loop=self.loop)
+
+    def test_aiter(self):
+        q = aioprocessing.AioQueue()
+        q.put_many([1, 2])
+
+        async def consume():
+            out = []
+            async for item in q:
+                out.append(item)
+                if len(out) == 2:
+                    break
+            return out
+
+        self.assertEqual(self.loop.run_until_complete(consume()), [1, 2])
+
+    def test_aclose_returns_prefetched(self):
+        q = aioprocessing.AioQueue()
+        q.put_many([1, 2, 3])
+
+        async def consume():
+            it = q.iterate(prefetch=2)
+            first = await it.__anext__()
+            # Give the prefetching task a chance to fill up.
+            while len(it._items) < 2:
+                await asyncio.sleep(0.01)
+            return first, await it.aclose()
+
+        first, rest = self.loop.run_until_complete(consume())
+        self.assertEqual(first, 1)
+        self.assertEqual(rest, [2, 3])
+
+
+class BackpressureTest(BaseTest):
+    def test_put_waits_for_room(self):
+        q = aioprocessing.AioQueue(2)
+        q.put_many([1, 2])
+
+        async def put_then_get():
+            put = asyncio.ensure_future(q.coro_put(3))
+            await asyncio.sleep(0.05)
+            self.assertFalse(put.done())
+            first = await q.coro_get()
+            await asyncio.wait_for(put, 5)
+            # The feeder thread may not have written 3 to the pipe yet,
+            # so a single get_many could come back with just 2.
+            return [first, await q.coro_get(), await q.coro_get()]
+
+        out = self.loop.run_until_complete(put_then_get())
+        self.assertEqual(out, [1, 2, 3])
+        # Nothing blocked in a thread.
+        self.assertFalse(hasattr(q, "_executor"))
+
+    def test_put_timeout(self):
+        q = aioprocessing.AioQueue(1)
+        q.put(1)
+
+        async def put():
+            await q.coro_put(2, timeout=0.05)
+
+        with self.assertRaises(Full):
+            self.loop.run_until_complete(put())
+
+    def test_watermarks(self):
+        q = aioprocessing.AioQueue(10, high_watermark=4, low_watermark=1)
+
+        async def fill():
+            for i in range(4):
+                await q.coro_put(i)
+            await asyncio.sleep(0.1)
+            self.assertTrue(q.producers_paused)
+            self.assertEqual(q.fill_level(), 0.4)
+            with self.assertRaises(Full):
+                await q.coro_put(4, block=False)
+            # Draining to 2 items isn't enough...
+            await q.coro_get_many(2)
+            self.assertTrue(q.producers_paused)
+            # ...but draining to the low watermark is.
+            await q.coro_get()
+            await q.coro_put(4, timeout=5)
+            self.assertFalse(q.producers_paused)
+
+        self.loop.run_until_complete(fill())
+
+    def test_bad_watermarks(self):
+        with self.assertRaises(ValueError):
+            aioprocessing.AioQueue(2, high_watermark=3)
+        with self.assertRaises(ValueError):
+            aioprocessing.AioQueue(high_watermark=3, low_watermark=3)
+        with self.assertRaises(ValueError):
+            aioprocessing.AioQueue(low_watermark=3)
+
+
+class PriorityQueueTest(BaseTest):
+    def test_priority_order(self):
+        q = aioprocessing.AioPriorityQueue()
+        items = [(2, "bulk"), (1, "normal"), (0, "urgent"), (2, "bulk2")]
+        p = Process(target=queue_put_all, args=(q, items))
+        p.start()
+        p.join()
+
+        async def get_all():
+            # Give the feeder threads time to flush everything.
+            while q.qsize() != 4 or not all(
+                level._poll() for level in q._levels
+            ):
+                await asyncio.sleep(0.01)
+            return await q.coro_get_many(4)
+
+        out = self.loop.run_until_complete(get_all())
+        self.assertEqual(
+            out, [(0, "urgent"), (1, "normal"), (2, "bulk"), (2, "bulk2")]
+        )
+
+    def test_coro_get_waits(self):
+        q = aioprocessing.AioPriorityQueue(levels=2)
+
+        async def get():
+            return await q.coro_get()
+
+        fut = asyncio.ensure_future(get(), loop=self.loop)
+        q.put((1, "late"))
+        self.assertEqual(self.loop.run_until_complete(fut), (1, "late"))
+
+    def test_blocking_get(self):
+        q = aioprocessing.AioPriorityQueue(levels=2)
+        with self.assertRaises(Empty):
+            q.get(timeout=0.01)
+        q.put((1, "a"))
+        self.assertEqual(q.get(timeout=5), (1, "a"))
+
+    def test_bad_priority(self):
+        q = aioprocessing.AioPriorityQueue(levels=2)
+        for priority in (2, -1, "0"):
+            with self.assertRaises(ValueError):
+                q.put((priority, "x"))
+
+    def test_managed(self):
+        m = aioprocessing.AioManager()
+        q = m.AioPriorityQueue()
+
+        async def put_get():
+            await q.coro_put((5, "b"))
+            await q.coro_put((1, "a"))
+            return [await q.coro_get(), await q.coro_get()]
+
+        out = self.loop.run_until_complete(put_get())
+        self.assertEqual(out, [(1, "a"), (5, "b")])
+        m.shutdown()
+
+    def test_managed_ties(self):
+        m = aioprocessing.AioManager()
+        q = m.AioPriorityQueue()
+        # Dicts can't be compared, so ties mustn't fall back on the data.
+        vals = [(1, {"n": 0}), (0, {"n": 1}), (1, {"n": 2}), (1, {"n": 3})]
+
+        async def put_get():
+            for val in vals:
+                await q.coro_put(val)
+            return [await q.coro_get() for _ in vals]
+
+        out = self.loop.run_until_complete(put_get())
+        self.assertEqual(out, [vals[1], vals[0], vals[2], vals[3]])
+        m.shutdown()
+
+
+class SerializerQueueTest(BaseTest):
+    def _check(self, q):
+        items = [{"a": [1, 2]}, "b", 3]
+        p = Process(target=queue_put_all, args=(q, items))
+        p.start()
+
+        async def get_all():
+            return [await q.coro_get() for _ in items]
+
+        self.assertEqual(self.loop.run_until_complete(get_all()), items)
+        p.join()
+        q.put_many(items)
+        self.assertEqual([q.get() for _ in items], items)
+
+    def test_marshal(self):
+        self._check(aioprocessing.AioQueue(serializer="marshal"))
+
+    def test_pickle_protocol(self):
+        self._check(
+            aioprocessing.AioSimpleQueue(
+                serializer=serialization.PickleSerializer(2)
+            )
+        )
+
+    def test_functions(self):
+        self._check(
+            aioprocessing.AioJoinableQueue(serializer=(json_dumps, json_loads))
+        )
+
+    def test_priority_queue(self):
+        q = aioprocessing.AioPriorityQueue(serializer="marshal")
+        q.put((1, {"a": 1}))
+        self.assertEqual(q.get(timeout=5), (1, {"a": 1}))
+
+    def test_put_oob_rejected(self):
+        q = aioprocessing.AioQueue(serializer="marshal")
+        with self.assertRaises(ValueError):
+            q.put_oob(b"a")
+
+    def test_bad_serializer(self):
+        with self.assertRaises(ValueError):
+            aioprocessing.AioQueue(serializer="yaml")
+        with self.assertRaises(TypeError):
+            aioprocessing.AioQueue(serializer=object())
+
+
+class StatsQueueTest(BaseTest):
+    def test_queue_stats(self):
+        q = aioprocessing.AioQueue(stats=True)
+
+        async def put_get():
+            await q.coro_put(1)
+            await q.coro_put_many([2, 3])
+            out = [await q.coro_get()]
+            while len(out) < 3:
+                out.extend(await q.coro_get_many(2))
+            return out
+
+        self.assertEqual(self.loop.run_until_complete(put_get()), [1, 2, 3])
+        stats = q.stats()
+        self.assertEqual(stats["put"]["count"], 3)
+        self.assertEqual(stats["get"]["count"], 3)
+        self.assertGreater(stats["get"]["frame_bytes"], 0)
+        self.assertEqual(stats["get"]["serialized_bytes"], 0)
+        self.assertEqual(stats["put"]["latency"]["count"], 2)
+        # Only coro_put_many went through the executor.
+        self.assertEqual(stats["executor"]["wait"]["count"], 1)
+        self.assertEqual(stats["executor"]["call"]["count"], 1)
+
+    def test_simple_queue_stats(self):
+        q = aioprocessing.AioSimpleQueue(stats=True)
+        q.put_many(["a", "b"])
+        self.assertEqual([q.get(), q.get()], ["a", "b"])
+        stats = q.stats()
+        self.assertEqual(stats["put"]["count"], 2)
+        self.assertGreater(stats["put"]["frame_bytes"], 0)
+        self.assertEqual(stats["get"]["latency"]["count"], 2)
+
+    def test_serializer_stats(self):
+        q = aioprocessing.AioQueue(serializer="marshal", stats=True)
+
+        async def put_get():
+            await q.coro_put("a" * 10)
+            q.put_many(["b" * 20, "c" * 30])
+            out = [await q.coro_get(), q.get()]
+            return out + await q.coro_get_many(1)
+
+        out = self.loop.run_until_complete(put_get())
+        self.assertEqual(out, ["a" * 10, "b" * 20, "c" * 30])
+        stats = q.stats()
+        # Whichever way the items went, both sides saw the same data.
+        self.assertGreater(stats["put"]["serialized_bytes"], 60)
+        self.assertEqual(
+            stats["put"]["serialized_bytes"],
+            stats["get"]["serialized_bytes"],
+        )
+
+    def test_no_stats(self):
+        with self.assertRaises(ValueError):
+            aioprocessing.AioQueue().stats()
+
+    def test_pickled_stats_start_over(self):
+        stats = QueueStats()
+        stats.record("put")
+        self.assertEqual(
+            pickle.loads(pickle.dumps(stats)).snapshot()["put"]["count"], 0
+        )
+
+    def test_histogram(self):
+        hist = Histogram()
+        for seconds in (0.000001, 0.000003, 0.001, 2):
+            hist.add(seconds)
+        snap = hist.snapshot()
+        self.assertEqual(snap["count"], 4)
+        self.assertEqual(snap["max"], 2)
+        self.assertEqual(sum(n for _, n in snap["buckets"]), 4)
+        self.assertLessEqual(snap["p50"], 0.000004)
+        self.assertEqual(snap["p99"], 2)
+
+
+class CancelQueueTest(BaseTest):
+    def test_cancelled_get_loses_nothing(self):
+        q = aioprocessing.AioQueue()
+
+        async def cancel_then_put():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(q.coro_get(), 0.05)
+            await q.coro_put(1)
+            return await asyncio.wait_for(q.coro_get(), 2)
+
+        self.assertEqual(self.loop.run_until_complete(cancel_then_put()), 1)
+
+    def _without_readers(self):
+        # Patched here rather than with a decorator, since dill can't
+        # unpickle a test class holding mock.patch objects, which it
+        # can be sent along with this module's globals to a spawned
+        # child.
+        return mock.patch(
+            "aioprocessing.util.supports_readers", return_value=False
+        )
+
+    def test_executor_get_frees_thread(self):
+        q = aioprocessing.AioQueue()
+        q.pool_workers = 1
+
+        async def cancel_then_put():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(q.coro_get(), 0.05)
+            # With a single executor thread, this would hang if the
+            # cancelled get still held it.
+            q.put(1)
+            return await asyncio.wait_for(q.coro_get(), 2)
+
+        with self._without_readers():
+            out = self.loop.run_until_complete(cancel_then_put())
+        self.assertEqual(out, 1)
+
+    def test_executor_get_hands_back(self):
+        q = aioprocessing.AioSimpleQueue()
+        q.put("item")
+        with self._without_readers():
+            fut = q.coro_get(loop=self.loop)
+            # Let the executor take the item, but cancel before the
+            # result reaches the event loop.
+            time.sleep(0.2)
+            fut.cancel()
+            self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(q.get(), "item")
+
 
 class ManagerQueueTest(BaseTest):
     @unittest.skipIf(
@@ -133,6 +826,52 @@ class JoinableQueueTest(BaseTest):
 
         self.loop.run_until_complete(join())
 
+    def test_join_from_process(self):
+        q = aioprocessing.AioJoinableQueue()
+        q.put_many(list(range(5)))
+        p = Process(target=queue_consume, args=(q, 5))
+        p.start()
+
+        async def join():
+            await asyncio.wait_for(q.coro_join(), 10)
+
+        self.loop.run_until_complete(join())
+        p.join()
+        # Waiting didn't need a thread.
+        self.assertFalse(hasattr(q, "_executor"))
+
+    def test_task_done_many(self):
+        q = aioprocessing.AioJoinableQueue()
+        q.put_many([1, 2, 3])
+
+        async def finish():
+            join = asyncio.ensure_future(q.coro_join())
+            out = []
+            while len(out) < 3:
+                out.extend(await q.coro_get_many(3))
+            self.assertEqual(out, [1, 2, 3])
+            q.task_done_many(2)
+            await asyncio.sleep(0.05)
+            self.assertFalse(join.done())
+            await q.coro_task_done_many(1)
+            await asyncio.wait_for(join, 5)
+
+        self.loop.run_until_complete(finish())
+        with self.assertRaises(ValueError):
+            q.task_done()
+
+    def test_task_done_many_too_many(self):
+        q = aioprocessing.AioJoinableQueue()
+        q.put_many([1, 2])
+        self.assertEqual([q.get(), q.get()], [1, 2])
+        with self.assertRaises(ValueError):
+            q.task_done_many(3)
+        # The failed call marked nothing done, so both tasks still are.
+        q.task_done_many(2)
+        self.loop.run_until_complete(
+            asyncio.wait_for(q.coro_join(loop=self.loop), 5)
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,131 @@
+import asyncio
+import unittest
+
+import aioprocessing
+from aioprocessing import rpc, transport
+from aioprocessing.mp import Process
+
+from ._base_test import BaseTest
+
+
+async def _double(request):
+    await asyncio.sleep(request / 100)
+    return request * 2
+
+
+def serve_doubles(conn, other_end):
+    # The other end must only be open in the client, so closing it
+    # there ends the server.
+    other_end.close()
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(rpc.serve(conn, _double, loop=loop))
+    loop.close()
+
+
+class RpcTest(BaseTest):
+    def _check_calls(self, **kwargs):
+        conn1, conn2 = aioprocessing.AioPipe(**kwargs)
+        p = Process(target=serve_doubles, args=(conn2, conn1))
+        p.start()
+        conn2.close()
+        client = rpc.RpcClient(conn1, loop=self.loop)
+
+        async def calls():
+            # The slowest call is made first, so the replies come back
+            # in the opposite order to the requests.
+            return await asyncio.gather(
+                *[client.call(i) for i in reversed(range(20))]
+            )
+
+        start = self.loop.time()
+        out = self.loop.run_until_complete(calls())
+        self.assertLess(self.loop.time() - start, 1)
+        self.assertEqual(out, [i * 2 for i in reversed(range(20))])
+        client.close()
+        p.join()
+        self.assertEqual(p.exitcode, 0)
+
+    def test_calls(self):
+        self._check_calls()
+
+    @unittest.skipIf(not transport.supported, "Not supported on Windows")
+    def test_calls_native(self):
+        self._check_calls(native=True)
+
+    def test_errors(self):
+        conn1, conn2 = aioprocessing.AioPipe()
+        client = rpc.RpcClient(conn1, loop=self.loop)
+
+        async def handler(request):
+            if request == "unpicklable":
+                # Unlike a lock, which dill can pickle, a generator can't
+                # be sent whether multiprocess is installed or not.
+                return (i for i in ())
+            return 1 / request
+
+        async def calls():
+            server = rpc.serve(conn2, handler, loop=self.loop)
+            try:
+                with self.assertRaises(ZeroDivisionError):
+                    await client.call(0)
+                with self.assertRaisesRegex(RuntimeError, "Couldn't send"):
+                    await client.call("unpicklable")
+                self.assertEqual(await client.call(4), 0.25)
+            finally:
+                # Otherwise a failure leaves the server's recv blocking
+                # an executor thread, and the test run never exits.
+                conn1.close()
+                await server
+
+        self.loop.run_until_complete(calls())
+        with self.assertRaises(ValueError):
+            rpc.serve(conn2, handler, 0, loop=self.loop)
+
+    def test_cancel(self):
+        conn1, conn2 = aioprocessing.AioPipe()
+        client = rpc.RpcClient(conn1, loop=self.loop)
+        cancelled = []
+        most_active = []
+        active = []
+
+        async def handler(request):
+            active.append(request)
+            most_active.append(len(active))
+            try:
+                await asyncio.sleep(request)
+            except asyncio.CancelledError:
+                cancelled.append(request)
+                raise
+            finally:
+                active.remove(request)
+            return request
+
+        async def calls():
+            server = rpc.serve(conn2, handler, 2, loop=self.loop)
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(client.call(10), 0.1)
+            out = await asyncio.gather(
+                *[client.call(i / 100) for i in range(6)]
+            )
+            self.assertEqual(out, [i / 100 for i in range(6)])
+            conn1.close()
+            await server
+
+        self.loop.run_until_complete(calls())
+        self.assertEqual(cancelled, [10])
+        self.assertLessEqual(max(most_active), 2)
+
+    def test_connection_lost(self):
+        conn1, conn2 = aioprocessing.AioPipe()
+        client = rpc.RpcClient(conn1, loop=self.loop)
+
+        async def calls():
+            fut = asyncio.ensure_future(client.call(1), loop=self.loop)
+            await conn2.coro_recv(loop=self.loop)
+            conn2.close()
+            with self.assertRaises(EOFError):
+                await fut
+            with self.assertRaises(OSError):
+                await client.call(2)
+
+        self.loop.run_until_complete(calls())